@@ -0,0 +1,289 @@
+"""
+Benchmarks for the reference data pipeline
+
+  python benchmark.py codec [--records N] [--tables N]
+      JSON parse and dump throughput on a synthetic artifact
+
+  python benchmark.py e2e [--scenarios quick|full] [--baseline FILE] [--write-baseline FILE]
+      runs synthetic artifacts through every stage against fake AWS services, printing a JSON line of stage timings
+      and request counts for each run.  With --baseline the job fails if any stage makes more requests than the
+      baseline recorded, so request regressions show up in CI; timings are only checked with --time-tolerance.
+"""
+import argparse
+import collections
+import json
+import random
+import StringIO
+import sys
+import time
+import zipfile
+
+import codec
+from loader import parse_files
+
+ENV = "bench"
+BUCKET = "artifacts"
+REPORT_BUCKET = "reports"
+# record files are numbered from here so their names sort after 000_schema.json
+FIRST_FILE = 1000000
+
+# (name, records, tables, key arity, document depth), the quick scenarios are run in CI
+SCENARIOS = {
+    "quick": [
+        ("1k-1t-k1-d1", 1000, 1, 1, 1),
+        ("1k-10t-k2-d3", 1000, 10, 2, 3)
+    ],
+    "full": [
+        ("1k-1t-k1-d1", 1000, 1, 1, 1),
+        ("1k-10t-k2-d3", 1000, 10, 2, 3),
+        ("10k-1t-k1-d2", 10000, 1, 1, 2),
+        ("10k-50t-k3-d4", 10000, 50, 3, 4),
+        ("100k-10t-k2-d2", 100000, 10, 2, 2),
+        ("100k-50t-k1-d1", 100000, 50, 1, 1)
+    ]
+}
+
+def make_artifact(records, tables):
+    """
+    Makes (table, file name, text) entries for a synthetic artifact of create records spread across tables
+    """
+    rng = random.Random(1)
+    entries = []
+    per_table = records // tables
+    for t in range(tables):
+        table = "table{t:02d}".format(t=t)
+        entries.append((table, "000_schema.json", json.dumps({"table": table, "keys": ["id1", "id2"]})))
+        for n in range(per_table):
+            entries.append((table, "{n:06d}_create.json".format(n=n + 1), json.dumps({
+                "action": "create",
+                "data": {
+                    "id1": n,
+                    "id2": "key-{n}".format(n=n),
+                    "name": "record {n} of {t}".format(n=n, t=table),
+                    "price": round(rng.uniform(0, 1000), 2),
+                    "rate": rng.random(),
+                    "enabled": rng.random() > 0.5,
+                    "tags": ["tag{i}".format(i=i) for i in range(rng.randint(0, 5))],
+                    "details": {
+                        "count": rng.randint(0, 100000),
+                        "ratio": round(rng.random(), 4),
+                        "note": "x" * rng.randint(10, 200)
+                    }
+                }
+            }, indent=2)))
+    return entries
+
+def timed(function):
+    start = time.time()
+    result = function()
+    return (time.time() - start, result)
+
+def report(name, seconds, count, size):
+    print "{n:<36} {s:8.3f}s {r:12,.0f} records/s {m:8.1f} MB/s".format(
+        n = name,
+        s = seconds,
+        r = count / seconds,
+        m = size / seconds / 1024 / 1024
+    )
+
+def run_codec(records = 50000, tables = 10):
+    entries = make_artifact(records, tables)
+    texts = [text for (table, file, text) in entries]
+    size = sum(len(text) for text in texts)
+    print "{c} files, {m:.1f} MB of JSON".format(c = len(entries), m = size / 1024.0 / 1024)
+    backends = ["json"] + (["simplejson"] if codec.simplejson else [])
+    for backend in backends:
+        codec.set_backend(backend)
+        (seconds, parsed) = timed(lambda: [codec.loads(text) for text in texts])
+        report("{b} parse".format(b = backend), seconds, len(texts), size)
+        (seconds, dumped) = timed(lambda: [codec.dumps(data, indent=2, sort_keys=True) for data in parsed])
+        report("{b} dump (report)".format(b = backend), seconds, len(parsed), sum(len(text) for text in dumped))
+        (seconds, dumped) = timed(lambda: [codec.dumps(data, sort_keys=True, separators=(",", ":")) for data in parsed])
+        report("{b} dump (checksum)".format(b = backend), seconds, len(parsed), sum(len(text) for text in dumped))
+        (seconds, loaded) = timed(lambda: list(parse_files(iter(entries), len(entries))))
+        report("{b} parse (process pool)".format(b = backend), seconds, len(entries), size)
+
+def make_document(rng, depth):
+    """
+    Makes a nested document depth levels deep
+    """
+    document = {
+        "value": rng.randint(0, 1000),
+        "label": "v" * rng.randint(5, 50),
+        "items": [rng.randint(0, 100) for i in range(3)]
+    }
+    if depth > 1:
+        document["child"] = make_document(rng, depth - 1)
+    return document
+
+def make_reference_zip(records, tables, key_arity, depth, changes = False):
+    """
+    Makes a zip file of reference data with records create records spread across tables
+
+    With changes there are also update files for a fifth of the records, changing one leaf of their documents, and
+    delete files for a twentieth.  Returns the zip file contents.
+    """
+    rng = random.Random(records * 31 + tables)
+    keys = ["id1", "id2", "id3"][:key_arity]
+    archive = StringIO.StringIO()
+    zf = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+    per_table = max(1, records // tables)
+    for t in range(tables):
+        table = "table{t:02d}".format(t=t)
+        zf.writestr("{t}/000_schema.json".format(t=table), json.dumps({"table": table, "keys": keys}))
+        for n in range(per_table):
+            key = {"id1": n, "id2": "key-{n}".format(n=n), "id3": n % 7}
+            data = dict((k, key[k]) for k in keys)
+            data.update({
+                "name": "record {n} of {t}".format(n=n, t=table),
+                "enabled": n % 2 == 0,
+                "doc": make_document(rng, depth)
+            })
+            zf.writestr("{t}/{n:07d}_create_record.json".format(t=table, n=FIRST_FILE + n), json.dumps({"action": "create", "data": data}))
+            if changes and n % 5 == 0:
+                update = json.loads(json.dumps(data))
+                leaf = update["doc"]
+                while "child" in leaf:
+                    leaf = leaf["child"]
+                leaf["value"] += 1
+                zf.writestr("{t}/{n:07d}_update_record.json".format(t=table, n=FIRST_FILE + per_table + n), json.dumps({"action": "update", "data": update}))
+            if changes and n % 20 == 1:
+                zf.writestr("{t}/{n:07d}_delete_record.json".format(t=table, n=FIRST_FILE + 2 * per_table + n), json.dumps({"action": "delete", "data": dict((k, key[k]) for k in keys)}))
+    zf.close()
+    return archive.getvalue()
+
+def run_stages(lf, aws, artifact_key):
+    """
+    Runs each stage of report and commit mode on the artifact at artifact_key, returning the time and requests of each
+    """
+    stages = collections.OrderedDict()
+    state = {}
+    def stage(name, function):
+        before = aws.request_counts()
+        (seconds, result) = timed(function)
+        after = aws.request_counts()
+        stages[name] = {
+            "seconds": round(seconds, 4),
+            "requests": dict((op, after[op] - before.get(op, 0)) for op in after if after[op] != before.get(op, 0))
+        }
+        return result
+    def parse():
+        checksums = {}
+        tables = dict(lf.iter_validated_tables(lf.checksum_files(lf.iter_zip_files(state["artifact"]), checksums)))
+        state["artifact"].close()
+        return (tables, checksums)
+    (state["artifact"], artifact_hash) = stage("download", lambda: lf.get_artifact_from_s3(BUCKET, artifact_key))
+    (tables, checksums) = stage("parse", parse)
+    unmanaged = stage("compare", lambda: lf.compare_tables_to_dynamo(tables, ENV, mode = "batch", concurrency = 4))
+    stage("report", lambda: lf.put_report_in_s3(REPORT_BUCKET, "job", tables, ENV, unmanaged))
+    stage("plan", lambda: lf.put_change_plan_in_s3(REPORT_BUCKET, "job/plan.ndjson", tables))
+    stage("apply", lambda: lf.apply_tables_to_dynamo(tables, ENV, mode = "batch", concurrency = 4))
+    actions = collections.Counter(record["_compare_result"]["action"] for table in tables.values() for record in table.get_records())
+    return (stages, dict(actions))
+
+def run_handler(lf, aws, artifact_key):
+    """
+    Runs the artifact through cp_event_handler in report and then commit mode, failing if either job fails
+    """
+    from fake_aws import make_job_event
+    for mode in ["report", "commit"]:
+        lf.cp_event_handler(make_job_event("job-" + mode, BUCKET, artifact_key, {
+            "mode": mode,
+            "env": ENV,
+            "reportbucket": REPORT_BUCKET,
+            "topic": "arn:aws:sns:fake:topic",
+            "concurrency": 4,
+            "writes": "batch"
+        }), None)
+        (job, result, message) = aws.code_pipeline.results[-1]
+        if result != "success":
+            raise RuntimeError("{m} job failed: {msg}".format(m = mode, msg = message))
+
+def run_scenario(name, records, tables, key_arity, depth):
+    """
+    Runs a scenario against fresh fake AWS services in three phases: an initial load into empty tables, the same
+    artifact again (nothing to do) and an artifact with updates and deletes, then both modes through the handler
+
+    Returns a list of results, one for each phase
+    """
+    import lambda_function as lf
+    from fake_aws import FakeAWS
+    results = []
+    with FakeAWS().install(lf) as aws:
+        for t in range(tables):
+            aws.dynamodb.create_table("{env}_table{t:02d}".format(env = ENV, t = t), ["id1", "id2", "id3"][:key_arity])
+        aws.s3.put(BUCKET, "initial.zip", make_reference_zip(records, tables, key_arity, depth))
+        aws.s3.put(BUCKET, "changes.zip", make_reference_zip(records, tables, key_arity, depth, changes = True))
+        for (phase, key) in [("initial", "initial.zip"), ("noop", "initial.zip"), ("changes", "changes.zip")]:
+            (stages, actions) = run_stages(lf, aws, key)
+            results.append({"scenario": name, "phase": phase, "records": records, "actions": actions, "stages": stages})
+        before = aws.request_counts()
+        (seconds, result) = timed(lambda: run_handler(lf, aws, "changes.zip"))
+        after = aws.request_counts()
+        results.append({"scenario": name, "phase": "handler", "records": records, "stages": {"handler": {
+            "seconds": round(seconds, 4),
+            "requests": dict((op, after[op] - before.get(op, 0)) for op in after if after[op] != before.get(op, 0))
+        }}})
+    return results
+
+def check_baseline(results, baseline, time_tolerance = None):
+    """
+    Compares results with a baseline, returning a list of the stages which make more requests or, when time_tolerance
+    is given, take more than that fraction longer
+    """
+    expected = dict(((b["scenario"], b["phase"]), b) for b in baseline)
+    problems = []
+    for result in results:
+        base = expected.get((result["scenario"], result["phase"]))
+        if base is None:
+            continue
+        for (stage, measured) in result["stages"].items():
+            base_stage = base["stages"].get(stage, {})
+            for (op, count) in measured["requests"].items():
+                if count > base_stage.get("requests", {}).get(op, 0):
+                    problems.append("{s}/{p}/{st}: {op} {c} requests, baseline {b}".format(
+                        s = result["scenario"], p = result["phase"], st = stage, op = op, c = count, b = base_stage.get("requests", {}).get(op, 0)))
+            if time_tolerance is not None and "seconds" in base_stage and measured["seconds"] > base_stage["seconds"] * (1 + time_tolerance):
+                problems.append("{s}/{p}/{st}: {t}s, baseline {b}s".format(
+                    s = result["scenario"], p = result["phase"], st = stage, t = measured["seconds"], b = base_stage["seconds"]))
+    return problems
+
+def run_e2e(scenarios = "quick", baseline = None, write_baseline = None, time_tolerance = None):
+    results = []
+    for scenario in SCENARIOS[scenarios]:
+        for result in run_scenario(*scenario):
+            print json.dumps(result, sort_keys = True)
+            results.append(result)
+    if write_baseline:
+        with open(write_baseline, "w") as f:
+            json.dump([{"scenario": r["scenario"], "phase": r["phase"], "stages": dict(
+                (stage, {"requests": measured["requests"]}) for (stage, measured) in r["stages"].items()
+            )} for r in results], f, indent = 2, separators = (",", ": "), sort_keys = True)
+    if baseline:
+        with open(baseline) as f:
+            problems = check_baseline(results, json.load(f), time_tolerance)
+        for problem in problems:
+            print "REGRESSION " + problem
+        if problems:
+            return 1
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "Benchmarks for the reference data pipeline")
+    commands = parser.add_subparsers(dest = "command")
+    codec_parser = commands.add_parser("codec", help = "JSON parse and dump throughput")
+    codec_parser.add_argument("--records", type = int, default = 50000)
+    codec_parser.add_argument("--tables", type = int, default = 10)
+    e2e_parser = commands.add_parser("e2e", help = "every stage against fake AWS services")
+    e2e_parser.add_argument("--scenarios", choices = sorted(SCENARIOS.keys()), default = "quick")
+    e2e_parser.add_argument("--baseline", help = "fail if a stage makes more requests than this baseline")
+    e2e_parser.add_argument("--write-baseline", help = "write the request counts to this file")
+    e2e_parser.add_argument("--time-tolerance", type = float, help = "also fail if a stage is this fraction slower than the baseline")
+    args = parser.parse_args(argv)
+    if args.command == "codec":
+        run_codec(args.records, args.tables)
+        return 0
+    return run_e2e(args.scenarios, args.baseline, args.write_baseline, args.time_tolerance)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
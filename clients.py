@@ -0,0 +1,144 @@
+import collections
+import threading
+
+import boto3.session
+import botocore.client
+import botocore.exceptions
+
+REGION = "ap-southeast-2"
+# clients for this many sets of credentials are kept, artifact credentials change with each job
+MAX_CREDENTIAL_SESSIONS = 4
+
+# retry modes botocore can use, legacy is the only behaviour of botocore before 1.15
+RETRY_MODES = ["legacy", "standard", "adaptive"]
+# the size of botocore's connection pool when it is not configured
+DEFAULT_POOL_CONNECTIONS = 10
+
+def _credentials_key(creds):
+    if not creds:
+        return None
+    return (creds["accessKeyId"], creds["secretAccessKey"], creds["sessionToken"])
+
+def _supports(**options):
+    try:
+        botocore.client.Config(**options)
+        return True
+    except (TypeError, botocore.exceptions.InvalidRetryConfigurationError):
+        return False
+
+def client_config(max_pool_connections=None, retry_mode=None, max_attempts=None, connect_timeout=None,
+        read_timeout=None, tcp_keepalive=None):
+    """
+    Gets the botocore Config arguments for the settings which are not None
+
+    Settings the installed botocore does not support are left out, retry modes need botocore 1.15 and TCP keepalive
+    1.27.  Returns the arguments and a list of the settings which were left out.
+    """
+    if retry_mode is not None and retry_mode not in RETRY_MODES:
+        raise ValueError("Retry mode {m} is not one of {r}".format(m=retry_mode, r=RETRY_MODES))
+    config = {}
+    unsupported = []
+    for (name, value) in [("max_pool_connections", max_pool_connections), ("connect_timeout", connect_timeout),
+            ("read_timeout", read_timeout), ("tcp_keepalive", tcp_keepalive)]:
+        if value is None:
+            continue
+        if _supports(**{name: value}):
+            config[name] = value
+        else:
+            unsupported.append(name)
+    retries = {}
+    if max_attempts is not None:
+        retries["max_attempts"] = max_attempts
+    if retry_mode is not None:
+        if _supports(retries={"mode": retry_mode}):
+            retries["mode"] = retry_mode
+        elif retry_mode != "legacy":
+            unsupported.append("retry_mode")
+    if retries:
+        config["retries"] = retries
+    return (config, unsupported)
+
+class ClientRegistry(object):
+    """
+    Creates boto3 clients and resources the first time they are asked for and keeps them, so they and their connection
+    pools are reused by later calls and warm invocations
+
+    Clients are kept for each service, kind (client or resource), botocore config and set of credentials.  Without
+    credentials a shared session for region is used.  With credentials (the CodePipeline artifact credentials) a session
+    is made for them, and only the clients of the most recently used MAX_CREDENTIAL_SESSIONS sets are kept.
+    """
+    def __init__(self, region=REGION, session_factory=boto3.session.Session):
+        self.region = region
+        self.session_factory = session_factory
+        self._session = None
+        self._clients = {}
+        self._credential_clients = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _create(self, service, kind, creds, config):
+        if creds:
+            session = self.session_factory(
+                aws_access_key_id=creds["accessKeyId"],
+                aws_secret_access_key=creds["secretAccessKey"],
+                aws_session_token=creds["sessionToken"]
+            )
+        else:
+            if self._session is None:
+                self._session = self.session_factory(region_name=self.region)
+            session = self._session
+        factory = session.resource if kind == "resource" else session.client
+        if config:
+            return factory(service, config=botocore.client.Config(**config))
+        return factory(service)
+
+    def get(self, service, kind="client", creds=None, **config):
+        """
+        Gets the client (or resource when kind is resource) for service, creating it if needed
+
+        creds are CodePipeline style artifact credentials and config are botocore client Config arguments
+        """
+        # config values like retries are dicts, which cannot be hashed
+        key = (service, kind, repr(sorted(config.items())))
+        creds_key = _credentials_key(creds)
+        with self._lock:
+            if creds_key is None:
+                clients = self._clients
+            else:
+                clients = self._credential_clients.pop(creds_key, {})
+                self._credential_clients[creds_key] = clients
+                while len(self._credential_clients) > MAX_CREDENTIAL_SESSIONS:
+                    self._credential_clients.popitem(last=False)
+            if key not in clients:
+                clients[key] = self._create(service, kind, creds, config)
+            return clients[key]
+
+    def lazy(self, service, kind="client", config=None):
+        """
+        Gets a stand-in for a client which is only created when one of its attributes is first used
+
+        config is a dict of botocore client Config arguments, it is read each time the client is used so changes to it
+        switch the stand-in to a client with the new config
+        """
+        return LazyClient(self, service, kind, {} if config is None else config)
+
+    def clear(self):
+        """
+        Forgets every client so they are created again when next used
+        """
+        with self._lock:
+            self._session = None
+            self._clients = {}
+            self._credential_clients.clear()
+
+class LazyClient(object):
+    """
+    Stands in for a client from a ClientRegistry, getting it from the registry whenever an attribute is used
+    """
+    def __init__(self, registry, service, kind, config):
+        self._registry = registry
+        self._service = service
+        self._kind = kind
+        self._config = config
+
+    def __getattr__(self, name):
+        return getattr(self._registry.get(self._service, self._kind, **self._config), name)
@@ -0,0 +1,167 @@
+import base64
+import decimal
+import json
+import re
+import uuid
+
+from boto3.dynamodb.types import Binary
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+BACKENDS = ["json", "simplejson"]
+
+INFINITY = float("inf")
+
+# json's python encoder, which is private so may not be there in every version
+_make_iterencode = getattr(json.encoder, "_make_iterencode", None)
+
+def _default(o):
+    # dynamo DB items can hold sets and binary values, which JSON has no type for
+    if isinstance(o, (set, frozenset)):
+        return sorted(_default(v) if isinstance(v, Binary) else v for v in o)
+    if isinstance(o, Binary):
+        return base64.b64encode(o.value)
+    raise TypeError("{o!r} is not JSON serializable".format(o=o))
+
+class _DecimalFloat(float):
+    """
+    A float standing in for a Decimal which keeps the Decimal's exact digits to be written
+    """
+    def __new__(cls, value):
+        self = float.__new__(cls, value)
+        self.text = str(value)
+        return self
+
+class ExactDecimalEncoder(json.JSONEncoder):
+    """
+    A json encoder which writes Decimals with their exact digits, as simplejson does with use_decimal
+
+    json writes floats with float.__repr__, in its C encoder as well, so the python encoder is used with a float writer
+    which knows about Decimals.  When the python encoder is not available, or takes different arguments, each Decimal
+    is written as a string made of a random token and its digits, and the quotes and token are taken off afterwards.
+    Sets and binary values are written as _default does.
+    """
+    def default(self, o):
+        if isinstance(o, decimal.Decimal):
+            return _DecimalFloat(o)
+        return _default(o)
+
+    def iterencode(self, o, _one_shot=False):
+        if _make_iterencode is not None:
+            try:
+                return self._iterencode(o, _one_shot)
+            except TypeError:
+                pass
+        return self._iterencode_tokens(o)
+
+    def _iterencode(self, o, _one_shot):
+        markers = {} if self.check_circular else None
+        if self.ensure_ascii:
+            encoder = json.encoder.encode_basestring_ascii
+        else:
+            encoder = json.encoder.encode_basestring
+
+        def floatstr(o):
+            if isinstance(o, _DecimalFloat):
+                return o.text
+            if o != o:
+                text = "NaN"
+            elif o == INFINITY:
+                text = "Infinity"
+            elif o == -INFINITY:
+                text = "-Infinity"
+            else:
+                return json.encoder.FLOAT_REPR(o)
+            if not self.allow_nan:
+                raise ValueError("Out of range float values are not JSON compliant: {o!r}".format(o=o))
+            return text
+
+        return _make_iterencode(markers, self.default, encoder, self.indent, floatstr, self.key_separator,
+            self.item_separator, self.sort_keys, self.skipkeys, _one_shot)(o, 0)
+
+    def _iterencode_tokens(self, o):
+        token = uuid.uuid4().hex
+
+        def default(o):
+            if isinstance(o, decimal.Decimal):
+                return token + str(o)
+            return _default(o)
+
+        text = json.JSONEncoder(skipkeys=self.skipkeys, ensure_ascii=self.ensure_ascii, check_circular=self.check_circular,
+            allow_nan=self.allow_nan, indent=self.indent, separators=(self.item_separator, self.key_separator),
+            sort_keys=self.sort_keys, default=default).encode(o)
+        return iter([re.sub('"{t}([^"]*)"'.format(t=token), r"\1", text)])
+
+class Codec(object):
+    """
+    Reads and writes JSON using the stdlib json module or simplejson
+
+    Numbers with a fraction or exponent are parsed to Decimal, which is what dynamo DB uses, rather than float.
+    Output is the same whichever backend is used, Decimals are written with their exact digits rather than as floats,
+    so plans and checksums keep the precision dynamo DB does.  Sets, as read from dynamo DB, are written as sorted lists
+    and binary values as base64 strings.
+    """
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = "simplejson" if simplejson else "json"
+        if backend not in BACKENDS:
+            raise ValueError("JSON backend must be one of {b}".format(b=BACKENDS))
+        if backend == "simplejson" and not simplejson:
+            raise ValueError("simplejson is not installed")
+        self.backend = backend
+
+    def loads(self, text):
+        """
+        Parses JSON text
+        """
+        if self.backend == "simplejson":
+            return simplejson.loads(text, use_decimal=True)
+        return json.loads(text, parse_float=decimal.Decimal)
+
+    def dumps(self, data, **kwargs):
+        """
+        Writes data as JSON text, takes the same keyword arguments as json.dumps
+        """
+        if self.backend == "simplejson":
+            if kwargs.get("indent") is not None and "separators" not in kwargs:
+                # match the separators json uses when indenting
+                kwargs["separators"] = (", ", ": ")
+            return simplejson.dumps(data, use_decimal=True, default=_default, **kwargs)
+        return json.dumps(data, cls=ExactDecimalEncoder, **kwargs)
+
+_codec = Codec()
+
+def set_backend(backend):
+    """
+    Changes the backend used by loads and dumps
+    """
+    global _codec
+    _codec = Codec(backend)
+
+def get_backend():
+    """
+    Gets the name of the backend used by loads and dumps
+    """
+    return _codec.backend
+
+def loads(text):
+    """
+    Parses JSON text, numbers with a fraction or exponent become Decimal
+    """
+    return _codec.loads(text)
+
+def dumps(data, **kwargs):
+    """
+    Writes data as JSON text, Decimals are written with their exact digits
+    """
+    return _codec.dumps(data, **kwargs)
+
+def canonical_dumps(data):
+    """
+    Writes data as canonical JSON for hashing, with keys sorted, no whitespace and Decimals as their exact digits, so
+    equal data always gives the same text and Decimals which differ past float precision do not
+    """
+    return _codec.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=True)
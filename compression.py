@@ -0,0 +1,53 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# values for the Content-Encoding header, identity means no compression
+ENCODINGS = ["identity", "gzip", "br"]
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+class _IdentityWriter(object):
+    def __init__(self, out):
+        self.out = out
+
+    def write(self, data):
+        self.out.write(data)
+
+    def close(self):
+        pass
+
+class _BrotliWriter(object):
+    def __init__(self, out):
+        self.out = out
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+
+    def write(self, data):
+        self.out.write(self.compressor.process(data))
+
+    def close(self):
+        self.out.write(self.compressor.finish())
+
+def available_encodings():
+    """
+    Gets the encodings which can be used here, br needs the brotli module
+    """
+    return [encoding for encoding in ENCODINGS if encoding != "br" or brotli is not None]
+
+def open_writer(out, encoding):
+    """
+    Opens a writer which compresses what is written to it with encoding and writes it to the file object out
+
+    Closing the writer flushes the compressed data but leaves out open
+    """
+    if encoding not in available_encodings():
+        raise ValueError("Encoding {e} is not one of {a}".format(e=encoding, a=available_encodings()))
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=out, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br":
+        return _BrotliWriter(out)
+    return _IdentityWriter(out)
@@ -0,0 +1,454 @@
+import collections
+import copy
+import json
+import math
+import re
+import StringIO
+import threading
+
+import botocore.exceptions
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+def client_error(code, message, operation):
+    return botocore.exceptions.ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+class ConditionalCheckFailedException(botocore.exceptions.ClientError):
+    def __init__(self, operation):
+        botocore.exceptions.ClientError.__init__(self, {"Error": {
+            "Code": "ConditionalCheckFailedException",
+            "Message": "The conditional request failed"
+        }}, operation)
+
+class _Exceptions(object):
+    ConditionalCheckFailedException = ConditionalCheckFailedException
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+def _normalize(value):
+    # store values as dynamo DB would return them, numbers become Decimal and floats are rejected as boto3 does
+    return _deserializer.deserialize(_serializer.serialize(value))
+
+def _item_size(item):
+    return len(json.dumps(item, default=str))
+
+def _read_units(items):
+    return sum(max(1, int(math.ceil(_item_size(item) / 4096.0))) for item in items) or 1
+
+def _write_units(item):
+    return max(1, int(math.ceil(_item_size(item) / 1024.0)))
+
+class _FakeTable(object):
+    def __init__(self, keys, read_capacity, write_capacity):
+        self.keys = keys
+        self.read_capacity = read_capacity
+        self.write_capacity = write_capacity
+        self.items = {}
+
+    def key_of(self, item):
+        return tuple(item[k] for k in self.keys)
+
+class FakeDynamoDB(object):
+    """
+    A DynamoDB stand-in with a python typed item client and a low level client
+
+    client takes and returns python types like the client behind a boto3 resource, low_level_client takes and returns
+    typed attribute values like boto3.client("dynamodb").  With throttle_every set every nth request is throttled.
+    With batch_limit set batch gets and writes only process that many keys or items of each table, returning the rest
+    as unprocessed as DynamoDB does when a batch is too big or throttled.  Batches bigger than DynamoDB allows fail.
+    """
+    PAGE_SIZE = 100
+    BATCH_GET_MAX_KEYS = 100
+    BATCH_WRITE_MAX_ITEMS = 25
+
+    def __init__(self, throttle_every=None, batch_limit=None):
+        self.tables = {}
+        self.requests = collections.Counter()
+        self.throttle_every = throttle_every
+        self.batch_limit = batch_limit
+        self._count = 0
+        self._lock = threading.RLock()
+        self.client = _FakeDynamoDBClient(self)
+        self.low_level_client = _FakeDynamoDBLowLevelClient(self)
+        self.meta = self
+
+    def create_table(self, name, keys, read_capacity=0, write_capacity=0):
+        """
+        Creates an empty table with the key fields keys, a capacity of 0 means on demand
+        """
+        self.tables[name] = _FakeTable(keys, read_capacity, write_capacity)
+
+    def put(self, name, item):
+        """
+        Puts an item in a table without counting a request
+        """
+        table = self.tables[name]
+        table.items[table.key_of(item)] = _normalize(item)
+
+    def items(self, name):
+        """
+        Gets the items in a table ordered by key
+        """
+        table = self.tables[name]
+        return [table.items[key] for key in sorted(table.items.keys())]
+
+    def table(self, name, operation):
+        if name not in self.tables:
+            raise client_error("ResourceNotFoundException", "Requested resource not found: {t}".format(t=name), operation)
+        return self.tables[name]
+
+    def request(self, operation, table):
+        with self._lock:
+            self.requests[(operation, table)] += 1
+            self._count += 1
+            if self.throttle_every and self._count % self.throttle_every == 0:
+                raise client_error("ProvisionedThroughputExceededException", "Throttled", operation)
+
+    def consumed(self, table, units):
+        return {"TableName": table, "CapacityUnits": float(units)}
+
+    def split_batch(self, requests, limit, operation):
+        if len(requests) > limit:
+            raise client_error("ValidationException", "Too many items requested for the {o} call".format(o=operation), operation)
+        if self.batch_limit is None:
+            return (requests, [])
+        return (requests[:self.batch_limit], requests[self.batch_limit:])
+
+class _FakeDynamoDBClient(object):
+    exceptions = _Exceptions()
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_item(self, TableName, Key, ConsistentRead=False, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            self.db.request("GetItem", TableName)
+            table = self.db.table(TableName, "GetItem")
+            item = table.items.get(table.key_of(Key))
+            response = {"ConsumedCapacity": self.db.consumed(TableName, _read_units([item] if item else []))}
+            if item is not None:
+                response["Item"] = copy.deepcopy(item)
+            return response
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            responses = {}
+            unprocessed = {}
+            consumed = []
+            for (name, request) in RequestItems.items():
+                self.db.request("BatchGetItem", name)
+                table = self.db.table(name, "BatchGetItem")
+                (keys, rest) = self.db.split_batch(request["Keys"], self.db.BATCH_GET_MAX_KEYS, "BatchGetItem")
+                if rest:
+                    unprocessed[name] = dict(request, Keys=rest)
+                attributes = None
+                if "ProjectionExpression" in request:
+                    names = request.get("ExpressionAttributeNames", {})
+                    attributes = [names.get(a.strip(), a.strip()) for a in request["ProjectionExpression"].split(",")]
+                items = [table.items[table.key_of(key)] for key in keys if table.key_of(key) in table.items]
+                consumed.append(self.db.consumed(name, _read_units(items)))
+                if attributes is not None:
+                    items = [dict((k, v) for (k, v) in item.items() if k in attributes) for item in items]
+                responses[name] = copy.deepcopy(items)
+            return {"Responses": responses, "UnprocessedKeys": unprocessed, "ConsumedCapacity": consumed}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            self.db.request("PutItem", TableName)
+            table = self.db.table(TableName, "PutItem")
+            key = table.key_of(Item)
+            if ConditionExpression:
+                fields = re.findall(r"attribute_not_exists\((\w+)\)", ConditionExpression)
+                if key in table.items and any(field in table.items[key] for field in fields):
+                    raise ConditionalCheckFailedException("PutItem")
+            table.items[key] = _normalize(Item)
+            return {"ConsumedCapacity": self.db.consumed(TableName, _write_units(Item))}
+
+    def delete_item(self, TableName, Key, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            self.db.request("DeleteItem", TableName)
+            table = self.db.table(TableName, "DeleteItem")
+            item = table.items.pop(table.key_of(Key), None)
+            return {"ConsumedCapacity": self.db.consumed(TableName, _write_units(item or Key))}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            self.db.request("UpdateItem", TableName)
+            table = self.db.table(TableName, "UpdateItem")
+            key = table.key_of(Key)
+            item = copy.deepcopy(table.items.get(key, _normalize(Key)))
+            names = ExpressionAttributeNames or {}
+            values = ExpressionAttributeValues or {}
+            removes = []
+            for (action, clause) in re.findall(r"(SET|REMOVE)\s+(.*?)(?=\s+(?:SET|REMOVE)\s|$)", UpdateExpression):
+                for part in clause.split(","):
+                    if action == "SET":
+                        (path, value) = [side.strip() for side in part.split("=")]
+                        _set_path(item, _parse_path(path, names), _normalize(values[value]))
+                    else:
+                        removes.append(_parse_path(part.strip(), names))
+            # list elements are removed from the end first so earlier indexes still refer to the same elements
+            for path in sorted(removes, key=lambda path: [(0, e) if isinstance(e, basestring) else (1, -e) for e in path]):
+                _remove_path(item, path)
+            table.items[key] = item
+            return {"ConsumedCapacity": self.db.consumed(TableName, _write_units(item))}
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            unprocessed = {}
+            consumed = []
+            for (name, requests) in RequestItems.items():
+                self.db.request("BatchWriteItem", name)
+                table = self.db.table(name, "BatchWriteItem")
+                (requests, rest) = self.db.split_batch(requests, self.db.BATCH_WRITE_MAX_ITEMS, "BatchWriteItem")
+                if rest:
+                    unprocessed[name] = rest
+                units = 0
+                for request in requests:
+                    if "PutRequest" in request:
+                        item = request["PutRequest"]["Item"]
+                        table.items[table.key_of(item)] = _normalize(item)
+                        units += _write_units(item)
+                    else:
+                        table.items.pop(table.key_of(request["DeleteRequest"]["Key"]), None)
+                        units += 1
+                consumed.append(self.db.consumed(name, units))
+            return {"UnprocessedItems": unprocessed, "ConsumedCapacity": consumed}
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None, ConsistentRead=False, ExclusiveStartKey=None, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            self.db.request("Query", TableName)
+            table = self.db.table(TableName, "Query")
+            (name, value) = [side.strip() for side in KeyConditionExpression.split("=")]
+            name = (ExpressionAttributeNames or {}).get(name, name)
+            value = ExpressionAttributeValues[value]
+            items = [table.items[key] for key in sorted(table.items.keys()) if table.items[key].get(name) == value]
+            return {"Items": copy.deepcopy(items), "ConsumedCapacity": self.db.consumed(TableName, _read_units(items))}
+
+def _parse_path(path, names):
+    elements = []
+    for (name, index) in re.findall(r"([#\w]+)|\[(\d+)\]", path):
+        if name:
+            elements.append(names.get(name, name))
+        else:
+            elements.append(int(index))
+    return elements
+
+def _parent(item, path, operation):
+    container = item
+    for element in path[:-1]:
+        try:
+            container = container[element]
+        except (KeyError, IndexError, TypeError):
+            raise client_error("ValidationException", "The document path provided in the update expression is invalid for update", operation)
+    return container
+
+def _set_path(item, path, value):
+    container = _parent(item, path, "UpdateItem")
+    if isinstance(container, list) and path[-1] >= len(container):
+        container.append(value)
+    else:
+        container[path[-1]] = value
+
+def _remove_path(item, path):
+    container = _parent(item, path, "UpdateItem")
+    if isinstance(container, list):
+        if path[-1] < len(container):
+            del container[path[-1]]
+    else:
+        container.pop(path[-1], None)
+
+class _FakeDynamoDBLowLevelClient(object):
+    def __init__(self, db):
+        self.db = db
+
+    def describe_table(self, TableName):
+        with self.db._lock:
+            self.db.request("DescribeTable", TableName)
+            table = self.db.table(TableName, "DescribeTable")
+            return {"Table": {
+                "TableName": TableName,
+                "ItemCount": len(table.items),
+                "TableSizeBytes": sum(_item_size(item) for item in table.items.values()),
+                "ProvisionedThroughput": {
+                    "ReadCapacityUnits": table.read_capacity,
+                    "WriteCapacityUnits": table.write_capacity
+                }
+            }}
+
+    def scan(self, TableName, ConsistentRead=False, Segment=0, TotalSegments=1, ExclusiveStartKey=None, ReturnConsumedCapacity=None):
+        with self.db._lock:
+            self.db.request("Scan", TableName)
+            table = self.db.table(TableName, "Scan")
+            keys = sorted(table.items.keys())[Segment::TotalSegments]
+            if ExclusiveStartKey:
+                start = tuple(_deserializer.deserialize(ExclusiveStartKey[k]) for k in table.keys)
+                keys = [key for key in keys if key > start]
+            page = [table.items[key] for key in keys[:self.db.PAGE_SIZE]]
+            response = {
+                "Items": [dict((k, _serializer.serialize(v)) for (k, v) in item.items()) for item in page],
+                "ConsumedCapacity": self.db.consumed(TableName, _read_units(page))
+            }
+            if len(keys) > self.db.PAGE_SIZE:
+                response["LastEvaluatedKey"] = dict((k, _serializer.serialize(page[-1][k])) for k in table.keys)
+            return response
+
+class _Body(object):
+    def __init__(self, data):
+        self._data = StringIO.StringIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+class FakeS3(object):
+    """
+    An S3 stand-in keeping objects in memory, objects are dicts of their Body and the other put arguments
+    """
+    def __init__(self):
+        self.objects = {}
+        self.requests = collections.Counter()
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def _count(self, operation):
+        with self._lock:
+            self.requests[operation] += 1
+
+    def put(self, bucket, key, data):
+        """
+        Puts an object without counting a request
+        """
+        self.objects[(bucket, key)] = {"Body": data}
+
+    def get_object(self, Bucket, Key):
+        self._count("GetObject")
+        if (Bucket, Key) not in self.objects:
+            raise client_error("NoSuchKey", "The specified key does not exist.", "GetObject")
+        return {"Body": _Body(self.objects[(Bucket, Key)]["Body"])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._count("PutObject")
+        kwargs["Body"] = Body.read() if hasattr(Body, "read") else Body
+        self.objects[(Bucket, Key)] = kwargs
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._count("CreateMultipartUpload")
+        with self._lock:
+            upload_id = "upload{n}".format(n=len(self._uploads) + 1)
+            self._uploads[upload_id] = (Bucket, Key, kwargs, {})
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self._count("UploadPart")
+        self._uploads[UploadId][3][PartNumber] = Body
+        return {"ETag": "\"{u}-{n}\"".format(u=UploadId, n=PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._count("CompleteMultipartUpload")
+        (bucket, key, kwargs, parts) = self._uploads.pop(UploadId)
+        kwargs = dict(kwargs)
+        kwargs["Body"] = "".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+        self.objects[(Bucket, Key)] = kwargs
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._count("AbortMultipartUpload")
+        self._uploads.pop(UploadId, None)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return "https://{b}.s3.fake/{k}?X-Amz-Expires={e}".format(b=Params["Bucket"], k=Params["Key"], e=ExpiresIn)
+
+class FakeCodePipeline(object):
+    """
+    Records the job results reported to CodePipeline
+    """
+    def __init__(self):
+        self.results = []
+
+    def put_job_success_result(self, jobId):
+        self.results.append((jobId, "success", None))
+
+    def put_job_failure_result(self, jobId, failureDetails):
+        self.results.append((jobId, "failure", failureDetails["message"]))
+
+class FakeSNS(object):
+    """
+    Records the messages published to SNS
+    """
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, TopicArn, Message):
+        self.messages.append((TopicArn, Message))
+
+class FakeAWS(object):
+    """
+    In-process stand-ins for the DynamoDB, S3, CodePipeline and SNS clients used by lambda_function
+
+    They keep their data in memory and need no network or credentials, so the whole pipeline can be run in tests and
+    benchmarks.  Only the operations and expression forms lambda_function uses are supported, and every request is
+    counted.  install puts them in place of the clients in a module like lambda_function.
+    """
+    def __init__(self, throttle_every=None):
+        self.dynamodb = FakeDynamoDB(throttle_every)
+        self.s3 = FakeS3()
+        self.code_pipeline = FakeCodePipeline()
+        self.sns = FakeSNS()
+        self._saved = None
+
+    def install(self, module):
+        """
+        Replaces the clients used by module with the fakes until uninstall is called
+        """
+        self._saved = (module, dict((name, getattr(module, name)) for name in ["ddb", "ddb_c", "code_pipeline", "sns", "get_s3_client"]))
+        module.ddb = self.dynamodb
+        module.ddb_c = self.dynamodb.low_level_client
+        module.code_pipeline = self.code_pipeline
+        module.sns = self.sns
+        module.get_s3_client = lambda creds=None: self.s3
+        return self
+
+    def uninstall(self):
+        """
+        Puts back the clients replaced by install
+        """
+        (module, saved) = self._saved
+        for (name, value) in saved.items():
+            setattr(module, name, value)
+        self._saved = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._saved:
+            self.uninstall()
+        return False
+
+    def request_counts(self):
+        """
+        Gets the number of requests made to each service by operation
+        """
+        counts = collections.Counter()
+        for ((operation, table), count) in self.dynamodb.requests.items():
+            counts["dynamodb." + operation] += count
+        for (operation, count) in self.s3.requests.items():
+            counts["s3." + operation] += count
+        counts["codepipeline.PutJobResult"] = len(self.code_pipeline.results)
+        counts["sns.Publish"] = len(self.sns.messages)
+        return dict(counts)
+
+def make_job_event(job_id, bucket, key, parameters):
+    """
+    Makes a CodePipeline job event for cp_event_handler with the artifact at key in bucket and parameters a dict of
+    UserParameters
+    """
+    return {"CodePipeline.job": {
+        "id": job_id,
+        "data": {
+            "actionConfiguration": {"configuration": {
+                "UserParameters": ",".join("{k}={v}".format(k=k, v=v) for (k, v) in sorted(parameters.items()))
+            }},
+            "artifactCredentials": {"accessKeyId": "fake", "secretAccessKey": "fake", "sessionToken": "fake"},
+            "inputArtifacts": [{"location": {"s3Location": {"bucketName": bucket, "objectKey": key}}}]
+        }
+    }}
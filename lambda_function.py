@@ -1,29 +1,104 @@
-from boto3.session import Session
-import boto3
 import botocore
 import zipfile
 import tempfile
 import shutil
 import os
-import json
 import datetime
-import StringIO
 import sys
+import time
+import random
+import math
+import threading
+import functools
+import itertools
+import hashlib
 import traceback
+import cgi
+import argparse
 from pprint import pprint
+from boto3.dynamodb.types import TypeDeserializer
 from errors import MalformedTableData, ProcessError
 from css import stylesheet
-from decimal_encoder import DecimalEncoder
+import codec
+import compression
+from table_state import TableState
+from workers import run_tasks, RequestSlots
+from rate_limiter import AdaptiveRateLimiter
+from loader import parse_files
+from uploader import MultipartUploader
+from update_expression import UpdateExpressionBuilder
+from metrics import Metrics, OUTPUTS as METRICS_OUTPUTS
+from profiling import Profiler, PROFILES, TOP_N as PROFILE_TOP_N
+from clients import ClientRegistry, client_config, RETRY_MODES, DEFAULT_POOL_CONNECTIONS
 
-boto3.setup_default_session(region_name="ap-southeast-2")
-
-ddb = boto3.resource("dynamodb")
-ddb_c = boto3.client("dynamodb")
-code_pipeline = boto3.client("codepipeline")
-sns = boto3.client("sns")
+# clients are only created when first used and then kept for later invocations
+clients = ClientRegistry()
+# botocore config of the dynamo DB clients, set by configure_ddb_clients
+ddb_client_config = {}
+ddb = clients.lazy("dynamodb", "resource", config = ddb_client_config)
+ddb_c = clients.lazy("dynamodb", config = ddb_client_config)
+# caps the number of dynamo DB requests in flight across worker threads
+ddb_requests = RequestSlots()
+# paces dynamo DB requests to each table
+ddb_rate_limiter = AdaptiveRateLimiter()
+# stage timings and dynamo DB request counters for the current run
+metrics = Metrics()
+code_pipeline = clients.lazy("codepipeline")
+sns = clients.lazy("sns")
 
 DATE_NOW = datetime.datetime.utcnow().isoformat()
 
+# limits and retry settings for DynamoDB batch operations
+BATCH_GET_MAX_KEYS = 100
+BATCH_MAX_RETRIES = 10
+BACKOFF_BASE_SECONDS = 0.05
+BACKOFF_MAX_SECONDS = 5.0
+
+BATCH_WRITE_MAX_ITEMS = 25
+
+# artifacts larger than this are buffered on disk rather than in memory
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+# rate limit modes and the error codes dynamo DB uses when requests are throttled
+RATE_LIMIT_MODES = ["off", "adaptive", "provisioned"]
+THROTTLE_ERRORS = ["ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"]
+
+# default number of worker threads for compares and commits, each has one dynamo DB request in flight at a time so this
+# is also how many reads and writes overlap
+CONCURRENCY = 1
+
+# dynamo DB client settings as (UserParameter, environment variable, client_config argument, parser), a UserParameter
+# overrides the environment variable
+DDB_CLIENT_SETTINGS = [
+	("ddbpool", "DDB_MAX_POOL_CONNECTIONS", "max_pool_connections", int),
+	("ddbretrymode", "DDB_RETRY_MODE", "retry_mode", str),
+	("ddbmaxattempts", "DDB_MAX_ATTEMPTS", "max_attempts", int),
+	("ddbconnecttimeout", "DDB_CONNECT_TIMEOUT", "connect_timeout", float),
+	("ddbreadtimeout", "DDB_READ_TIMEOUT", "read_timeout", float),
+	("ddbkeepalive", "DDB_TCP_KEEPALIVE", "tcp_keepalive", lambda value: value.lower() in ["true", "yes", "1"])
+]
+
+# write modes for commits, batch only batches deletes as creates must stay conditional
+WRITE_MODES = ["item", "batch"]
+
+# compare modes and settings for full table scans
+COMPARE_MODES = ["get", "batch", "scan", "auto"]
+SCAN_SEGMENTS = 4
+# in auto mode a table is scanned when the scan is expected to cost no more read units than this multiple of the record count
+SCAN_COST_RATIO = 1.0
+
+# actions shown in the report index and the default number of rows on each report page
+REPORT_ACTIONS = ["create", "update", "delete", "none"]
+REPORT_PAGE_ROWS = 500
+# tables are compared and then reported or applied in groups of at least this many records (a table is never split),
+# so only one group of tables is held in memory
+GROUP_RECORDS = 100000
+# bytes read at a time from a saved plan
+PLAN_READ_BYTES = 1024 * 1024
+
+# attribute holding the content hash of the record an item was written from
+HASH_FIELD = "_hash"
+
 def mark_cp_job_success(message, job):
 	"""
 	Marks a codepipeline job as successful
@@ -53,38 +128,64 @@ def create_delete_record(key_fields, record):
 		dict.update({key: record[key]})
 	return dict
 		
-def get_nested_key_from_dict(dict, keys):
+def get_pending_records(table):
 	"""
-	Gets a value from a dict under nested keys
+	Gets the records in a table which do not have a compare result yet
 	"""
-	val = dict
-	for key in keys:
-		val = val[key]
-	return val
-		
-def check_for_nested_key_in_dict(in_dict, keys):
+	return [record for record in table.get_records() if "_compare_result" not in record]
+
+def get_record_keys(record, key_fields):
 	"""
-	Checks if dictionary contains keys
+	Gets a dict of just the key fields of a record
 	"""
-	dict = in_dict
-	for key in keys:
-		if key in dict:
-			dict = dict[key]
-		else:
-			return False
-	return True
+	return {k: v for (k, v) in record.iteritems() if k in key_fields}
 
-def add_record_to_dict(dict, keys, record):
+def get_key_tuple(record, key_fields):
 	"""
-	Adds nested keys for a record and then adds data under the keys
+	Gets the values of the key fields of a record as a tuple, in schema order
 	"""
-	if len(keys) > 1:
-		if not keys[0] in dict:
-			dict[keys[0]] = {}
-		add_record_to_dict(dict[keys[0]], keys[1:], record)
+	return tuple(record[k] for k in key_fields)
+
+def get_item_to_write(record):
+	"""
+	Gets a copy of a record without the fields added when comparing and applying it, with its content hash added
+	"""
+	item = {k: v for (k, v) in record.iteritems() if k not in ["_compare_result", "_result"]}
+	item[HASH_FIELD] = get_content_hash(record)
+	return item
+
+def get_managed_content(value, top = True):
+	"""
+	Gets the part of a record which is compared, leaving out DT_CREATED and DT_MODIFIED fields at every level and, at
+	the top level, fields starting with _ and blank fields (which are removed from the item)
+	"""
+	if isinstance(value, dict):
+		return {k: get_managed_content(v, False) for (k, v) in value.iteritems()
+			if k.upper() not in ["DT_CREATED", "DT_MODIFIED"] and not (top and (k[0:1] == "_" or v == ""))}
+	elif isinstance(value, list):
+		return [get_managed_content(v, False) for v in value]
 	else:
-		dict[keys[0]] = record
+		return value
+
+def get_content_hash(record):
+	"""
+	Gets the SHA-256 hash of the canonical JSON of the managed content of a record, Decimals are hashed with their
+	exact digits
 	
+	This is stored on items under HASH_FIELD when they are written.  An item whose hash matches a record was last
+	written from a record with the same content, so it does not need to be compared.
+	"""
+	return hashlib.sha256(codec.canonical_dumps(get_managed_content(record))).hexdigest()
+
+def get_item_version(item):
+	"""
+	Gets the _meta and content hash of an item in dynamo, which change whenever this tool writes it, or None when there
+	is no item
+	"""
+	if item is None:
+		return None
+	return {field: item.get(field) for field in ["_meta", HASH_FIELD]}
+
 def add_meta_data_to_record(record, file, action):
 	"""
 	Adds _meta field to record
@@ -135,109 +236,365 @@ def expand_special_values(d):
 			# not a special value
 			return d
 		
-def validate_and_process(input):
+def validate_table(table, files):
 	"""
-	Takes raw data and validates and processes for updates to dynamodb
+	Validates and processes the files for one table, given as (file name, parsed json) pairs in file name order
+	
+	Returns a TableState, or None when the table has no files
 	"""
-	tables = {}
-	for table in input:
-		table_name = ""
-		table_keys = []
-		raw_data = input[table]
-		keys = sorted(raw_data.keys())
-		if len(keys) >= 1:
-			# check we have a schema and it is valid
-			if keys[0] == "000_schema.json":
-				schema = raw_data[keys[0]]
-				# get table name and keys from record
-				if "table" in schema and "keys" in schema:
-					table_name = schema["table"]
-					table_keys = schema["keys"]
-					if len(table_keys) == 0:
-						raise MalformedTableData("Keys attribute in schema is length 0 for table {tn}, expecting at least one element".format(tn=table))
+	table_name = ""
+	table_keys = []
+	files = iter(files)
+	first = next(files, None)
+	if first is None:
+		return None
+	# check we have a schema and it is valid
+	if first[0] == "000_schema.json":
+		schema = first[1]
+		# get table name and keys from record
+		if "table" in schema and "keys" in schema:
+			table_name = schema["table"]
+			table_keys = schema["keys"]
+			if len(table_keys) == 0:
+				raise MalformedTableData("Keys attribute in schema is length 0 for table {tn}, expecting at least one element".format(tn=table))
+		else:
+			# schema file is incomplete
+			raise MalformedTableData("Schema file for {tn} does not contain table name or keys attribute".format(tn=table))
+	else:
+		# first element is not a schema definition
+		raise MalformedTableData("000_schema.json is missing for this table: {tn}".format(tn=table))
+	
+	# init empty table
+	state = TableState({
+		"table": table_name,
+		"keys": table_keys
+	})
+	
+	# loop through data records
+	for (key, record) in files:
+		if "action" in record and "data" in record:
+			# check keys are specified in data
+			if not all(key in record["data"] for key in table_keys):
+				raise MalformedTableData("One or more key fields are missing in record file {rec} for table {tn}".format(rec=key, tn=table))
+			key_values = state.key_of(record["data"])
+			if record["action"] == "create":
+				# this is a create
+				# must be the first time the key is seen
+				if key_values in state:
+					raise MalformedTableData("Check record file {rec} for table {tn} as action is 'create' but keys have been seen before".format(rec=key, tn=table))
 				else:
-					# schema file is incomplete
-					raise MalformedTableData("Schema file for {tn} does not contain table name or keys attribute".format(tn=table))
-			else:
-				# first element is not a schema definition
-				raise MalformedTableData("000_schema.json is missing for this table: {tn}".format(tn=table))
-			
-			# init empty table
-			tables[table_name] = {}
-			tables[table_name]["_schema"] = {
-				"table": table_name,
-				"keys": table_keys
-			}
-			
-			# loop through data records
-			for key in keys[1:]:
-				record = raw_data[key]
-				if "action" in record and "data" in record:
-					# check keys are specified in data
-					if not all(key in record["data"] for key in table_keys):
-						raise MalformedTableData("One or more key fields are missing in record file {rec} for table {tn}".format(rec=key, tn=table))
-					key_values = []
-					for k in table_keys:
-						key_values.append(record["data"][k])
-					if record["action"] == "create":
-						# this is a create
-						# must be the first time the key is seen
-						if check_for_nested_key_in_dict(tables[table_name], key_values):
-							raise MalformedTableData("Check record file {rec} for table {tn} as action is 'create' but keys have been seen before".format(rec=key, tn=table))
-						else:
-							data = record["data"]
-							add_meta_data_to_record(record = data, file = key, action = record["action"])
-							add_record_to_dict(tables[table_name], key_values, data)
-					elif record["action"] == "update":
-						# this is an update
-						# must have seen the key before
-						if check_for_nested_key_in_dict(tables[table_name], key_values):
-							old_data = get_nested_key_from_dict(dict = tables[table_name], keys = key_values)
-							# make sure this combination of keys has not been deleted before
-							if old_data["_meta"]["action"] == "delete":
-								raise MalformedTableData("Check record file {rec} for table {tn} as action is update but record has previously been deleted".format(rec=key, tn=table))
-							new_data = record["data"]
-							add_meta_data_to_record(record = new_data, file = key, action = record["action"])
-							update_record_values(old = old_data, new = new_data, key_fields = table_keys)
-						else:
-							raise MalformedTableData("Check record file {rec} for table {tn} as action is 'update' but keys have not been seen before".format(rec=key, tn=table))
-					elif record["action"] == "delete":
-						# this is a delete
-						# must have seen the key before
-						if check_for_nested_key_in_dict(tables[table_name], key_values):
-							data = get_nested_key_from_dict(dict = tables[table_name], keys = key_values)
-							delete_record = create_delete_record(key_fields = table_keys, record = data)
-							add_meta_data_to_record(record = delete_record, file = key, action = record["action"])
-							add_record_to_dict(tables[table_name], key_values, delete_record)
-						else:
-							raise MalformedTableData("Check record file {rec} for table {tn} as action is 'delete' but keys have not been seen before".format(rec=key, tn=table))
-					else:
-						raise MalformedTableData("Action value is unknown in record file {rec} for table {tn}".format(rec=key, tn=table))
+					data = record["data"]
+					add_meta_data_to_record(record = data, file = key, action = record["action"])
+					state.put(data)
+					state.add_file(key_values, key)
+			elif record["action"] == "update":
+				# this is an update
+				# must have seen the key before
+				if key_values in state:
+					old_data = state.get(key_values)
+					# make sure this combination of keys has not been deleted before
+					if old_data["_meta"]["action"] == "delete":
+						raise MalformedTableData("Check record file {rec} for table {tn} as action is update but record has previously been deleted".format(rec=key, tn=table))
+					new_data = record["data"]
+					add_meta_data_to_record(record = new_data, file = key, action = record["action"])
+					update_record_values(old = old_data, new = new_data, key_fields = table_keys)
+					state.add_file(key_values, key)
+				else:
+					raise MalformedTableData("Check record file {rec} for table {tn} as action is 'update' but keys have not been seen before".format(rec=key, tn=table))
+			elif record["action"] == "delete":
+				# this is a delete
+				# must have seen the key before
+				if key_values in state:
+					data = state.get(key_values)
+					delete_record = create_delete_record(key_fields = table_keys, record = data)
+					add_meta_data_to_record(record = delete_record, file = key, action = record["action"])
+					state.put(delete_record)
+					state.add_file(key_values, key)
 				else:
-					raise MalformedTableData("Record file {rec} for table {tn} does not contain action and data attribute".format(rec=key, tn=table))
-	tables = expand_special_values(tables)
-	return tables
+					raise MalformedTableData("Check record file {rec} for table {tn} as action is 'delete' but keys have not been seen before".format(rec=key, tn=table))
+			else:
+				raise MalformedTableData("Action value is unknown in record file {rec} for table {tn}".format(rec=key, tn=table))
+		else:
+			raise MalformedTableData("Record file {rec} for table {tn} does not contain action and data attribute".format(rec=key, tn=table))
+	
+	for record in state.get_records():
+		expand_special_values(record)
+	return state
+
+def iter_validated_tables(entries):
+	"""
+	Validates and processes a stream of (table, file name, parsed json) entries ordered by table and then file name
+	
+	Yields (table name, TableState) for each table as soon as all of its files have been read
+	"""
+	for (table, files) in itertools.groupby(entries, key = lambda entry: entry[0]):
+		state = validate_table(table, ((file, data) for (t, file, data) in files))
+		if state is not None:
+			yield (state.schema["table"], state)
+
+def iter_raw_files(input):
+	"""
+	Yields (table, file name, parsed json) entries from raw data, ordered by table and then file name
+	"""
+	for table in sorted(input.keys()):
+		for file in sorted(input[table].keys()):
+			yield (table, file, input[table][file])
+
+def validate_and_process(input):
+	"""
+	Takes raw data and validates and processes for updates to dynamodb
+	
+	Returns a dict of TableState keyed by table name
+	"""
+	return dict(iter_validated_tables(iter_raw_files(input)))
+
+def get_ddb_item_client():
+	"""
+	Gets the client used for item reads and writes
+	
+	This is the client behind a dynamo DB resource so it takes and returns python types like the resource does, but
+	unlike the resource it can be shared between threads
+	"""
+	return ddb.meta.client
+
+def get_ddb_client_settings(parameters, workers):
+	"""
+	Gets the dynamo DB client settings from parameters and the environment
+	
+	Unless it is set the connection pool is made big enough for workers requests to be in flight at once, so requests
+	do not queue for connections.  Other settings are left to botocore unless they are set.
+	"""
+	settings = {"max_pool_connections": max(DEFAULT_POOL_CONNECTIONS, workers)}
+	for (parameter, variable, setting, parse) in DDB_CLIENT_SETTINGS:
+		value = parameters.get(parameter, os.environ.get(variable))
+		if value is not None and value != "":
+			try:
+				settings[setting] = parse(value)
+			except ValueError:
+				raise ProcessError("{p} value {v} is not valid for {s}".format(p = parameter, v = value, s = setting))
+	if settings.get("retry_mode") not in [None] + RETRY_MODES:
+		raise ProcessError("Retry mode {m} is not valid, expecting one of {modes}".format(m = settings["retry_mode"], modes = ", ".join(RETRY_MODES)))
+	return settings
+
+def configure_ddb_clients(settings):
+	"""
+	Sets the botocore config of the shared dynamo DB clients
+	
+	Settings the installed botocore does not support are left out and logged
+	"""
+	(config, unsupported) = client_config(**settings)
+	if unsupported:
+		print "This version of botocore does not support {s}, using its defaults instead".format(s = ", ".join(unsupported))
+	ddb_client_config.clear()
+	ddb_client_config.update(config)
+
+def backoff_sleep(attempt):
+	"""
+	Sleeps for a jittered exponential backoff period based on the attempt number
+	"""
+	delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+	time.sleep(random.uniform(0, delay))
+
+def get_consumed_units(response, table_name):
+	"""
+	Gets the capacity units a request consumed on table_name from the ConsumedCapacity in its response
+	"""
+	consumed = response.get("ConsumedCapacity", [])
+	if isinstance(consumed, dict):
+		consumed = [consumed]
+	return sum([c.get("CapacityUnits", 0) for c in consumed if c.get("TableName") == table_name])
+
+def ddb_call(operation, table_name, kind, units, **kwargs):
+	"""
+	Makes a dynamo DB request to table_name paced by the rate limiter
+	
+	kind is read or write and units is the capacity the request is expected to consume.  The limiter is told what the
+	request really consumed and whether it was throttled, throttled requests are retried with backoff.
+	
+	Returns the response
+	"""
+	attempt = 0
+	while True:
+		ddb_rate_limiter.acquire(table_name, kind, units)
+		start = time.time()
+		try:
+			with ddb_requests:
+				response = operation(ReturnConsumedCapacity = "TOTAL", **kwargs)
+		except botocore.exceptions.ClientError as e:
+			metrics.add(table_name, "requests")
+			metrics.add(table_name, "request_seconds", time.time() - start)
+			if e.response["Error"]["Code"] not in THROTTLE_ERRORS or attempt >= BATCH_MAX_RETRIES:
+				raise
+			ddb_rate_limiter.consumed(table_name, kind, units, 0)
+			ddb_rate_limiter.throttled(table_name, kind)
+			metrics.add(table_name, "throttles")
+			metrics.add(table_name, "retries")
+			backoff_sleep(attempt)
+			attempt += 1
+			continue
+		consumed = get_consumed_units(response, table_name)
+		metrics.add(table_name, "requests")
+		metrics.add(table_name, "request_seconds", time.time() - start)
+		metrics.add(table_name, "consumed_" + kind, float(consumed))
+		# botocore retries throttled requests itself before returning them
+		retries = response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+		if retries > 0:
+			ddb_rate_limiter.throttled(table_name, kind)
+			metrics.add(table_name, "throttles")
+			metrics.add(table_name, "retries", retries)
+		ddb_rate_limiter.consumed(table_name, kind, units, consumed)
+		return response
+
+def get_provisioned_capacity(table_name, kind):
+	"""
+	Gets the provisioned read or write capacity of table_name, this is 0 for on demand tables
+	"""
+	throughput = ddb_describe_table(table_name).get("ProvisionedThroughput", {})
+	if kind == "read":
+		return throughput.get("ReadCapacityUnits", 0)
+	else:
+		return throughput.get("WriteCapacityUnits", 0)
+
+def configure_rate_limit(mode):
+	"""
+	Sets how the rate limiter paces requests to each table
+	
+	off does not pace requests, adaptive starts unlimited and slows down when requests are throttled and provisioned
+	also starts at and never goes above the provisioned capacity of the table
+	"""
+	if mode not in RATE_LIMIT_MODES:
+		raise ProcessError("Rate limit mode {m} is not valid, expecting one of {modes}".format(m = mode, modes = ", ".join(RATE_LIMIT_MODES)))
+	ddb_rate_limiter.configure(
+		enabled = mode != "off",
+		capacity_lookup = get_provisioned_capacity if mode == "provisioned" else None
+	)
 
 def ddb_get_item_consistent(keys, table_name):
 	"""
 	Performs a consistent read on table_name for keys
 	"""
-	table = ddb.Table(table_name)
-	item = table.get_item(
+	item = ddb_call(get_ddb_item_client().get_item, table_name, "read", 1,
+		TableName = table_name,
 		Key = keys,
 		ConsistentRead = True
 	)
 	if "Item" in item:
+		metrics.add(table_name, "items_read")
 		return item["Item"]
 	else:
 		return None
 
+def ddb_batch_get_items_consistent(keys, table_name, attributes = None):
+	"""
+	Performs consistent batch reads on table_name for a list of keys
+	
+	Keys are requested in chunks of BATCH_GET_MAX_KEYS and unprocessed keys are retried with backoff.  When a list of
+	attributes is given only those attributes are returned.
+	
+	Returns a list of the items which were found
+	"""
+	items = []
+	for i in range(0, len(keys), BATCH_GET_MAX_KEYS):
+		request = {
+			table_name: {
+				"Keys": keys[i:i + BATCH_GET_MAX_KEYS],
+				"ConsistentRead": True
+			}
+		}
+		if attributes:
+			names = {"#p{n}".format(n=n): attribute for (n, attribute) in enumerate(attributes)}
+			request[table_name].update({
+				"ProjectionExpression": ", ".join(sorted(names.keys())),
+				"ExpressionAttributeNames": names
+			})
+		attempt = 0
+		while request:
+			response = ddb_call(get_ddb_item_client().batch_get_item, table_name, "read", len(request[table_name]["Keys"]),
+				RequestItems = request
+			)
+			items.extend(response["Responses"].get(table_name, []))
+			metrics.add(table_name, "items_read", len(response["Responses"].get(table_name, [])))
+			request = response.get("UnprocessedKeys")
+			if request:
+				ddb_rate_limiter.throttled(table_name, "read")
+				metrics.add(table_name, "throttles")
+				metrics.add(table_name, "retries")
+				if attempt >= BATCH_MAX_RETRIES:
+					raise ProcessError("Gave up reading from {tn} after {n} attempts with unprocessed keys".format(tn=table_name, n=attempt + 1))
+				backoff_sleep(attempt)
+				attempt += 1
+	return items
+
+def ddb_describe_table(table_name):
+	"""
+	Gets the description of table_name
+	"""
+	metrics.add(table_name, "requests")
+	with ddb_requests:
+		return ddb_c.describe_table(
+			TableName = table_name
+		)["Table"]
+
+def ddb_scan_segment(table_name, segment, total_segments):
+	"""
+	Performs a consistent scan of one segment of table_name
+	
+	Returns a list of the items in the segment
+	"""
+	deserializer = TypeDeserializer()
+	items = []
+	request = {
+		"TableName": table_name,
+		"ConsistentRead": True,
+		"Segment": segment,
+		"TotalSegments": total_segments
+	}
+	while True:
+		# the size of a page is not known up front, the limiter is told what it really cost afterwards
+		page = ddb_call(ddb_c.scan, table_name, "read", 1, **request)
+		for item in page["Items"]:
+			items.append({k: deserializer.deserialize(v) for (k, v) in item.iteritems()})
+		metrics.add(table_name, "items_read", len(page["Items"]))
+		if "LastEvaluatedKey" not in page:
+			return items
+		request["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+def ddb_scan_table_snapshot(table_name, key_fields, segments):
+	"""
+	Scans the whole of table_name using parallel segments
+	
+	Returns a dict of the items in the table keyed by the tuple of their key values
+	"""
+	results = [[] for segment in range(segments)]
+	errors = []
+	def scan(segment):
+		try:
+			results[segment] = ddb_scan_segment(
+				table_name = table_name,
+				segment = segment,
+				total_segments = segments
+			)
+		except:
+			errors.append(sys.exc_info())
+	threads = [threading.Thread(target = scan, args = (segment,)) for segment in range(segments)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+	snapshot = {}
+	for items in results:
+		for item in items:
+			snapshot[get_key_tuple(item, key_fields)] = item
+	return snapshot
+
 def ddb_create_item(keys, data, table_name):
 	"""
 	Writes data to table_name 
 	"""
-	table = ddb.Table(table_name)
-	data_to_write = {k :v for (k, v) in data.iteritems() if k != "_compare_result"}
+	client = get_ddb_item_client()
+	data_to_write = get_item_to_write(data)
 	condition_expression = ""
 	key_count = 0
 	for key in keys:
@@ -246,101 +603,170 @@ def ddb_create_item(keys, data, table_name):
 		else:
 			condition_expression += " AND attribute_not_exists({key})".format(key=key)
 	try:
-		table.put_item(
+		ddb_call(client.put_item, table_name, "write", 1,
+			TableName=table_name,
 			ConditionExpression=condition_expression,
 			Item=data_to_write
 		)
+		metrics.add(table_name, "items_written")
 		return True
-	except ddb_c.exceptions.ConditionalCheckFailedException:
+	except client.exceptions.ConditionalCheckFailedException:
 		traceback.print_tb(sys.exc_info()[2])
 		return False
 
+def ddb_batch_write_items(requests, table_name):
+	"""
+	Performs batch writes of a list of put and delete requests to table_name
+	
+	Requests are sent in chunks of BATCH_WRITE_MAX_ITEMS and unprocessed items are retried with jittered backoff
+	"""
+	for i in range(0, len(requests), BATCH_WRITE_MAX_ITEMS):
+		request = {
+			table_name: requests[i:i + BATCH_WRITE_MAX_ITEMS]
+		}
+		attempt = 0
+		while request:
+			response = ddb_call(get_ddb_item_client().batch_write_item, table_name, "write", len(request[table_name]),
+				RequestItems = request
+			)
+			sent = len(request[table_name])
+			request = response.get("UnprocessedItems")
+			metrics.add(table_name, "items_written", sent - len(request.get(table_name, [])) if request else sent)
+			if request:
+				ddb_rate_limiter.throttled(table_name, "write")
+				metrics.add(table_name, "throttles")
+				metrics.add(table_name, "retries")
+				if attempt >= BATCH_MAX_RETRIES:
+					raise ProcessError("Gave up writing to {tn} after {n} attempts with unprocessed items".format(tn=table_name, n=attempt + 1))
+				backoff_sleep(attempt)
+				attempt += 1
+
 def ddb_delete_item(keys, table_name):
 	"""
 	Deletes an item from table_name using keys
 	"""
-	table = ddb.Table(table_name)
-	table.delete_item(
+	ddb_call(get_ddb_item_client().delete_item, table_name, "write", 1,
+		TableName = table_name,
 		Key = keys
 	)
+	metrics.add(table_name, "items_written")
 
-def ddb_update_item(keys, delta, meta, table_name):
+def get_delta_update(delta, meta, content_hash = None):
+	"""
+	Compiles a compare delta into the UpdateExpression and attribute names and values which apply it and set meta,
+	and the content hash if there is one
+	"""
+	update = UpdateExpressionBuilder()
+	for k in sorted(delta["new"]):
+		update.set((k,), delta["new"][k])
+	for k in sorted(delta["changed"]):
+		if "edits" in delta["changed"][k]:
+			for edit in delta["changed"][k]["edits"]:
+				if edit["op"] == "removed":
+					update.remove((k,) + tuple(edit["path"]))
+				else:
+					update.set((k,) + tuple(edit["path"]), edit["new"])
+		else:
+			update.set((k,), delta["changed"][k]["new"])
+	for k in sorted(delta["removed"]):
+		update.remove((k,))
+	update.set(("_meta",), meta)
+	if content_hash:
+		update.set((HASH_FIELD,), content_hash)
+	return update.build()
+
+def ddb_update_item(keys, delta, meta, table_name, content_hash = None):
 	"""
 	Updates record with keys in table_name using delta
 	"""
-	table = ddb.Table(table_name)
-	update_map = {}
-	for k in delta["new"]:
-		update_map.update({
-			k: {
-				"Value": delta["new"][k],
-				"Action": "PUT"
-			}
-		})
-	for k in delta["changed"]:
-		update_map.update({
-			k: {
-				"Value": delta["changed"][k]["new"],
-				"Action": "PUT"
-			}
-		})
-	for k in delta["removed"]:
-		update_map.update({
-			k: {
-				"Action": "DELETE"
-			}
-		})
-	update_map.update({
-		"_meta": {
-			"Value": meta,
-			"Action": "PUT"
-		}
-	})
-	table.update_item(
+	ddb_call(get_ddb_item_client().update_item, table_name, "write", 1,
+		TableName = table_name,
 		Key = keys,
-		AttributeUpdates = update_map
+		**get_delta_update(delta, meta, content_hash)
 	)
+	metrics.add(table_name, "items_written")
 
-def deep_field_compare(new, current):
+def ddb_set_content_hash(keys, content_hash, table_name):
 	"""
-	Checks if the field meets the rules to be different
+	Stores the content hash on the item with keys in table_name without changing anything else
+	"""
+	ddb_call(get_ddb_item_client().update_item, table_name, "write", 1,
+		TableName = table_name,
+		Key = keys,
+		**UpdateExpressionBuilder().set((HASH_FIELD,), content_hash).build()
+	)
+	metrics.add(table_name, "items_written")
+
+def diff_field(new, current, path = ()):
+	"""
+	Finds the smallest changes which turn the current value of a field into the new value
 	
-	Returns true when the same, false when different
+	Returns a list of edits, each a dict with the path (a list of map keys and list indexes relative to the field), the
+	op ("added", "removed" or "changed") and the current and/or new value at that path.  An empty list means the
+	values are the same.
 	
-	Ignores dict changes if the only changes are the DT_CREATED and DT_MODIFIED fields
+	Maps are compared key by key and lists index by index.  Changes to a map are ignored if the only changes are to its
+	DT_CREATED and DT_MODIFIED fields.
 	"""
-	if isinstance(new, dict):
-		# check keys for difference
+	if isinstance(new, dict) and isinstance(current, dict):
+		edits = []
 		different_fields = []
 		for key in new:
 			if key in current:
 				# this is an existing field
-				if not deep_field_compare(new[key], current[key]):
+				key_edits = diff_field(new[key], current[key], path + (key,))
+				if key_edits:
 					# which has changed
 					different_fields.append(key)
+					edits += key_edits
 			else:
 				# this is a new field
 				different_fields.append(key)
+				edits.append({"path": list(path + (key,)), "op": "added", "new": new[key]})
 		for key in [key for key in current if key not in new]:
 			# this is a removed field
 			different_fields.append(key)
-		different_fields = list(map(lambda x: x.upper(), different_fields))
-		if not set(different_fields).issubset(set(["DT_CREATED", "DT_MODIFIED"])):
-			return False
-		else:
-			return True
-	elif isinstance(new, list):
-		# check list elements for difference
-		different = True
-		if len(new) == len(current):
-			for i in range(0, len(new)):
-				if not deep_field_compare(new[i], current[i]):
-					different = False
-			return different
-		else:
-			return False
+			edits.append({"path": list(path + (key,)), "op": "removed", "current": current[key]})
+		if set(key.upper() for key in different_fields).issubset(set(["DT_CREATED", "DT_MODIFIED"])):
+			return []
+		return edits
+	elif isinstance(new, list) and isinstance(current, list):
+		edits = []
+		for i in range(0, min(len(new), len(current))):
+			edits += diff_field(new[i], current[i], path + (i,))
+		for i in range(len(current), len(new)):
+			# elements added to the end
+			edits.append({"path": list(path + (i,)), "op": "added", "new": new[i]})
+		for i in range(len(new), len(current)):
+			# elements removed from the end
+			edits.append({"path": list(path + (i,)), "op": "removed", "current": current[i]})
+		return edits
+	elif new == current:
+		return []
 	else:
-		return new == current
+		return [{"path": list(path), "op": "changed", "current": current, "new": new}]
+
+def deep_field_compare(new, current):
+	"""
+	Checks if the field meets the rules to be different
+	
+	Returns true when the same, false when different
+	
+	Ignores dict changes if the only changes are the DT_CREATED and DT_MODIFIED fields
+	"""
+	return len(diff_field(new, current)) == 0
+
+def format_field_path(path):
+	"""
+	Formats a path of map keys and list indexes like a dynamo DB document path, e.g. address.lines[0]
+	"""
+	text = ""
+	for element in path:
+		if isinstance(element, basestring):
+			text += ("." if text else "") + element
+		else:
+			text += "[{i:d}]".format(i=element)
+	return text
 	
 def compare_single_record(new, current, key_fields):
 	"""
@@ -348,6 +774,9 @@ def compare_single_record(new, current, key_fields):
 	
 	Returns a dict with keys "new", "changed" and "removed"
 	
+	A changed field has its "current" and "new" values, or when both values are maps or lists, the "edits" found by
+	diff_field so that only the parts which changed are reported and written.
+	
 	Ignores changes to fields named dt_created (special field for creation date) and dt_modified if no other fields have changed
 	"""
 	new_attributes = {}
@@ -364,8 +793,15 @@ def compare_single_record(new, current, key_fields):
 			else:
 				if new_key.upper() != "DT_CREATED":
 					# need to do a deep compare of these objects to avoid DT changes
-					if not deep_field_compare(new[new_key], current[new_key]):
-					#if current[new_key] != new[new_key]:
+					edits = diff_field(new[new_key], current[new_key])
+					if edits and edits[0]["path"]:
+						# only parts of a map or list have changed
+						changed_attributes.update({
+							new_key: {
+								"edits": edits
+							}
+						})
+					elif edits:
 						changed_attributes.update({
 							new_key: {
 								"current": current[new_key],
@@ -387,9 +823,18 @@ def compare_single_record(new, current, key_fields):
 		"removed": removed_attributes
 	}
 	
-def create_change_report_entries(data, schema):
+def iter_report_value(value):
+	"""
+	Yields the table cell for a field value, lists and dicts are shown as indented JSON
 	"""
-	Creates the table rows for a given change entry
+	if isinstance(value, (list, dict)):
+		yield "<td><pre>{val}</pre></td>".format(val=codec.dumps(value, indent=2, sort_keys=True))
+	else:
+		yield "<td>{val}</td>".format(val=value)
+
+def iter_change_report_entry(data, schema):
+	"""
+	Yields the HTML fragments of the table row for a record with a compare result
 	
 	Each row has the following data:
 	 - ID columns
@@ -398,331 +843,1041 @@ def create_change_report_entries(data, schema):
 	 - state of current row in ddb
 	 - data to be created/updated
 	"""
-	if "_compare_result" in data:
-		html = "<tr>"
-		for key_field in schema["keys"]:
-			html += "<td>{col}</td>".format(col=data[key_field])
-		html += "<td><p class=\"label {action}\">{action}</p></td>".format(action=data["_meta"]["action"])
-		html += "<td><p class=\"label {action}\">{action}</p></td>".format(action=data["_compare_result"]["action"])
-		html += "<td><p class=\"label\">{reason}</p></td>".format(reason=data["_compare_result"]["state"])
-		if data["_compare_result"]["action"] == "create":
-			# need to show all the fields
-			sub_table = "<table class=\"ResultsTable\">"
-			sub_table += "<tr><th>Field</th><th>Value</th></tr>"
-			for k in [key for key in data.keys() if key[0:1] != "_"]:
-				sub_table += "<tr><td>{col}</td>".format(col = k)
-				if isinstance(data[k], (list, dict)):
-					sub_table += "<td><pre>{val}</pre></td>".format(val=json.dumps(data[k], indent=2, sort_keys=True, cls=DecimalEncoder))
+	yield "<tr>"
+	for key_field in schema["keys"]:
+		yield "<td>{col}</td>".format(col=data[key_field])
+	yield "<td><p class=\"label {action}\">{action}</p></td>".format(action=data["_meta"]["action"])
+	yield "<td><p class=\"label {action}\">{action}</p></td>".format(action=data["_compare_result"]["action"])
+	yield "<td><p class=\"label\">{reason}</p></td>".format(reason=data["_compare_result"]["state"])
+	if data["_compare_result"]["action"] == "create":
+		# need to show all the fields
+		yield "<td><table class=\"ResultsTable\">"
+		yield "<tr><th>Field</th><th>Value</th></tr>"
+		for k in [key for key in data.keys() if key[0:1] != "_"]:
+			yield "<tr><td>{col}</td>".format(col = k)
+			for fragment in iter_report_value(data[k]):
+				yield fragment
+			yield "</tr>"
+		yield "</table></td>"
+	elif data["_compare_result"]["action"] == "update":
+		# need to show changed fields
+		delta = data["_compare_result"]["delta"]
+		yield "<td class=\"row_data\">"
+		# new fields
+		if len(delta["new"]) == 0:
+			yield "<p>No new fields</p>"
+		else:
+			yield "<p>New Fields</p><table class=\"ResultsTable\">"
+			yield "<tr><th>Field</th><th>Value</th></tr>"
+			for k in delta["new"]:
+				yield "<tr><td>{col}</td>".format(col = k)
+				for fragment in iter_report_value(delta["new"][k]):
+					yield fragment
+				yield "</tr>"
+			yield "</table>"
+		# changed fields
+		if len(delta["changed"]) == 0:
+			yield "<p>No changed fields</p>"
+		else:
+			yield "<p>Changed Fields</p><table class=\"ResultsTable\">"
+			yield "<tr><th>Field</th><th>Current Value</th><th>New Value</th></tr>"
+			for k in delta["changed"]:
+				if "edits" in delta["changed"][k]:
+					# show just the parts of the field which have changed
+					for edit in delta["changed"][k]["edits"]:
+						yield "<tr><td>{col}</td>".format(col = format_field_path([k] + edit["path"]))
+						for side in ["current", "new"]:
+							if side in edit:
+								for fragment in iter_report_value(edit[side]):
+									yield fragment
+							else:
+								yield "<td>n/a</td>"
+						yield "</tr>"
 				else:
-					sub_table += "<td>{val}</td>".format(val=data[k])
-				sub_table += "</tr>"
-			sub_table += "</table>"
-			html += "<td>{sub}</td>".format(sub = sub_table)
-		elif data["_compare_result"]["action"] == "update":
-			# need to show changed fields
-			html += "<td class=\"row_data\">"
-			# new fields
-			if len(data["_compare_result"]["delta"]["new"]) == 0:
-				html += "<p>No new fields</p>"
-			else:
-				sub_table = "<p>New Fields</p><table class=\"ResultsTable\">"
-				sub_table += "<tr><th>Field</th><th>Value</th></tr>"
-				for k in data["_compare_result"]["delta"]["new"]:
-					sub_table += "<tr><td>{col}</td>".format(col = k)
-					if isinstance(data["_compare_result"]["delta"]["new"][k], (list, dict)):
-						sub_table += "<td><pre>{val}</pre></td>".format(val=json.dumps(data["_compare_result"]["delta"]["new"][k], indent=2, sort_keys=True, cls=DecimalEncoder))
-					else:
-						sub_table += "<td>{val}</td>".format(val=data["_compare_result"]["delta"]["new"][k])
-					sub_table += "</tr>"
-				sub_table += "</table>"
-				html += sub_table
-			# changed fields
-			if len(data["_compare_result"]["delta"]["changed"]) == 0:
-				html += "<p>No changed fields</p>"
-			else:
-				sub_table = "<p>Changed Fields</p><table class=\"ResultsTable\">"
-				sub_table += "<tr><th>Field</th><th>Current Value</th><th>New Value</th></tr>"
-				for k in data["_compare_result"]["delta"]["changed"]:
-					sub_table += "<tr><td>{col}</td>".format(col = k)
-					if isinstance(data["_compare_result"]["delta"]["changed"][k]["current"], (list, dict)):
-						sub_table += "<td><pre>{val}</pre></td>".format(val=json.dumps(data["_compare_result"]["delta"]["changed"][k]["current"], indent=2, sort_keys=True, cls=DecimalEncoder))
-					else:
-						sub_table += "<td>{val}</td>".format(val=data["_compare_result"]["delta"]["changed"][k]["current"])
-					if isinstance(data["_compare_result"]["delta"]["changed"][k]["new"], (list, dict)):
-						sub_table += "<td><pre>{val}</pre></td>".format(val=json.dumps(data["_compare_result"]["delta"]["changed"][k]["new"], indent=2, sort_keys=True, cls=DecimalEncoder))
-					else:
-						sub_table += "<td>{val}</td>".format(val=data["_compare_result"]["delta"]["changed"][k]["new"])
-					sub_table += "</tr>"
-				sub_table += "</table>"
-				html += sub_table
-			# removed fields
-			if len(data["_compare_result"]["delta"]["removed"]) == 0:
-				html += "<p>No removed fields</p>"
-			else:
-				html += "<p>Removed Fields</p>"
-				html += "<ul>"
-				for k in data["_compare_result"]["delta"]["removed"]:
-					html += "<li>{field}</li>".format(field=k)
-				html += "</ul>"
-			html += "</td>"
-		elif data["_compare_result"]["action"] == "delete":
-			# need to show no fields
-			html += "<td>n/a</td>"
-		elif data["_compare_result"]["action"] == "none":
-			# need to show no fields
-			html += "<td>n/a</td>"
-		html += "</tr>"
-		return [html]
-	else:
-		entries = []
-		for k in [key for key in data.keys() if str(key)[0:1] != "_"]:
-			entries = entries + create_change_report_entries(
-				data = data[k],
-				schema = schema
-			)
-		return entries
+					yield "<tr><td>{col}</td>".format(col = k)
+					for fragment in iter_report_value(delta["changed"][k]["current"]):
+						yield fragment
+					for fragment in iter_report_value(delta["changed"][k]["new"]):
+						yield fragment
+					yield "</tr>"
+			yield "</table>"
+		# removed fields
+		if len(delta["removed"]) == 0:
+			yield "<p>No removed fields</p>"
+		else:
+			yield "<p>Removed Fields</p>"
+			yield "<ul>"
+			for k in delta["removed"]:
+				yield "<li>{field}</li>".format(field=k)
+			yield "</ul>"
+		yield "</td>"
+	elif data["_compare_result"]["action"] == "delete":
+		# need to show no fields
+		yield "<td>n/a</td>"
+	elif data["_compare_result"]["action"] == "none":
+		# need to show no fields
+		yield "<td>n/a</td>"
+	yield "</tr>"
+
+def create_change_report_entry(data, schema):
+	"""
+	Creates the table row for a record with a compare result
+	"""
+	return "".join(iter_change_report_entry(data, schema))
 	
-def create_change_report(data, env_prefix):
+def iter_unmanaged_report_entries(items, schema):
 	"""
-	Writes a HTML report showing the changes that will be made
+	Yields the HTML fragments of the table rows for items which are in dynamo but not in the reference data
+	"""
+	for item in items:
+		yield "<tr>"
+		for key_field in schema["keys"]:
+			yield "<td>{col}</td>".format(col=item[key_field])
+		yield "<td><pre>{val}</pre></td>".format(val=codec.dumps({k: v for (k, v) in item.iteritems() if k not in schema["keys"]}, indent=2, sort_keys=True))
+		yield "</tr>"
+
+def create_unmanaged_report_entries(items, schema):
 	"""
-	html = "<html><head><title>Delta Report</title><style>{style}</style></head><body>".format(style=stylesheet)
-	html += "<h1>DynamoDB Ref Data delta report</h1>"
+	Creates the table rows for items which are in dynamo but not in the reference data
+	"""
+	return ["".join(iter_unmanaged_report_entries([item], schema)) for item in items]
+
+def iter_report_head(env_prefix, title = "Delta Report"):
+	"""
+	Yields the start of a report page up to the environment heading
+	"""
+	yield "<html><head><title>{title}</title><style>{style}</style></head><body>".format(title=title, style=stylesheet)
+	yield "<h1>DynamoDB Ref Data delta report</h1>"
 	if env_prefix:
-		html += "<h2>Environment: {env}</h2>".format(env=env_prefix)
+		yield "<h2>Environment: {env}</h2>".format(env=env_prefix)
+
+def iter_change_table(records, schema):
+	"""
+	Yields the table of changes for records with a compare result
+	"""
+	yield "<table class=\"TableTable\"><tr>"
+	for key_field in schema["keys"]:
+		yield "<th class=\"fixed_width\">{key}</th>".format(key=key_field)
+	yield "<th class=\"fixed_width\">Requested action</th>"
+	yield "<th class=\"fixed_width\">Action which will be performed</th>"
+	yield "<th class=\"fixed_width\">Reason</th>"
+	yield "<th class=\"take_up_space\">Row data</th>"
+	yield "</tr>"
+	for record in records:
+		for fragment in iter_change_report_entry(record, schema):
+			yield fragment
+	yield "</table>"
+
+def iter_unmanaged_table(items, schema, count = None):
+	"""
+	Yields the table of unmanaged rows, headed with count or the number of items
+	"""
+	yield "<h3>Unmanaged rows: {count}</h3>".format(count=len(items) if count is None else count)
+	yield "<table class=\"TableTable\"><tr>"
+	for key_field in schema["keys"]:
+		yield "<th class=\"fixed_width\">{key}</th>".format(key=key_field)
+	yield "<th class=\"take_up_space\">Row data</th>"
+	yield "</tr>"
+	for fragment in iter_unmanaged_report_entries(items, schema):
+		yield fragment
+	yield "</table>"
+
+def iter_change_report(data, env_prefix, unmanaged = None):
+	"""
+	Yields the HTML report showing the changes that will be made a fragment at a time
+	
+	Unmanaged rows found for a table are listed after its changes
+	"""
+	for fragment in iter_report_head(env_prefix):
+		yield fragment
 	for table_key in data:
 		table = data[table_key]
-		schema = table["_schema"]
-		html += "<h2>Table: {table}</h2>".format(table=schema["table"])
-		html += "<table class=\"TableTable\"><tr>"
-		for key_field in schema["keys"]:
-			html += "<th class=\"fixed_width\">{key}</th>".format(key=key_field)
-		html += "<th class=\"fixed_width\">Requested action</th>"
-		html += "<th class=\"fixed_width\">Action which will be performed</th>"
-		html += "<th class=\"fixed_width\">Reason</th>"
-		html += "<th class=\"take_up_space\">Row data</th>"
-		html += "</tr>"
-		html += "".join(create_change_report_entries(table, schema))
-		html += "</table>"
-	html += "</body></html>"
-	return html
+		schema = table.schema
+		yield "<h2>Table: {table}</h2>".format(table=schema["table"])
+		for fragment in iter_change_table([record for record in table.get_records() if "_compare_result" in record], schema):
+			yield fragment
+		if unmanaged and unmanaged.get(table_key):
+			for fragment in iter_unmanaged_table(unmanaged[table_key], schema):
+				yield fragment
+	yield "</body></html>"
+
+def iter_change_plan(data):
+	"""
+	Yields a line of JSON for each compared record, for tools which need the changes without reading the report
+	
+	Each line has the table, the key values, the requested action, the action which will be performed, the state of the
+	item in dynamo, the file the record came from and, for updates, the delta.
+	"""
+	for table_key in sorted(data.keys()):
+		schema = data[table_key].schema
+		for record in data[table_key].get_records():
+			if "_compare_result" in record:
+				line = {
+					"table": schema["table"],
+					"keys": get_record_keys(record, schema["keys"]),
+					"requested": record["_meta"]["action"],
+					"action": record["_compare_result"]["action"],
+					"state": record["_compare_result"]["state"],
+					"ref_file": record["_meta"]["ref_file"]
+				}
+				if "delta" in record["_compare_result"]:
+					line["delta"] = record["_compare_result"]["delta"]
+				yield codec.dumps(line, sort_keys=True) + "\n"
+
+def get_report_summary(data, unmanaged = None):
+	"""
+	Counts the compared records of each table by the action which will be performed, and its unmanaged rows
+	
+	Returns a dict keyed by table with the counts under each action and "unmanaged"
+	"""
+	summary = {}
+	for table_key in data:
+		counts = dict((action, 0) for action in REPORT_ACTIONS)
+		for record in data[table_key].get_records():
+			if "_compare_result" in record:
+				action = record["_compare_result"]["action"]
+				counts[action] = counts.get(action, 0) + 1
+		counts["unmanaged"] = len(unmanaged.get(table_key) or []) if unmanaged else 0
+		summary[table_key] = counts
+	return summary
+
+def get_report_pages(data, unmanaged = None, page_rows = REPORT_PAGE_ROWS):
+	"""
+	Splits the rows of the report into pages of at most page_rows rows
+	
+	Tables where every row has an action of none have no change rows in their pages, they are summarised in the index
+	instead.  Returns a list of pages, each a dict with the table, its page number and count, and its records and
+	unmanaged items.
+	"""
+	pages = []
+	for table_key in sorted(data.keys()):
+		records = [record for record in data[table_key].get_records() if "_compare_result" in record]
+		if all(record["_compare_result"]["action"] == "none" for record in records):
+			records = []
+		rows = [("record", record) for record in records]
+		if unmanaged and unmanaged.get(table_key):
+			rows += [("unmanaged", item) for item in unmanaged[table_key]]
+		table_pages = [rows[start:start + page_rows] for start in range(0, len(rows), page_rows)]
+		for (number, page) in enumerate(table_pages):
+			pages.append({
+				"table": table_key,
+				"number": number + 1,
+				"count": len(table_pages),
+				"records": [row for (kind, row) in page if kind == "record"],
+				"unmanaged": [row for (kind, row) in page if kind == "unmanaged"]
+			})
+	return pages
+
+def get_report_page_path(prefix, page):
+	"""
+	Gets the path of a report page under prefix
+	"""
+	return "{prefix}/{table}/page-{number:04d}.html".format(prefix=prefix, table=page["table"], number=page["number"])
+
+def iter_report_page(page, data, env_prefix, unmanaged = None, index_url = None):
+	"""
+	Yields a page of the report for one table
+	"""
+	schema = data[page["table"]].schema
+	for fragment in iter_report_head(env_prefix, title = "Delta Report: {table} page {n}".format(table=page["table"], n=page["number"])):
+		yield fragment
+	if index_url:
+		yield "<p><a href=\"{url}\">Back to index</a></p>".format(url=cgi.escape(index_url, True))
+	yield "<h2>Table: {table}</h2>".format(table=schema["table"])
+	yield "<p>Page {n} of {count}</p>".format(n=page["number"], count=page["count"])
+	if page["records"]:
+		for fragment in iter_change_table(page["records"], schema):
+			yield fragment
+	if page["unmanaged"]:
+		for fragment in iter_unmanaged_table(page["unmanaged"], schema, count = len(unmanaged[page["table"]])):
+			yield fragment
+	yield "</body></html>"
+
+def iter_report_index(data, env_prefix, summary, page_urls):
+	"""
+	Yields the index page of the report with the counts for each table and links to its pages
+	
+	page_urls is a dict keyed by table of lists of page URLs
+	"""
+	for fragment in iter_report_head(env_prefix):
+		yield fragment
+	yield "<table class=\"TableTable\"><tr>"
+	yield "<th class=\"fixed_width\">Table</th>"
+	for action in REPORT_ACTIONS:
+		yield "<th class=\"fixed_width\"><p class=\"label {action}\">{action}</p></th>".format(action=action)
+	yield "<th class=\"fixed_width\">Unmanaged</th>"
+	yield "<th class=\"take_up_space\">Pages</th>"
+	yield "</tr>"
+	for table_key in sorted(data.keys()):
+		counts = summary[table_key]
+		yield "<tr><td>{table}</td>".format(table=data[table_key].schema["table"])
+		for action in REPORT_ACTIONS:
+			yield "<td>{count}</td>".format(count=counts[action])
+		yield "<td>{count}</td>".format(count=counts["unmanaged"])
+		yield "<td>"
+		if all(counts[action] == 0 for action in REPORT_ACTIONS if action != "none"):
+			yield "<p>No changes</p>"
+		for (number, url) in enumerate(page_urls.get(table_key, [])):
+			yield "<a href=\"{url}\">{n}</a> ".format(url=cgi.escape(url, True), n=number + 1)
+		yield "</td></tr>"
+	yield "</table>"
+	yield "</body></html>"
+
+def create_change_report(data, env_prefix, unmanaged = None):
+	"""
+	Writes a HTML report showing the changes that will be made
+	"""
+	return "".join(iter_change_report(data, env_prefix, unmanaged))
 		
-def compare_to_dynamo(data, env_prefix, prev_keys, schema):
+def classify_record(data, item, schema):
 	"""
-	Runs through table dict and compares to the data in dyanamo to confirm the actions that will be taken
+	Works out the action which will be taken for a record given the current item in dynamo (None when there is no item)
 	
-	This is done via a DFS (depth first search)
+	Adds the outcome to the record under _compare_result, along with the version of the item it was compared to so a
+	plan can be checked against dynamo later
 	"""
-	# check if this is a leaf
-	if "_meta" in data:
-		# create
-		if data["_meta"]["action"] == "create":
-			# need to check if this item exists in dynamodb
-			item = ddb_get_item_consistent(
-				keys = {k: v for (k, v) in data.iteritems() if k in schema["keys"]},
-				table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
-			)
-			if item:
-				data.update({
-					"_compare_result": {
-						"state": "exists",
-						"action": "none"
-					}
-				})
-			else:
-				data.update({
-					"_compare_result": {
-						"state": "does_not_exist",
-						"action": "create"
+	# create
+	if data["_meta"]["action"] == "create":
+		if item:
+			data.update({
+				"_compare_result": {
+					"state": "exists",
+					"action": "none"
+				}
+			})
+		else:
+			data.update({
+				"_compare_result": {
+					"state": "does_not_exist",
+					"action": "create"
+				}
+			})
+	elif data["_meta"]["action"] == "update":
+		content_hash = get_content_hash(data)
+		if item and item.get(HASH_FIELD) == content_hash:
+			# the item was written from a record with the same content so there is no need to compare them
+			data.update({
+				"_compare_result": {
+					"state": "exists_no_changes",
+					"action": "none",
+					"delta": {
+						"new": {},
+						"changed": {},
+						"removed": {}
 					}
-				})
-		elif data["_meta"]["action"] == "update":
-			# need to check if this item exists in dynamodb
-			item = ddb_get_item_consistent(
-				keys = {k: v for (k, v) in data.iteritems() if k in schema["keys"]},
-				table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+				}
+			})
+		elif item:
+			delta = compare_single_record(
+				new = data,
+				current = item,
+				key_fields = schema["keys"]
 			)
-			if item:
-				delta = compare_single_record(
-					new = data,
-					current = item,
-					key_fields = schema["keys"]
-				)
-				if len(delta["new"]) + len(delta["changed"]) + len(delta["removed"]) == 0:
-					data.update({
-						"_compare_result": {
-							"state": "exists_no_changes",
-							"action": "none",
-							"delta": delta
-						}
-					})
-
-				else:
-					data.update({
-						"_compare_result": {
-							"state": "exists",
-							"action": "update",
-							"delta": delta
-						}
-					})
-			else:
+			if len(delta["new"]) + len(delta["changed"]) + len(delta["removed"]) == 0:
+				# store the hash when committing so the next compare can skip this item
 				data.update({
 					"_compare_result": {
-						"state": "does_not_exist",
-						"action": "create"
+						"state": "exists_no_changes",
+						"action": "none",
+						"delta": delta,
+						"rehash": True
 					}
 				})
-		elif data["_meta"]["action"] == "delete":
-			# need to check if this item exists in dynamodb
-			item = ddb_get_item_consistent(
-				keys = {k: v for (k, v) in data.iteritems() if k in schema["keys"]},
-				table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
-			)
-			if item:
+			else:
 				data.update({
 					"_compare_result": {
 						"state": "exists",
-						"action": "delete"
+						"action": "update",
+						"delta": delta
 					}
 				})
-			else:
-				data.update({
-					"_compare_result": {
-						"state": "does_not_exist",
-						"action": "none"
-					}
-				})
-				
-	else:
-		# get the schema if we are at the root of the tree
-		if "_schema" in data:
-			schema = data["_schema"]
-		# loop through the keys, searching again depth first
-		for key in [key for key in data.keys() if key not in ["_schema"]]:
-			compare_to_dynamo(
-				data = data[key], 
-				env_prefix = env_prefix, 
-				prev_keys = prev_keys + [key],
+		else:
+			data.update({
+				"_compare_result": {
+					"state": "does_not_exist",
+					"action": "create"
+				}
+			})
+	elif data["_meta"]["action"] == "delete":
+		if item:
+			data.update({
+				"_compare_result": {
+					"state": "exists",
+					"action": "delete"
+				}
+			})
+		else:
+			data.update({
+				"_compare_result": {
+					"state": "does_not_exist",
+					"action": "none"
+				}
+			})
+	data["_compare_result"]["observed"] = get_item_version(item)
+
+def batch_compare_records(records, schema, env_prefix):
+	"""
+	Compares a list of records from a table to the data in dynamo to confirm the actions that will be taken
+	
+	All the keys are collected first and read with consistent batch gets of just the keys, _meta and content hash.  Only the
+	updates whose items have a different hash are read in full, then each record is classified against the items
+	which were returned.  The results are the same as compare_to_dynamo.
+	"""
+	table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+	items = ddb_batch_get_items_consistent(
+		keys = [get_record_keys(record, schema["keys"]) for record in records],
+		table_name = table_name,
+		attributes = schema["keys"] + ["_meta", HASH_FIELD]
+	)
+	current = {get_key_tuple(item, schema["keys"]): item for item in items}
+	compare = [record for record in records
+		if record["_meta"]["action"] == "update"
+		and get_key_tuple(record, schema["keys"]) in current
+		and current[get_key_tuple(record, schema["keys"])].get(HASH_FIELD) != get_content_hash(record)]
+	if compare:
+		items = ddb_batch_get_items_consistent(
+			keys = [get_record_keys(record, schema["keys"]) for record in compare],
+			table_name = table_name
+		)
+		current.update({get_key_tuple(item, schema["keys"]): item for item in items})
+	for record in records:
+		classify_record(
+			data = record,
+			item = current.get(get_key_tuple(record, schema["keys"])),
+			schema = schema
+		)
+
+def scan_compare_to_dynamo(data, env_prefix, segments):
+	"""
+	Compares a table to a snapshot of the whole dynamo table taken with a parallel scan
+	
+	The results are the same as compare_to_dynamo.  Returns a list of the items in dynamo which are not mentioned by
+	any record in the table (unmanaged rows).
+	"""
+	schema = data.schema
+	snapshot = ddb_scan_table_snapshot(
+		table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"]),
+		key_fields = schema["keys"],
+		segments = segments
+	)
+	for record in data.get_records():
+		item = snapshot.pop(get_key_tuple(record, schema["keys"]), None)
+		if "_compare_result" not in record:
+			classify_record(
+				data = record,
+				item = item,
 				schema = schema
 			)
+	return [snapshot[key] for key in sorted(snapshot.keys())]
+
+def pick_compare_mode(data, env_prefix, mode):
+	"""
+	Picks the compare mode to use for a table
+	
+	In auto mode a table is scanned when a scan is expected to use fewer read units than batch gets of its records
+	"""
+	if mode != "auto":
+		return mode
+	schema = data.schema
+	description = ddb_describe_table(
+		table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+	)
+	scan_units = int(math.ceil(description["TableSizeBytes"] / 4096.0))
+	if scan_units <= len(get_pending_records(data)) * SCAN_COST_RATIO:
+		return "scan"
+	else:
+		return "batch"
+
+def compare_tables_to_dynamo(tables, env_prefix, mode = "batch", segments = SCAN_SEGMENTS, concurrency = CONCURRENCY):
+	"""
+	Compares each table to dynamo using the compare mode requested
+	
+	The work is split into tasks which are run on up to concurrency threads.  A scanned table is one task, otherwise the
+	records of a table are split into tasks of one batch get (or one get in get mode) each.  Every record is classified
+	by exactly one task so the tasks can run in any order.  Records which already have a compare result are skipped.
+	
+	Returns a dict of the unmanaged rows found for each table which was scanned
+	"""
+	if mode not in COMPARE_MODES:
+		raise ProcessError("Compare mode {m} is not valid, expecting one of {modes}".format(m = mode, modes = ", ".join(COMPARE_MODES)))
+	scanned = []
+	scan_tasks = []
+	tasks = []
+	for table in tables:
+		data = tables[table]
+		schema = data.schema
+		table_mode = pick_compare_mode(
+			data = data,
+			env_prefix = env_prefix,
+			mode = mode
+		)
+		if table_mode == "scan":
+			scanned.append(table)
+			scan_tasks.append(functools.partial(scan_compare_to_dynamo, data = data, env_prefix = env_prefix, segments = segments))
+		elif table_mode == "batch":
+			records = get_pending_records(data)
+			for i in range(0, len(records), BATCH_GET_MAX_KEYS):
+				tasks.append(functools.partial(batch_compare_records, records = records[i:i + BATCH_GET_MAX_KEYS], schema = schema, env_prefix = env_prefix))
+		else:
+			for record in get_pending_records(data):
+				tasks.append(functools.partial(compare_to_dynamo, data = record, env_prefix = env_prefix, schema = schema))
+	# scans are the longest tasks so they are started first
+	results = run_tasks(scan_tasks + tasks, concurrency)
+	return dict(zip(scanned, results[:len(scanned)]))
+
+def compare_to_dynamo(data, env_prefix, schema):
+	"""
+	Compares a record to the data in dyanamo with a consistent get to confirm the action that will be taken
+	"""
+	item = ddb_get_item_consistent(
+		keys = get_record_keys(data, schema["keys"]),
+		table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+	)
+	classify_record(
+		data = data,
+		item = item,
+		schema = schema
+	)
 
 def apply_to_dynamo(data, env_prefix, schema):
 	"""
-	Applies changes to dynamo DB table from local copy of data
-	"""
-	# check if this is a leaf with a compare result:
-	if "_compare_result" in data:
-		compare_result = data["_compare_result"]
-		keys = {k: v for (k, v) in data.iteritems() if k in schema["keys"]}
-		if compare_result["action"] == "create":
-			result = ddb_create_item(
-				keys = keys,
-				data = data,
-				table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
-			)
-			if result:
-				data.update({
-					"_result": "completed"
-				})
-			else:
-				data.update({
-					"_result": "not_completed"
-				})
-		elif compare_result["action"] == "update":
-			ddb_update_item(
-				keys = keys,
-				delta = compare_result["delta"],
-				meta = data["_meta"],
-				table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
-			)
-		elif compare_result["action"] == "delete":
-			ddb_delete_item(
-				keys = keys,
-				table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
-			)
+	Applies the change for a record with a compare result to its dynamo DB table
+	"""
+	compare_result = data["_compare_result"]
+	keys = {k: v for (k, v) in data.iteritems() if k in schema["keys"]}
+	if compare_result["action"] == "create":
+		result = ddb_create_item(
+			keys = keys,
+			data = data,
+			table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+		)
+		if result:
 			data.update({
 				"_result": "completed"
 			})
-	else:
-		if "_schema" in data:
-			schema = data["_schema"]
-		for key in [key for key in data.keys() if key not in ["_schema"]]:
-			apply_to_dynamo(
-				data = data[key],
+		else:
+			data.update({
+				"_result": "not_completed"
+			})
+	elif compare_result["action"] == "update":
+		ddb_update_item(
+			keys = keys,
+			delta = compare_result["delta"],
+			meta = data["_meta"],
+			table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"]),
+			content_hash = get_content_hash(data)
+		)
+	elif compare_result["action"] == "delete":
+		ddb_delete_item(
+			keys = keys,
+			table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+		)
+		data.update({
+			"_result": "completed"
+		})
+	elif compare_result.get("rehash"):
+		ddb_set_content_hash(
+			keys = keys,
+			content_hash = get_content_hash(data),
+			table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+		)
+
+def batch_write_records(records, schema, env_prefix):
+	"""
+	Applies deletes for a list of records from a table to dynamo DB as batch writes
+	
+	Batch writes cannot be conditional, so creates (which must not overwrite an item created since the compare) are
+	not batched.  Only deletes are sped up by batch mode, a re-seed made of creates still writes one conditional put
+	per record and is sped up with the concurrency setting instead.
+	"""
+	requests = []
+	for record in records:
+		requests.append({
+			"DeleteRequest": {
+				"Key": get_record_keys(record, schema["keys"])
+			}
+		})
+	ddb_batch_write_items(
+		requests = requests,
+		table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"])
+	)
+	for record in records:
+		record.update({
+			"_result": "completed"
+		})
+
+def apply_tables_to_dynamo(tables, env_prefix, mode = "item", concurrency = CONCURRENCY):
+	"""
+	Applies changes to dynamo DB from each table using the write mode requested
+	
+	The work is split into tasks which are run on up to concurrency threads.  In batch mode deletes are grouped into
+	tasks of one batch write each, every other change is a task of its own.  Creates are conditional, which batch
+	writes cannot be, so they are always written one at a time even in batch mode, which therefore does not speed up a
+	load made mostly of creates.  Each item has a single change so the tasks can run in any order.
+	"""
+	if mode not in WRITE_MODES:
+		raise ProcessError("Write mode {m} is not valid, expecting one of {modes}".format(m = mode, modes = ", ".join(WRITE_MODES)))
+	tasks = []
+	for table in tables:
+		schema = tables[table].schema
+		records = [record for record in tables[table].get_records() if "_compare_result" in record]
+		if mode == "batch":
+			batched = [record for record in records if record["_compare_result"]["action"] == "delete"]
+			for i in range(0, len(batched), BATCH_WRITE_MAX_ITEMS):
+				tasks.append(functools.partial(batch_write_records, records = batched[i:i + BATCH_WRITE_MAX_ITEMS], schema = schema, env_prefix = env_prefix))
+			records = [record for record in records if record["_compare_result"]["action"] != "delete"]
+		for record in records:
+			if record["_compare_result"]["action"] != "none" or record["_compare_result"].get("rehash"):
+				tasks.append(functools.partial(apply_to_dynamo, data = record, env_prefix = env_prefix, schema = schema))
+	run_tasks(tasks, concurrency)
+
+def create_plan_header(env_prefix, artifact_hash):
+	"""
+	Creates the header of a plan, which is saved as its first line
+	
+	A plan is saved from compared tables so the changes can be applied later.  The header is followed by a line for
+	each table written by iter_plan.
+	"""
+	return {
+		"env": env_prefix,
+		"artifact": artifact_hash,
+		"timestamp": datetime.datetime.utcnow().isoformat()
+	}
+
+def iter_plan(tables, checksums = None):
+	"""
+	Yields a line of JSON for each compared table of a plan, a record at a time so the plan is never held as one string
+	
+	Each line has the schema, the records and the checksums of the files the table came from, which are kept so they
+	can be recorded in the ledger.  checksums is keyed by table name and then file name.
+	"""
+	for table in sorted(tables.keys()):
+		yield "{{\"schema\": {s}, \"checksums\": {c}, \"records\": [".format(
+			s = codec.dumps(tables[table].schema),
+			c = codec.dumps((checksums or {}).get(table, {}))
+		)
+		for (i, record) in enumerate(tables[table].get_records()):
+			yield (", " if i else "") + codec.dumps(record)
+		yield "]}\n"
+
+def load_plan(lines, checksums):
+	"""
+	Rebuilds the compared tables of a plan from the lines after its header, one table at a time
+	
+	Yields (table name, TableState) for each table.  checksums is filled in with the checksums of each table's files,
+	keyed by table name and then file name.
+	"""
+	for line in lines:
+		if line.strip():
+			table = codec.loads(line)
+			checksums[table["schema"]["table"]] = table["checksums"]
+			yield (table["schema"]["table"], TableState(table["schema"], table["records"]))
+
+def record_changed_since_plan(record, item):
+	"""
+	Checks if the item in dynamo for a record has changed since the plan the record came from was made
+	
+	item only needs the key fields, _meta and content hash.  It has changed if it is not the version of the item the
+	record was compared to, so it has been created, deleted or written since.  Records from plans which did not keep
+	the version have always changed.
+	"""
+	if "observed" not in record["_compare_result"]:
+		return True
+	return get_item_version(item) != record["_compare_result"]["observed"]
+
+def recheck_records(records, schema, env_prefix):
+	"""
+	Checks records from a plan against dynamo, comparing any whose items have changed since the plan was made again
+	
+	Only the keys, _meta and content hash of each item are read for the check.  Returns the number of records compared
+	again.
+	"""
+	items = ddb_batch_get_items_consistent(
+		keys = [get_record_keys(record, schema["keys"]) for record in records],
+		table_name = "{env}_{name}".format(env=env_prefix, name=schema["table"]),
+		attributes = schema["keys"] + ["_meta", HASH_FIELD]
+	)
+	current = {get_key_tuple(item, schema["keys"]): item for item in items}
+	changed = [record for record in records if record_changed_since_plan(record, current.get(get_key_tuple(record, schema["keys"])))]
+	if changed:
+		batch_compare_records(
+			records = changed,
+			schema = schema,
+			env_prefix = env_prefix
+		)
+	return len(changed)
+
+def recheck_tables(tables, env_prefix, concurrency = CONCURRENCY):
+	"""
+	Checks the records in each table loaded from a plan against dynamo, comparing changed ones again
+	
+	Records from files which had already been applied when the plan was made are not checked.  Returns the number of
+	records compared again.
+	"""
+	tasks = []
+	for table in tables:
+		schema = tables[table].schema
+		records = [record for record in tables[table].get_records() if record["_compare_result"]["state"] != "applied"]
+		for i in range(0, len(records), BATCH_GET_MAX_KEYS):
+			tasks.append(functools.partial(recheck_records, records = records[i:i + BATCH_GET_MAX_KEYS], schema = schema, env_prefix = env_prefix))
+	return sum(run_tasks(tasks, concurrency))
+
+def group_tables(tables, group_records = GROUP_RECORDS):
+	"""
+	Groups a stream of (table name, TableState) pairs into dicts of tables holding at least group_records records
+	
+	Tables are never split, so a group holds at most group_records records plus those of its last table.  Each group is
+	yielded as soon as it is full, the last one with whatever tables are left.
+	"""
+	group = {}
+	count = 0
+	for (table, state) in tables:
+		group[table] = state
+		count += len(state)
+		if count >= group_records:
+			yield group
+			group = {}
+			count = 0
+	if group:
+		yield group
+
+def iter_compared_groups(entries, env_prefix, checksums, ledger = None, mode = "batch", segments = SCAN_SEGMENTS, concurrency = CONCURRENCY, group_records = GROUP_RECORDS):
+	"""
+	Validates and compares the tables in a stream of (table, file name, parsed json) entries a group at a time
+	
+	checksums is filled in with the checksums of the record files as they are read.  Records from files which the
+	ledger shows have been applied are not compared.  Yields (tables, unmanaged) for each group, where unmanaged is the
+	dict compare_tables_to_dynamo returns.
+	"""
+	groups = group_tables(iter_validated_tables(checksum_files(entries, checksums)), group_records)
+	while True:
+		# read the files and process the tables as they are read, so parsing and validation are timed together
+		with metrics.span("parse"):
+			tables = next(groups, None)
+		if tables is None:
+			return
+		if ledger:
+			with metrics.span("ledger"):
+				applied = mark_applied_records(
+					tables = tables,
+					applied = get_applied_files(
+						checksums = dict((table, checksums.get(table, {})) for table in tables),
+						env_prefix = env_prefix,
+						ledger = ledger
+					)
+				)
+			print "{n} records come from files which have already been applied".format(n = applied)
+		with metrics.span("compare", items = sum(len(tables[table]) for table in tables)):
+			unmanaged = compare_tables_to_dynamo(
+				tables = tables,
 				env_prefix = env_prefix,
-				schema = schema
+				mode = mode,
+				segments = segments,
+				concurrency = concurrency
 			)
-			
-def read_zip_file(zip_file):
+		yield (tables, unmanaged)
+
+def iter_rechecked_groups(lines, env_prefix, checksums, concurrency = CONCURRENCY, group_records = GROUP_RECORDS):
+	"""
+	Loads the tables of a plan from the lines after its header and checks them against dynamo a group at a time
+	
+	checksums is filled in as load_plan does.  Yields (tables, unmanaged) for each group like iter_compared_groups,
+	unmanaged is always empty as plans do not keep unmanaged rows.
+	"""
+	groups = group_tables(load_plan(lines, checksums), group_records)
+	while True:
+		with metrics.span("load_plan"):
+			tables = next(groups, None)
+		if tables is None:
+			return
+		with metrics.span("recheck"):
+			changed = recheck_tables(
+				tables = tables,
+				env_prefix = env_prefix,
+				concurrency = concurrency
+			)
+		print "{n} records had changed since the plan was made and were compared again".format(n = changed)
+		yield (tables, {})
+
+def get_file_checksum(data):
+	"""
+	Gets a checksum of the parsed content of a reference file
+	"""
+	return hashlib.sha256(codec.canonical_dumps(data)).hexdigest()
+
+def checksum_files(entries, checksums):
+	"""
+	Passes on a stream of (table, file name, parsed json) entries, recording the checksum of each record file
+	
+	checksums is filled in keyed by the table name from the schema file and then file name.  The checksums need to be
+	taken before validate_and_process changes the records.
+	"""
+	table_names = {}
+	for (table, file, data) in entries:
+		if file == "000_schema.json":
+			if isinstance(data, dict) and "table" in data:
+				table_names[table] = data["table"]
+				checksums[data["table"]] = {}
+		elif table in table_names:
+			checksums[table_names[table]][file] = get_file_checksum(data)
+		yield (table, file, data)
+
+def get_file_checksums(input):
+	"""
+	Gets the checksums of the record files in raw data, keyed by table name and then file name
+	"""
+	checksums = {}
+	for entry in checksum_files(iter_raw_files(input), checksums):
+		pass
+	return checksums
+
+def ddb_get_ledger(ledger_table, table_name):
+	"""
+	Gets the files the ledger shows have been applied to table_name
+	
+	Returns a dict of the checksums of the files keyed by file name
+	"""
+	applied = {}
+	request = {
+		"TableName": ledger_table,
+		"KeyConditionExpression": "#t = :t",
+		"ExpressionAttributeNames": {"#t": "table"},
+		"ExpressionAttributeValues": {":t": table_name},
+		"ConsistentRead": True
+	}
+	while True:
+		page = ddb_call(get_ddb_item_client().query, ledger_table, "read", 1, **request)
+		for item in page["Items"]:
+			applied[item["ref_file"]] = item["checksum"]
+		if "LastEvaluatedKey" not in page:
+			return applied
+		request["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+def get_applied_files(checksums, env_prefix, ledger):
+	"""
+	Gets the files for each table which the ledger shows have been applied and which have not changed since
+	
+	Returns a dict of sets of file names keyed by table name
+	"""
+	applied = {}
+	for table in checksums:
+		applied[table] = set()
+		for (file, checksum) in ddb_get_ledger("{env}_{name}".format(env=env_prefix, name=ledger), table).iteritems():
+			if checksums[table].get(file) == checksum:
+				applied[table].add(file)
+			elif file in checksums[table]:
+				print "{tn}/{f} has changed since it was applied so the records it contributes to will be compared".format(tn=table, f=file)
+	return applied
+
+def mark_applied_records(tables, applied):
+	"""
+	Marks records all of whose files have been applied as needing no action, so that they are not compared
+	
+	A record is still compared when any file which contributed to it is not in applied, as an older file may have
+	changed while the newest did not.  Returns the number of records marked
+	"""
+	marked = 0
+	for table in tables:
+		state = tables[table]
+		for record in state.get_records():
+			files = state.files_of(state.key_of(record))
+			if files and all(file in applied.get(table, ()) for file in files):
+				record.update({
+					"_compare_result": {
+						"state": "applied",
+						"action": "none"
+					}
+				})
+				marked += 1
+	return marked
+
+def record_applied_files(checksums, env_prefix, ledger):
+	"""
+	Records the files for each table in the ledger as applied, skipping those it already has
+	"""
+	ledger_table = "{env}_{name}".format(env=env_prefix, name=ledger)
+	for table in checksums:
+		recorded = ddb_get_ledger(ledger_table, table)
+		ddb_batch_write_items(
+			requests = [{
+				"PutRequest": {
+					"Item": {
+						"table": table,
+						"ref_file": file,
+						"checksum": checksums[table][file],
+						"applied_at": DATE_NOW
+					}
+				}
+			} for file in sorted(checksums[table].keys()) if recorded.get(file) != checksums[table][file]],
+			table_name = ledger_table
+		)
+
+def iter_zip_files(zip_file, processes = None):
+	"""
+	Reads a zip file of reference data one file at a time
+	
+	Yields (table, file name, parsed json) entries ordered by table and then file name, the files are parsed using up
+	to processes processes
+	"""
+	file = zipfile.ZipFile(zip_file, "r")
+	try:
+		names = []
+		for file_name in sorted(file.namelist()):
+			file_name_parts = file_name.split("/")
+			if len(file_name_parts) == 2 and file_name_parts[1] != "":
+				names.append(file_name_parts)
+		for entry in parse_files(
+			entries = ((table, name, file.read("{t}/{n}".format(t=table, n=name))) for (table, name) in names),
+			count = len(names),
+			processes = processes
+		):
+			yield entry
+	finally:
+		file.close()
+
+def read_zip_file(zip_file, processes = None):
 	"""
 	Reads a zip file and outputs a dictionary of reference data to be processed
 	"""
 	data = {}
-	file = zipfile.ZipFile(zip_file, "r")
-	for file_name in file.namelist():
-		file_name_parts = file_name.split("/")
-		if file_name_parts[1] == "":
-			data.update({
-				file_name_parts[0]: {}
-			})
-		else:
-			if file_name_parts[0] not in data:
-				data.update({
-					file_name_parts[0]: {}
-				})
-			json_data = json.loads(file.read(file_name))
-			data[file_name_parts[0]][file_name_parts[1]] = json_data
-	file.close()
-	return data	
+	for (table, file, json_data) in iter_zip_files(zip_file, processes):
+		data.setdefault(table, {})[file] = json_data
+	return data
 
 def get_s3_client(creds = None):
 	"""
 	Gets an S3 client using creds if specified
 	"""
 	if creds:
-		# need to create a new S3 client with the creds
-		session = Session(
-			aws_access_key_id = creds["accessKeyId"],
-			aws_secret_access_key = creds["secretAccessKey"],
-			aws_session_token = creds["sessionToken"]
+		# the artifact can only be read with the creds
+		return clients.get("s3",
+			creds = creds,
+			signature_version = "s3v4"
 		)
-		client = session.client("s3", config=botocore.client.Config(
-			signature_version="s3v4"
-		))
-		return client
 	else:
-		return boto3.client("s3")
+		return clients.get("s3")
 	
-def get_file_from_s3(bucket, path, creds = None):
+def get_artifact_from_s3(bucket, path, creds = None):
 	"""
-	Downloads the file at path from S3 bucket to a new temp file.
+	Streams the object at path in S3 bucket into a buffer which is only written to disk if it is large
 	
-	Returns the temp file path
+	Returns the buffer, positioned at the start, and the SHA-256 hash of its content
 	
 	Uses creds if specified
 	"""
 	client = get_s3_client(creds)
-	temp_dir = tempfile.mkdtemp()
-	file_name = path.split("/").pop()
-	download_loc = os.path.join(temp_dir, file_name)
-	client.download_file(bucket, path, download_loc)
-	return download_loc
+	body = client.get_object(
+		Bucket=bucket,
+		Key=path
+	)["Body"]
+	sha = hashlib.sha256()
+	buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+	for block in iter(lambda: body.read(1024 * 1024), b""):
+		sha.update(block)
+		buffer.write(block)
+	buffer.seek(0)
+	return (buffer, sha.hexdigest())
+
+def write_fragments(fragments, out):
+	"""
+	Writes a stream of HTML fragments to a file object, unicode fragments are encoded as UTF-8
+	"""
+	for fragment in fragments:
+		if isinstance(fragment, unicode):
+			fragment = fragment.encode("utf-8")
+		out.write(fragment)
 
-def put_html_file_in_s3(bucket, path, html, creds = None):
+def put_html_file_in_s3(bucket, path, html, creds = None, encoding = "gzip"):
 	"""
-	Puts HTML report file in S3 at path
+	Puts HTML report file in S3 at path, html can be a string or an iterable of fragments
+	
+	The fragments are compressed with encoding as they are uploaded in parts, so the whole report is never held in
+	memory.  The object has a matching Content-Encoding so browsers decompress it.
 	
 	Uses creds if specified
 	"""
 	client = get_s3_client(creds)
-	data = StringIO.StringIO(html)
-	client.put_object(
-		Bucket=bucket,
-		Key="{p}".format(p=path), 
-		Body=data#,
+	if isinstance(html, basestring):
+		html = [html]
+	with MultipartUploader(
+		client = client,
+		bucket = bucket,
+		key = "{p}".format(p=path),
+		ContentType = "text/html; charset=utf-8",
+		ContentEncoding = encoding#,
 		#ServerSideEncryption="aws:kms"
+	) as upload:
+		writer = compression.open_writer(upload, encoding)
+		write_fragments(html, writer)
+		writer.close()
+
+def open_s3_upload(bucket, path, content_type):
+	"""
+	Opens a multipart upload to path in S3, to be used in a with statement so it is completed or aborted
+	"""
+	return MultipartUploader(
+		client = get_s3_client(),
+		bucket = bucket,
+		key = path,
+		ContentType = content_type
 	)
 
+def put_text_file_in_s3(bucket, path, text):
+	"""
+	Puts plain text in S3 at path
+	"""
+	with MultipartUploader(
+		client = get_s3_client(),
+		bucket = bucket,
+		key = path,
+		ContentType = "text/plain; charset=utf-8"
+	) as upload:
+		upload.write(text)
+
+def put_change_plan_in_s3(bucket, path, data):
+	"""
+	Puts the change plan for compared tables in S3 at path as NDJSON
+	"""
+	with open_s3_upload(bucket, path, "application/x-ndjson") as upload:
+		write_fragments(iter_change_plan(data), upload)
+
+def iter_body_lines(body, size = PLAN_READ_BYTES):
+	"""
+	Yields the lines of a streamed S3 object body, reading size bytes at a time
+	"""
+	pieces = []
+	while True:
+		chunk = body.read(size)
+		if not chunk:
+			break
+		parts = chunk.split("\n")
+		for part in parts[:-1]:
+			pieces.append(part)
+			yield "".join(pieces)
+			pieces = []
+		pieces.append(parts[-1])
+	if any(pieces):
+		yield "".join(pieces)
+
+def get_plan_from_s3(bucket, path):
+	"""
+	Gets the plan at path in S3
+	
+	Returns the header of the plan and an iterator over the rest of its lines, which are read as they are used.
+	Returns None when the plan cannot be read, so that the caller can fall back to making a new one.
+	"""
+	client = get_s3_client()
+	try:
+		response = client.get_object(
+			Bucket=bucket,
+			Key=path
+		)
+		lines = iter_body_lines(response["Body"])
+		return (codec.loads(next(lines)), lines)
+	except (botocore.exceptions.ClientError, StopIteration, ValueError) as e:
+		print "Could not read plan {p}: {err}".format(p=path, err=e)
+		return None
+
 def get_presigned_url_for_review(bucket, path, expires):
 	"""
 	Uses plain client to generate a presigned URL
@@ -738,47 +1893,181 @@ def get_presigned_url_for_review(bucket, path, expires):
 	)
 	return url
 
-def read_folder(folder):
+def put_report_in_s3(bucket, prefix, data, env_prefix, unmanaged = None, page_rows = REPORT_PAGE_ROWS, expires = 600, encoding = "gzip"):
 	"""
-	Reads a folder and create data structure
+	Puts the report in S3 under prefix as an index page and pages of at most page_rows rows, compressed with encoding
+	
+	The index links to each page with a presigned URL, and each page links back to the index.  Returns the presigned
+	URL of the index.
 	"""
-	data = {}
-	for dir in os.listdir(folder):
+	index_url = get_presigned_url_for_review(
+		bucket = bucket,
+		path = get_report_index_path(prefix),
+		expires = expires
+	)
+	page_urls = put_report_pages_in_s3(bucket, prefix, data, env_prefix, index_url, unmanaged, page_rows, expires, encoding)
+	put_report_index_in_s3(bucket, prefix, data, env_prefix, get_report_summary(data, unmanaged), page_urls, encoding)
+	return index_url
+
+def get_report_index_path(prefix):
+	"""
+	Gets the path of the report index page under prefix
+	"""
+	return "{prefix}/index.html".format(prefix=prefix)
+
+def put_report_pages_in_s3(bucket, prefix, data, env_prefix, index_url, unmanaged = None, page_rows = REPORT_PAGE_ROWS, expires = 600, encoding = "gzip"):
+	"""
+	Puts the report pages for compared tables in S3 under prefix, each linking back to index_url
+	
+	Returns a dict keyed by table of lists of presigned URLs of its pages
+	"""
+	page_urls = {}
+	for page in get_report_pages(data, unmanaged, page_rows):
+		path = get_report_page_path(prefix, page)
+		put_html_file_in_s3(
+			bucket = bucket,
+			path = path,
+			html = iter_report_page(page, data, env_prefix, unmanaged, index_url),
+			encoding = encoding
+		)
+		page_urls.setdefault(page["table"], []).append(get_presigned_url_for_review(
+			bucket = bucket,
+			path = path,
+			expires = expires
+		))
+	return page_urls
+
+def put_report_index_in_s3(bucket, prefix, data, env_prefix, summary, page_urls, encoding = "gzip"):
+	"""
+	Puts the report index in S3 under prefix
+	
+	Only the schemas of the tables in data are used, so the tables can be left without their records
+	"""
+	put_html_file_in_s3(
+		bucket = bucket,
+		path = get_report_index_path(prefix),
+		html = iter_report_index(
+			data = data,
+			env_prefix = env_prefix,
+			summary = summary,
+			page_urls = page_urls
+		),
+		encoding = encoding
+	)
+
+def iter_folder_files(folder, processes = None):
+	"""
+	Reads a folder of reference data one file at a time
+	
+	Yields (table, file name, parsed json) entries ordered by table and then file name, the files are parsed using up
+	to processes processes
+	"""
+	names = []
+	for dir in sorted(os.listdir(folder)):
 		# ignore folders which start with .
 		if not dir[:1] == ".":
-			data[dir] = {}
-			for file in os.listdir("{r}/{d}".format(r=folder, d=dir)):
-				json_file = "{r}/{d}/{f}".format(r=folder, d=dir, f=file)
-				with open(json_file) as f:
-					json_data = json.load(f)
-					f.close()
-				data[dir][file] = json_data
+			for file in sorted(os.listdir("{r}/{d}".format(r=folder, d=dir))):
+				names.append((dir, file))
+	def read(dir, file):
+		with open("{r}/{d}/{f}".format(r=folder, d=dir, f=file)) as f:
+			return f.read()
+	return parse_files(
+		entries = ((dir, file, read(dir, file)) for (dir, file) in names),
+		count = len(names),
+		processes = processes
+	)
+
+def read_folder(folder, processes = None):
+	"""
+	Reads a folder and create data structure
+	"""
+	data = {}
+	for (dir, file, json_data) in iter_folder_files(folder, processes):
+		data.setdefault(dir, {})[file] = json_data
 	return data
-				
-	
-def local_run(folder, environment):
+
+def local_run(folder, environment, compare_mode = "batch", concurrency = CONCURRENCY, profile = None, profile_top = PROFILE_TOP_N, profile_output = sys.stderr):
 	"""
 	Runs locally for testing, only does a compare, not a commit
+	
+	When profile is cpu or mem the run is profiled and the top profile_top results are written to profile_output
 	"""
+	if profile:
+		profiler = Profiler(profile, profile_top)
+		with profiler:
+			local_run(folder, environment, compare_mode, concurrency)
+		profile_output.write(profiler.report())
+		return
+	configure_ddb_clients(get_ddb_client_settings({}, max(concurrency, SCAN_SEGMENTS)))
 	raw = read_folder(folder)
 	#print(json.dumps(raw))
 	tables = validate_and_process(raw)
 	#print(json.dumps(tables))
 	#pprint(tables)
-	for table in tables:
-		compare_to_dynamo(
-			data = tables[table],
-			env_prefix = environment,
-			prev_keys = [],
-			schema = {}
-		)
+	unmanaged = compare_tables_to_dynamo(
+		tables = tables,
+		env_prefix = environment,
+		mode = compare_mode,
+		concurrency = concurrency
+	)
 	#print(json.dumps(tables))
-	report = create_change_report(
-		data = tables,
-		env_prefix = environment
+	write_fragments(
+		fragments = iter_change_report(
+			data = tables,
+			env_prefix = environment,
+			unmanaged = unmanaged
+		),
+		out = sys.stdout
 	)
-	print report
+	print
 	
+def add_record_metrics(tables, env_prefix):
+	"""
+	Counts the records of each table and the action each needs against its dynamo DB table
+	"""
+	for table in tables:
+		table_name = "{env}_{name}".format(env=env_prefix, name=tables[table].schema["table"])
+		for record in tables[table].get_records():
+			metrics.add(table_name, "records")
+			if "_compare_result" in record:
+				metrics.add(table_name, "records_" + record["_compare_result"]["action"])
+
+def save_profile(profiler, job_id, parameters):
+	"""
+	Stops profiling a job and puts the results next to its report, or in the log when there is no report bucket
+	"""
+	profiler.stop()
+	report = profiler.report()
+	if "reportbucket" not in parameters:
+		print report
+		return
+	path = "{id}/profile-{kind}.txt".format(id = job_id, kind = profiler.kind)
+	try:
+		put_text_file_in_s3(
+			bucket = parameters["reportbucket"],
+			path = path,
+			text = report
+		)
+		print "Profile saved to {p}".format(p = path)
+	except:
+		# the job has already been reported, so a failure here is only logged
+		traceback.print_exc()
+		print report
+
+def emit_metrics(job_id, parameters, error = None):
+	"""
+	Writes the metrics collected for a job to the log, as the metrics parameter asks, with the error it failed with
+	"""
+	output = parameters.get("metrics", "json")
+	if output not in METRICS_OUTPUTS:
+		output = "json"
+	metrics.emit(sys.stdout,
+		output = output,
+		dimensions = {"Environment": parameters.get("env", ""), "Mode": parameters.get("mode", "")},
+		job = job_id,
+		error = error
+	)
+
 def cp_event_handler(event, context):
 	"""
 	Gets event from codepipeline and uses the data to update DynamoDB data
@@ -791,6 +2080,11 @@ def cp_event_handler(event, context):
 	"""
 	job_id = event["CodePipeline.job"]["id"]
 	success = False
+	error = None
+	parameters = {}
+	profiler = None
+	artifact = None
+	metrics.reset()
 	try:
 		job_data = event["CodePipeline.job"]["data"]
 		action = job_data["actionConfiguration"]["configuration"]
@@ -799,7 +2093,6 @@ def cp_event_handler(event, context):
 		
 		# need to get user parameters
 		user_parameters = action["UserParameters"]
-		parameters = {}
 		for parameter in user_parameters.split(","):
 			kvp = parameter.split("=")
 			if len(kvp) != 2:
@@ -814,63 +2107,146 @@ def cp_event_handler(event, context):
 			raise ProcessError("Mode not specified")
 		if "env" not in parameters:
 			raise ProcessError("Env not specified")
+		report_encoding = parameters.get("reportencoding", "gzip")
+		if report_encoding not in compression.available_encodings():
+			raise ProcessError("Report encoding {e} is not valid, use one of {a}".format(e = report_encoding, a = compression.available_encodings()))
+		if parameters.get("metrics", "json") not in METRICS_OUTPUTS:
+			raise ProcessError("Metrics output {m} is not valid, expecting one of {outputs}".format(m = parameters["metrics"], outputs = ", ".join(METRICS_OUTPUTS)))
+		if "profile" in parameters:
+			if parameters["profile"] not in PROFILES:
+				raise ProcessError("Profile {p} is not valid, expecting one of {profiles}".format(p = parameters["profile"], profiles = ", ".join(PROFILES)))
+			profile_top = int(parameters.get("profiletop", PROFILE_TOP_N))
+			if profile_top < 1:
+				raise ProcessError("Profile top {n} is not valid, expecting at least 1".format(n = profile_top))
+			profiler = Profiler(parameters["profile"], profile_top).start()
 		
 		# get S3 file
-		temp_zip_file = get_file_from_s3(
-			bucket = input_artifact["location"]["s3Location"]["bucketName"],
-			path = input_artifact["location"]["s3Location"]["objectKey"],
-			creds = s3creds
-		)
-		
-		# read zip file
-		raw = read_zip_file(temp_zip_file)
+		with metrics.span("download"):
+			(artifact, artifact_hash) = get_artifact_from_s3(
+				bucket = input_artifact["location"]["s3Location"]["bucketName"],
+				path = input_artifact["location"]["s3Location"]["objectKey"],
+				creds = s3creds
+			)
 		
-		# process the tables
-		tables = validate_and_process(raw)
+		# work out how many threads to use and cap the requests they can have in flight
+		if "io" in parameters or "pipeline" in parameters:
+			raise ProcessError("The io and pipeline parameters have been removed, set concurrency to the number of requests to keep in flight")
+		concurrency = int(parameters.get("concurrency", CONCURRENCY))
+		segments = int(parameters.get("scansegments", SCAN_SEGMENTS))
+		configure_rate_limit(parameters.get("ratelimit", "adaptive"))
+		ddb_requests.resize(int(parameters.get("maxinflight", max(concurrency, segments))))
+		# size the connection pool for the requests which can be in flight
+		configure_ddb_clients(get_ddb_client_settings(parameters, ddb_requests.size or max(concurrency, segments)))
 		
-		# for each table we need to compare to dynamodb
-		for table in tables:
-			compare_to_dynamo(
-				data = tables[table],
-				env_prefix = parameters["env"],
-				prev_keys = [],
-				schema = {}
-			)
+		# the plan made by report mode is saved against the hash of the artifact it was made from
+		plan_path = "plans/{env}/{hash}.ndjson".format(env = parameters["env"], hash = artifact_hash)
+		ledger = parameters.get("ledger")
+		group_records = int(parameters.get("grouprecords", GROUP_RECORDS))
+		if group_records < 1:
+			raise ProcessError("Group records {n} is not valid, expecting at least 1".format(n = group_records))
+		checksums = {}
+		groups = None
 		
-		# if mode=report then produce the change report
 		if parameters["mode"] == "report":
 			# check mandatory parameters are present
 			if "reportbucket" not in parameters:
 				raise ProcessError("Report bucket not specified")
 			if "topic" not in parameters:
 				raise ProcessError("Topic not specified")
-			
-			# create report
-			report = create_change_report(
-				data = tables,
-				env_prefix = parameters["env"]
-			)
-			# upload it to the reports bucket
-			put_html_file_in_s3(
-				bucket = parameters["reportbucket"],
-				path = "{id}/report.html".format(id = job_id),
-				html = report
+			page_rows = int(parameters.get("pagesize", REPORT_PAGE_ROWS))
+			if page_rows < 1:
+				raise ProcessError("Page size {n} is not valid, expecting at least 1".format(n = page_rows))
+		
+		# in commit mode reuse the plan from report mode if there is one for this artifact
+		if parameters["mode"] == "commit" and "reportbucket" in parameters:
+			with metrics.span("load_plan"):
+				plan = get_plan_from_s3(
+					bucket = parameters["reportbucket"],
+					path = plan_path
+				)
+			if plan:
+				print "Using plan {p}".format(p = plan_path)
+				groups = iter_rechecked_groups(
+					lines = plan[1],
+					env_prefix = parameters["env"],
+					checksums = checksums,
+					concurrency = concurrency,
+					group_records = group_records
+				)
+		
+		if groups is None:
+			groups = iter_compared_groups(
+				entries = iter_zip_files(
+					zip_file = artifact,
+					processes = int(parameters["parsers"]) if "parsers" in parameters else None
+				),
+				env_prefix = parameters["env"],
+				checksums = checksums,
+				ledger = ledger,
+				mode = parameters.get("compare", "batch"),
+				segments = segments,
+				concurrency = concurrency,
+				group_records = group_records
 			)
-			# get URL for report
-			url = get_presigned_url_for_review(
+		
+		# tables are compared and then reported or applied a group at a time, so only one group is held in memory
+		# if mode=report then produce the change report
+		if parameters["mode"] == "report":
+			index_url = get_presigned_url_for_review(
 				bucket = parameters["reportbucket"],
-				path = "{id}/report.html".format(id = job_id),
+				path = get_report_index_path(job_id),
 				expires = 600
 			)
+			# only the schemas, counts and page URLs of the tables are kept for the index
+			reported = {}
+			summary = {}
+			page_urls = {}
+			with open_s3_upload(parameters["reportbucket"], "{id}/plan.ndjson".format(id = job_id), "application/x-ndjson") as change_plan, \
+					open_s3_upload(parameters["reportbucket"], plan_path, "application/x-ndjson") as plan:
+				# save the plan so commit mode does not need to compare again
+				plan.write(codec.dumps(create_plan_header(parameters["env"], artifact_hash)) + "\n")
+				for (tables, unmanaged) in groups:
+					add_record_metrics(tables, parameters["env"])
+					# create the report pages as they are uploaded to the reports bucket
+					with metrics.span("report"):
+						page_urls.update(put_report_pages_in_s3(
+							bucket = parameters["reportbucket"],
+							prefix = job_id,
+							data = tables,
+							env_prefix = parameters["env"],
+							index_url = index_url,
+							unmanaged = unmanaged,
+							page_rows = page_rows,
+							expires = 600,
+							encoding = report_encoding
+						))
+						summary.update(get_report_summary(tables, unmanaged))
+						reported.update((table, TableState(tables[table].schema)) for table in tables)
+					with metrics.span("plan"):
+						# write the changes as NDJSON next to the report for other tools
+						write_fragments(iter_change_plan(tables), change_plan)
+						write_fragments(iter_plan(tables, checksums), plan)
+			with metrics.span("report"):
+				put_report_index_in_s3(
+					bucket = parameters["reportbucket"],
+					prefix = job_id,
+					data = reported,
+					env_prefix = parameters["env"],
+					summary = summary,
+					page_urls = page_urls,
+					encoding = report_encoding
+				)
+			url = index_url
 			# send sns message with URL for review
-			sns.publish(
-				TopicArn=parameters["topic"],
-				Message="""
+			with metrics.span("notify"):
+				sns.publish(
+					TopicArn=parameters["topic"],
+					Message="""
 Please review this report and approve if it can be deployed.  You will have been sent a separate notification asking for that approval.
 
 {url}
-				""".format(url=url)
-			)
+					""".format(url=url)
+				)
 			# tell CP we were successful
 			success = True
 			mark_cp_job_success(
@@ -880,11 +2256,23 @@ Please review this report and approve if it can be deployed.  You will have been
 			
 		# if the mode=commit then we need to make changes to dynamo DB
 		elif parameters["mode"] == "commit":
-			apply_to_dynamo(
-				data = tables,
-				env_prefix = parameters["env"],
-				schema = {}
-			)
+			for (tables, unmanaged) in groups:
+				add_record_metrics(tables, parameters["env"])
+				with metrics.span("apply"):
+					apply_tables_to_dynamo(
+						tables = tables,
+						env_prefix = parameters["env"],
+						mode = parameters.get("writes", "item"),
+						concurrency = concurrency
+					)
+			# record the files which have now been applied
+			if ledger:
+				with metrics.span("ledger"):
+					record_applied_files(
+						checksums = checksums,
+						env_prefix = parameters["env"],
+						ledger = ledger
+					)
 			# tell CP we were successful
 			success = True
 			mark_cp_job_success(
@@ -894,6 +2282,7 @@ Please review this report and approve if it can be deployed.  You will have been
 	except:
 		traceback.print_tb(sys.exc_info()[2])
 		success = True
+		error = str(sys.exc_info()[1])
 		mark_cp_job_failed(
 			message = "Unexpected err: {err}".format(err = sys.exc_info()[1]),
 			job = job_id
@@ -904,6 +2293,11 @@ Please review this report and approve if it can be deployed.  You will have been
 				message = "Hit catch all and failed",
 				job = job_id
 			)
+		if artifact is not None:
+			artifact.close()
+		if profiler:
+			save_profile(profiler, job_id, parameters)
+		emit_metrics(job_id, parameters, error)
 
 def lambda_handler(event, context):
 	"""
@@ -913,7 +2307,19 @@ def lambda_handler(event, context):
 
 if __name__ == "__main__":
 	# entry point for local running
+	parser = argparse.ArgumentParser(description = "Compares a folder of reference data to dynamo DB and writes the change report to stdout")
+	parser.add_argument("folder")
+	parser.add_argument("environment")
+	parser.add_argument("compare_mode", nargs = "?", default = "batch", choices = COMPARE_MODES)
+	parser.add_argument("--concurrency", type = int, default = CONCURRENCY)
+	parser.add_argument("--profile", choices = PROFILES, help = "profile the run and write the results to stderr")
+	parser.add_argument("--profile-top", type = int, default = PROFILE_TOP_N, help = "number of results in the profile")
+	args = parser.parse_args()
 	local_run(
-		folder=sys.argv[1],
-		environment=sys.argv[2]
+		folder=args.folder,
+		environment=args.environment,
+		compare_mode=args.compare_mode,
+		concurrency=args.concurrency,
+		profile=args.profile,
+		profile_top=args.profile_top
 	)
\ No newline at end of file
@@ -0,0 +1,72 @@
+import collections
+import multiprocessing
+
+import codec
+from errors import MalformedTableData
+
+# below this many files starting worker processes costs more than it saves
+PARALLEL_MIN_FILES = 500
+BATCH_SIZE = 200
+
+def parse_file(table, file, text):
+    """
+    Parses the JSON text of table/file, raising MalformedTableData naming the file if it is not valid
+    """
+    try:
+        return codec.loads(text)
+    except ValueError as e:
+        raise MalformedTableData("{t}/{f} is not valid JSON: {e}".format(t=table, f=file, e=e))
+
+def parse_batch(batch):
+    """
+    Parses a list of (table, file name, text) entries, this is what runs in the worker processes
+    """
+    return [(table, file, parse_file(table, file, text)) for (table, file, text) in batch]
+
+def _batches(entries, size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _serial(entries):
+    for (table, file, text) in entries:
+        yield (table, file, parse_file(table, file, text))
+
+def parse_files(entries, count, processes=None, batch_size=BATCH_SIZE, min_files=PARALLEL_MIN_FILES):
+    """
+    Parses a stream of count (table, file name, text) entries, yielding (table, file name, parsed json) in the same order
+
+    Batches of entries are parsed by a pool of processes (one per CPU by default) with a bounded number of batches in
+    flight, so the text is read as the results are used.  Small inputs, or places where a pool cannot be started (AWS
+    Lambda has no /dev/shm), are parsed serially on the calling process.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or count < min_files:
+        return _serial(entries)
+    try:
+        pool = multiprocessing.Pool(processes)
+    except OSError:
+        return _serial(entries)
+    return _parallel(pool, entries, processes, batch_size)
+
+def _parallel(pool, entries, processes, batch_size):
+    try:
+        pending = collections.deque()
+        for batch in _batches(entries, batch_size):
+            pending.append(pool.apply_async(parse_batch, (batch,)))
+            if len(pending) > 2 * processes:
+                for entry in pending.popleft().get():
+                    yield entry
+        while pending:
+            for entry in pending.popleft().get():
+                yield entry
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
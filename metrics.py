@@ -0,0 +1,129 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# how the summary of a run is written, emf also writes CloudWatch embedded metric format documents
+OUTPUTS = ["off", "json", "emf"]
+NAMESPACE = "ReferenceData"
+
+# counters kept for each table and the CloudWatch unit of each
+TABLE_UNITS = collections.OrderedDict([
+    ("requests", "Count"),
+    ("request_seconds", "Seconds"),
+    ("items_read", "Count"),
+    ("items_written", "Count"),
+    ("retries", "Count"),
+    ("throttles", "Count"),
+    ("consumed_read", "Count"),
+    ("consumed_write", "Count")
+])
+
+class Metrics(object):
+    """
+    Collects the time spent in each stage of a run and counters for each table
+
+    Stages are timed with span, which can be used from several threads and adds up the time of each use.  Counters are
+    added to with add.  summary gets what has been collected as a dict and emit writes it as a single JSON line.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets everything collected so far
+        """
+        with self._lock:
+            self.started = self.clock()
+            self.stages = collections.OrderedDict()
+            self.tables = {}
+
+    @contextlib.contextmanager
+    def span(self, stage, items=None):
+        """
+        Times the block inside the with statement as stage, items is a count of what the stage processed if known
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            seconds = self.clock() - start
+            with self._lock:
+                totals = self.stages.setdefault(stage, {"seconds": 0.0, "count": 0})
+                totals["seconds"] += seconds
+                totals["count"] += 1
+                if items is not None:
+                    totals["items"] = totals.get("items", 0) + items
+
+    def add(self, table, counter, value=1):
+        """
+        Adds value to counter for table
+        """
+        with self._lock:
+            counters = self.tables.setdefault(table, collections.Counter())
+            counters[counter] += value
+
+    def summary(self, **fields):
+        """
+        Gets what has been collected as a dict with any other fields given
+        """
+        with self._lock:
+            summary = dict(fields)
+            summary.update({
+                "seconds": round(self.clock() - self.started, 6),
+                "stages": dict((stage, dict(totals, seconds=round(totals["seconds"], 6))) for (stage, totals) in self.stages.items()),
+                "tables": dict((table, dict(
+                    (counter, round(value, 6) if isinstance(value, float) else value) for (counter, value) in counters.items()
+                )) for (table, counters) in self.tables.items())
+            })
+            return summary
+
+    def emf_documents(self, **dimensions):
+        """
+        Gets CloudWatch embedded metric format documents for the stage durations and table counters, with dimensions
+        (for example the environment) added to each
+        """
+        timestamp = int(self.clock() * 1000)
+        names = sorted(dimensions.keys())
+        def document(dimension, value, metrics):
+            values = dict(dimensions)
+            values[dimension] = value
+            values.update((name, amount) for (name, (amount, unit)) in metrics.items())
+            values["_aws"] = {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [names + [dimension]],
+                    "Metrics": [{"Name": name, "Unit": unit} for (name, (amount, unit)) in sorted(metrics.items())]
+                }]
+            }
+            return values
+        summary = self.summary()
+        documents = []
+        for (stage, totals) in sorted(summary["stages"].items()):
+            documents.append(document("Stage", stage, {"Duration": (totals["seconds"], "Seconds")}))
+        for (table, counters) in sorted(summary["tables"].items()):
+            documents.append(document("Table", table, dict(
+                (counter, (value, TABLE_UNITS.get(counter, "Count"))) for (counter, value) in counters.items()
+            )))
+        return documents
+
+    def emit(self, out, output="json", dimensions=None, **fields):
+        """
+        Writes the summary to out as one JSON line with dimensions and fields added, in emf output followed by an
+        embedded metric format document for each stage and table using dimensions (which should be few valued, like the
+        environment, where fields like a job id are not)
+        """
+        if output not in OUTPUTS:
+            raise ValueError("Metrics output {o} is not one of {a}".format(o=output, a=OUTPUTS))
+        if output == "off":
+            return
+        dimensions = dimensions or {}
+        fields.update(dimensions)
+        out.write(json.dumps(self.summary(metrics="summary", **fields), sort_keys=True) + "\n")
+        if output == "emf":
+            for document in self.emf_documents(**dimensions):
+                out.write(json.dumps(document, sort_keys=True) + "\n")
@@ -0,0 +1,104 @@
+import collections
+import cProfile
+import gc
+import pstats
+import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# cpu profiles function calls, mem profiles allocations
+PROFILES = ["cpu", "mem"]
+TOP_N = 30
+# frames kept for each allocation when tracemalloc is available
+TRACEMALLOC_FRAMES = 10
+
+def _type_census():
+    census = collections.Counter()
+    for o in gc.get_objects():
+        census[type(o).__name__] += 1
+    return census
+
+class Profiler(object):
+    """
+    Profiles the code run between start and stop, or inside a with statement
+
+    cpu profiles with cProfile and reports the top functions by cumulative and by own time.  mem reports the top
+    allocation sites from tracemalloc, or where tracemalloc is not available (it is not in python 2) the types whose
+    number of live objects grew the most, found by counting the objects the garbage collector tracks before and after,
+    along with the peak resident memory of the process.
+
+    cProfile only sees the thread which started it, so work done on worker threads is profiled only when the
+    concurrency is 1.
+    """
+    def __init__(self, kind, top=TOP_N):
+        if kind not in PROFILES:
+            raise ValueError("Profile {k} is not one of {p}".format(k=kind, p=PROFILES))
+        self.kind = kind
+        self.top = top
+        self._profile = None
+        self._census = None
+        self._snapshot = None
+
+    def start(self):
+        """
+        Starts profiling
+        """
+        if self.kind == "cpu":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif tracemalloc is not None:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        else:
+            self._census = _type_census()
+        return self
+
+    def stop(self):
+        """
+        Stops profiling, the results are kept for report
+        """
+        if self.kind == "cpu":
+            self._profile.disable()
+        elif tracemalloc is not None:
+            self._snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+        else:
+            after = _type_census()
+            self._census = collections.Counter(dict(
+                (name, count - self._census.get(name, 0)) for (name, count) in after.items()
+            ))
+
+    def report(self):
+        """
+        Gets the results as text
+        """
+        out = StringIO.StringIO()
+        if self.kind == "cpu":
+            for (order, label) in [("cumulative", "cumulative time"), ("tottime", "own time")]:
+                out.write("Top {n} functions by {l}\n".format(n=self.top, l=label))
+                pstats.Stats(self._profile, stream=out).sort_stats(order).print_stats(self.top)
+        elif self._snapshot is not None:
+            out.write("Top {n} allocation sites\n".format(n=self.top))
+            for statistic in self._snapshot.statistics("lineno")[:self.top]:
+                out.write("{s}\n".format(s=statistic))
+        else:
+            out.write("Top {n} types by growth in live objects\n".format(n=self.top))
+            for (name, count) in self._census.most_common(self.top):
+                out.write("{c:+12d} {n}\n".format(c=count, n=name))
+            if resource is not None:
+                out.write("Peak resident memory {m} KB\n".format(m=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        return out.getvalue()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+        return False
@@ -0,0 +1,177 @@
+import threading
+import time
+
+class TokenBucket(object):
+    """
+    A token bucket refilled at rate tokens per second, a rate of None means there is no limit
+
+    Tokens can be taken before they are available, the bucket then goes into debt and later takers wait longer
+    """
+    BURST_SECONDS = 1.0
+
+    def __init__(self, rate=None, clock=time.time):
+        self.clock = clock
+        self.rate = rate
+        self.tokens = rate * self.BURST_SECONDS if rate else 0.0
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        if self.rate:
+            self.tokens = min(self.rate * self.BURST_SECONDS, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        """
+        Changes the refill rate
+        """
+        self._refill()
+        self.rate = rate
+        if rate:
+            self.tokens = min(self.tokens, rate * self.BURST_SECONDS)
+        else:
+            self.tokens = 0.0
+
+    def take(self, tokens):
+        """
+        Takes tokens from the bucket
+
+        Returns how many seconds the caller should wait before using them
+        """
+        self._refill()
+        if not self.rate:
+            return 0.0
+        self.tokens -= tokens
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def give(self, tokens):
+        """
+        Returns tokens to the bucket, or takes more when tokens is negative, without waiting
+        """
+        self._refill()
+        if self.rate:
+            self.tokens = min(self.rate * self.BURST_SECONDS, self.tokens + tokens)
+
+class _Pacer(object):
+    """
+    The bucket and AIMD state for one kind of request on one table
+    """
+    def __init__(self, ceiling, clock):
+        self.ceiling = ceiling
+        self.bucket = TokenBucket(ceiling, clock)
+        self.window_start = clock()
+        self.window_units = 0.0
+        self.observed_rate = None
+        self.last_throttle = None
+        self.last_increase = clock()
+
+class AdaptiveRateLimiter(object):
+    """
+    Paces dynamo DB reads and writes per table using token buckets measured in capacity units
+
+    Throttles cut the rate of the table by DECREASE (multiplicative decrease).  Each INCREASE_INTERVAL seconds without
+    a throttle adds INCREASE_FRACTION of the ceiling, or of the current rate when there is no ceiling, back onto it
+    (additive increase).  The ceiling is the provisioned capacity returned by capacity_lookup(table, kind), or None
+    when it is not known, in which case the rate goes back to being unlimited once it is well above the rate which
+    is being consumed.
+    """
+    DECREASE = 0.5
+    INCREASE_FRACTION = 0.1
+    INCREASE_INTERVAL = 1.0
+    MIN_RATE = 1.0
+
+    def __init__(self, enabled=True, capacity_lookup=None, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.configure(enabled, capacity_lookup)
+
+    def configure(self, enabled, capacity_lookup=None):
+        """
+        Turns the limiter on or off and forgets what it has learnt about each table
+        """
+        with self._lock:
+            self.enabled = enabled
+            self.capacity_lookup = capacity_lookup
+            self._pacers = {}
+
+    def _pacer(self, table, kind):
+        # the capacity lookup is a network call, so it is made without the lock held and the pacer is only installed
+        # if another thread has not installed one for the table while it was made
+        key = (table, kind)
+        with self._lock:
+            pacers = self._pacers
+            lookup = self.capacity_lookup
+            if key in pacers:
+                return pacers[key]
+        ceiling = lookup(table, kind) if lookup else None
+        with self._lock:
+            return pacers.setdefault(key, _Pacer(ceiling or None, self.clock))
+
+    def rate(self, table, kind):
+        """
+        Gets the current rate for table and kind, None means unlimited
+        """
+        pacer = self._pacer(table, kind)
+        with self._lock:
+            return pacer.bucket.rate
+
+    def acquire(self, table, kind, units):
+        """
+        Waits until units of capacity can be used on table for kind ("read" or "write") requests
+        """
+        if not self.enabled:
+            return
+        pacer = self._pacer(table, kind)
+        with self._lock:
+            wait = pacer.bucket.take(units)
+        if wait > 0:
+            self.sleep(wait)
+
+    def consumed(self, table, kind, estimated, units):
+        """
+        Records the units a request really consumed after estimated units were acquired for it
+        """
+        if not self.enabled:
+            return
+        pacer = self._pacer(table, kind)
+        with self._lock:
+            now = self.clock()
+            pacer.bucket.give(estimated - units)
+            pacer.window_units += units
+            if now - pacer.window_start >= 1.0:
+                pacer.observed_rate = pacer.window_units / (now - pacer.window_start)
+                pacer.window_start = now
+                pacer.window_units = 0.0
+            self._increase(pacer, now)
+
+    def throttled(self, table, kind):
+        """
+        Records that a request to table was throttled and cuts its rate
+        """
+        if not self.enabled:
+            return
+        pacer = self._pacer(table, kind)
+        with self._lock:
+            current = pacer.bucket.rate or pacer.observed_rate or pacer.window_units or self.MIN_RATE
+            pacer.bucket.set_rate(max(self.MIN_RATE, current * self.DECREASE))
+            pacer.last_throttle = self.clock()
+
+    def _increase(self, pacer, now):
+        rate = pacer.bucket.rate
+        if not rate:
+            return
+        if now - pacer.last_increase < self.INCREASE_INTERVAL:
+            return
+        if pacer.last_throttle and now - pacer.last_throttle < self.INCREASE_INTERVAL:
+            return
+        pacer.last_increase = now
+        rate += max(self.MIN_RATE, (pacer.ceiling or rate) * self.INCREASE_FRACTION)
+        if pacer.ceiling:
+            rate = min(rate, pacer.ceiling)
+        elif pacer.observed_rate is not None and rate > 2 * pacer.observed_rate:
+            # well above what is being used, so stop limiting
+            rate = None
+        pacer.bucket.set_rate(rate)
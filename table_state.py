@@ -0,0 +1,64 @@
+class TableState(object):
+    """
+    The schema of a table and its records, indexed by the tuple of their key values in schema order
+
+    The names of the files which contributed to each record are kept when they are added with add_file, they are not
+    part of the records so are not compared or written.
+    """
+    def __init__(self, schema, records=None):
+        self.schema = schema
+        self.records = {}
+        self.files = {}
+        for record in records or []:
+            self.put(record)
+
+    def key_of(self, record):
+        """
+        Gets the tuple of key values for a record
+        """
+        return tuple(record[k] for k in self.schema["keys"])
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        """
+        Gets the record with the key tuple, or None
+        """
+        return self.records.get(key)
+
+    def put(self, record):
+        """
+        Adds a record, replacing any record with the same keys
+        """
+        self.records[self.key_of(record)] = record
+
+    def add_file(self, key, file):
+        """
+        Records that file contributed to the record with the key tuple
+        """
+        self.files.setdefault(key, []).append(file)
+
+    def files_of(self, key):
+        """
+        Gets the names of the files which contributed to the record with the key tuple, in the order they were added
+        """
+        return self.files.get(key, [])
+
+    def get_records(self):
+        """
+        Gets a list of the records ordered by their keys
+        """
+        return [self.records[key] for key in sorted(self.records.keys())]
+
+    def __eq__(self, other):
+        return isinstance(other, TableState) and self.schema == other.schema and self.records == other.records
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "TableState(schema={s!r}, records={r!r})".format(s=self.schema, r=self.records)
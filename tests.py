@@ -6,9 +6,36 @@ import shutil
 import os
 import pprint
 from time import sleep
+import threading
+import StringIO
+import decimal
 
 from lambda_function import validate_and_process, read_zip_file, expand_special_values, DATE_NOW, deep_field_compare
-from errors import MalformedTableData
+from lambda_function import create_change_report, get_key_tuple, classify_record, compare_tables_to_dynamo, create_unmanaged_report_entries
+from lambda_function import apply_tables_to_dynamo, get_item_to_write
+from lambda_function import get_consumed_units, load_plan, iter_plan, record_changed_since_plan, iter_body_lines, group_tables
+from lambda_function import get_file_checksum, get_file_checksums, mark_applied_records, get_pending_records
+from lambda_function import iter_zip_files, checksum_files, iter_validated_tables, iter_change_report, write_fragments
+from lambda_function import iter_change_plan, get_record_keys, get_delta_update
+from lambda_function import diff_field, compare_single_record, create_change_report_entry, get_content_hash
+import lambda_function
+from lambda_function import get_report_summary, get_report_pages, get_report_page_path, iter_report_page, iter_report_index
+from errors import MalformedTableData, ProcessError
+from table_state import TableState
+from workers import run_tasks, RequestSlots
+from rate_limiter import TokenBucket, AdaptiveRateLimiter
+from loader import parse_files
+import codec
+import compression
+import gzip
+import uploader
+from update_expression import UpdateExpressionBuilder
+from boto3.dynamodb.types import Binary
+from fake_aws import FakeAWS, make_job_event
+from metrics import Metrics
+from profiling import Profiler
+from clients import ClientRegistry, MAX_CREDENTIAL_SESSIONS, client_config
+import botocore.client
 
 pp = pprint.PrettyPrinter(indent=4)
 
@@ -114,12 +141,10 @@ valid_single_key_schema = """
 """
 
 dict_single_key_schema = {
-	"test": {
-		"_schema": {
-			"table": "test",
-			"keys": ["id1"]
-		}
-	}
+	"test": TableState({
+		"table": "test",
+		"keys": ["id1"]
+	})
 }
 
 valid_create_single_key = """
@@ -133,9 +158,8 @@ valid_create_single_key = """
 """
 
 dict_valid_create_single_key = {
-	"test": {
-		"_schema": dict_single_key_schema["test"]["_schema"],
-		1: {
+	"test": TableState(dict_single_key_schema["test"].schema, [
+		{
 			"id1": 1,
 			"val1": "test",
 			"_meta": {
@@ -144,7 +168,7 @@ dict_valid_create_single_key = {
 				"timestamp": DATE_NOW
 			}
 		}
-	}
+	])
 }
 
 create_missing_key = """
@@ -167,69 +191,58 @@ valid_dual_key_schema = """
 """
 
 dict_dual_key_schema = {
-	"test": {
-		"_schema": {
-			"table": "test",
-			"keys": ["id1", "id2"]
-		}
-	}
+	"test": TableState({
+		"table": "test",
+		"keys": ["id1", "id2"]
+	})
 }
 
 dict_valid_update = {
-	"test": {
-		"_schema": dict_dual_key_schema["test"]["_schema"],
-		1: {
-			2: {
-				"id1": 1,
-				"id2": 2,
-				"val1": 2,
-				"val2": "testing2",
-				"val3": False,
-				"_meta": {
-					"action": "update",
-					"ref_file": "002_update.json",
-					"timestamp": DATE_NOW
-				}
+	"test": TableState(dict_dual_key_schema["test"].schema, [
+		{
+			"id1": 1,
+			"id2": 2,
+			"val1": 2,
+			"val2": "testing2",
+			"val3": False,
+			"_meta": {
+				"action": "update",
+				"ref_file": "002_update.json",
+				"timestamp": DATE_NOW
 			}
 		}
-	}
+	])
 }
 
 dict_valid_update_single_col = {
-	"test": {
-		"_schema": dict_dual_key_schema["test"]["_schema"],
-		1: {
-			2: {
-				"id1": 1,
-				"id2": 2,
-				"val1": 100,
-				"val2": "testing",
-				"val3": True,
-				"_meta": {
-					"action": "update",
-					"ref_file": "002_update.json",
-					"timestamp": DATE_NOW
-				}
+	"test": TableState(dict_dual_key_schema["test"].schema, [
+		{
+			"id1": 1,
+			"id2": 2,
+			"val1": 100,
+			"val2": "testing",
+			"val3": True,
+			"_meta": {
+				"action": "update",
+				"ref_file": "002_update.json",
+				"timestamp": DATE_NOW
 			}
 		}
-	}
+	])
 }
 
 dict_valid_delete = {
-	"test": {
-		"_schema": dict_dual_key_schema["test"]["_schema"],
-		1: {
-			2: {
-				"id1": 1,
-				"id2": 2,
-				"_meta": {
-					"action": "delete",
-					"ref_file": "002_delete.json",
-					"timestamp": DATE_NOW
-				}
+	"test": TableState(dict_dual_key_schema["test"].schema, [
+		{
+			"id1": 1,
+			"id2": 2,
+			"_meta": {
+				"action": "delete",
+				"ref_file": "002_delete.json",
+				"timestamp": DATE_NOW
 			}
 		}
-	}
+	])
 }
 
 valid_create_dual_key = """
@@ -244,21 +257,18 @@ valid_create_dual_key = """
 """
 
 dict_valid_create_dual_key = {
-	"test": {
-		"_schema": dict_dual_key_schema["test"]["_schema"],
-		1: {
-			2: {
-				"id1": 1,
-				"id2": 2,
-				"val1": "test",
-				"_meta": {
-					"action": "create",
-					"ref_file": "001_create.json",
-					"timestamp": DATE_NOW
-				}
+	"test": TableState(dict_dual_key_schema["test"].schema, [
+		{
+			"id1": 1,
+			"id2": 2,
+			"val1": "test",
+			"_meta": {
+				"action": "create",
+				"ref_file": "001_create.json",
+				"timestamp": DATE_NOW
 			}
 		}
-	}
+	])
 }
 
 valid_create_dual_nested_key = """
@@ -273,31 +283,28 @@ valid_create_dual_nested_key = """
 """
 
 dict_valid_create_nested_key = {
-	"test": {
-		"_schema": dict_dual_key_schema["test"]["_schema"],
-		1: {
-			2: {
-				"id1": 1,
-				"id2": 2,
-				"val1": "test",
-				"_meta": {
-					"action": "create",
-					"ref_file": "001_create.json",
-					"timestamp": DATE_NOW
-				}
-			},
-			3: {
-				"id1": 1,
-				"id2": 3,
-				"val1": "test",
-				"_meta": {
-					"action": "create",
-					"ref_file": "002_create.json",
-					"timestamp": DATE_NOW
-				}
+	"test": TableState(dict_dual_key_schema["test"].schema, [
+		{
+			"id1": 1,
+			"id2": 2,
+			"val1": "test",
+			"_meta": {
+				"action": "create",
+				"ref_file": "001_create.json",
+				"timestamp": DATE_NOW
+			}
+		},
+		{
+			"id1": 1,
+			"id2": 3,
+			"val1": "test",
+			"_meta": {
+				"action": "create",
+				"ref_file": "002_create.json",
+				"timestamp": DATE_NOW
 			}
 		}
-	}
+	])
 }
 
 valid_update_dual_nested_key = """
@@ -312,31 +319,28 @@ valid_update_dual_nested_key = """
 """
 
 dict_valid_update_nested_key = {
-	"test": {
-		"_schema": dict_dual_key_schema["test"]["_schema"],
-		1: {
-			2: {
-				"id1": 1,
-				"id2": 2,
-				"val1": "test",
-				"_meta": {
-					"action": "create",
-					"ref_file": "001_create.json",
-					"timestamp": DATE_NOW
-				}
-			},
-			3: {
-				"id1": 1,
-				"id2": 3,
-				"val1": "testing",
-				"_meta": {
-					"action": "update",
-					"ref_file": "003_update.json",
-					"timestamp": DATE_NOW
-				}
+	"test": TableState(dict_dual_key_schema["test"].schema, [
+		{
+			"id1": 1,
+			"id2": 2,
+			"val1": "test",
+			"_meta": {
+				"action": "create",
+				"ref_file": "001_create.json",
+				"timestamp": DATE_NOW
+			}
+		},
+		{
+			"id1": 1,
+			"id2": 3,
+			"val1": "testing",
+			"_meta": {
+				"action": "update",
+				"ref_file": "003_update.json",
+				"timestamp": DATE_NOW
 			}
 		}
-	}
+	])
 }
 
 invalid_schema_missing_id = """
@@ -643,6 +647,345 @@ class TestZipExtractor(unittest.TestCase):
 			self.assertDictEqual(read_zip_file(tmp_archive), self.complete_dict)
 		finally:
 			shutil.rmtree(temp_dir)
+	
+	def test_streamed_zip_matches_dictionary(self):
+		"""
+		Tests that validating a zip file as it is read gives the same tables and checksums as reading it all first
+		"""
+		archive = StringIO.StringIO()
+		zf = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+		zf.writestr("test2/001_create.json", valid_create_dual_key)
+		zf.writestr("test/", "")
+		zf.writestr("test/001_create.json", valid_create_dual_key)
+		zf.writestr("test/000_schema.json", valid_dual_key_schema)
+		zf.writestr("test2/000_schema.json", valid_dual_key_schema.replace('"test"', '"test2"'))
+		zf.close()
+		archive.seek(0)
+		checksums = {}
+		tables = dict(iter_validated_tables(checksum_files(iter_zip_files(archive), checksums)))
+		archive.seek(0)
+		raw = read_zip_file(archive)
+		self.assertEqual(checksums, get_file_checksums(raw))
+		self.assertEqual(tables, validate_and_process(raw))
+		self.assertEqual(sorted(tables.keys()), ["test", "test2"])
+
+class TestLoader(unittest.TestCase):
+	def setUp(self):
+		self.entries = [("t{n}".format(n=n / 10), "{n:03d}.json".format(n=n), json.dumps({"n": n})) for n in range(50)]
+	
+	def test_parallel_parse_keeps_order(self):
+		"""
+		Tests that files parsed across a process pool come back in the order they were given
+		"""
+		serial = list(parse_files(self.entries, len(self.entries), processes = 1))
+		parallel = list(parse_files(iter(self.entries), len(self.entries), processes = 2, batch_size = 3, min_files = 0))
+		self.assertEqual(parallel, serial)
+		self.assertEqual([entry[2]["n"] for entry in parallel], range(50))
+	
+	def test_bad_json_names_file(self):
+		"""
+		Tests that invalid JSON is reported against its table and file whether parsed serially or in parallel
+		"""
+		self.entries[17] = ("t1", "017.json", "{not json")
+		for processes in [1, 2]:
+			with self.assertRaisesRegexp(MalformedTableData, "t1/017.json"):
+				list(parse_files(self.entries, len(self.entries), processes = processes, batch_size = 4, min_files = 0))
+
+class TestCodec(unittest.TestCase):
+	def setUp(self):
+		self.text = '{"id1": 1, "price": 1.10, "tiny": 1e-7, "nested": {"list": [2.5, "x"]}}'
+	
+	def test_numbers_parse_to_decimal(self):
+		"""
+		Tests that fractional numbers are parsed as Decimal and whole numbers stay as int
+		"""
+		data = codec.loads(self.text)
+		self.assertEqual(data["id1"], 1)
+		self.assertIsInstance(data["id1"], int)
+		self.assertEqual(data["price"], decimal.Decimal("1.10"))
+		self.assertEqual(data["tiny"], decimal.Decimal("1e-7"))
+		self.assertEqual(data["nested"]["list"][0], decimal.Decimal("2.5"))
+	
+	def test_dumps_matches_stdlib(self):
+		"""
+		Tests that output is laid out as json.dumps lays out the same data
+		"""
+		for kwargs in [{}, {"indent": 2, "sort_keys": True}, {"sort_keys": True, "separators": (",", ":")}]:
+			text = json.dumps(json.loads(self.text), **kwargs).replace("1.1,", "1.10,").replace("1e-07", "1E-7")
+			self.assertEqual(codec.dumps(codec.loads(self.text), **kwargs), text)
+	
+	def test_dumps_exact_decimals(self):
+		"""
+		Tests that Decimals are written with their exact digits by either backend
+		"""
+		data = {"pi": decimal.Decimal("3.14159265358979323846"), "values": [decimal.Decimal("1.00000000000000001"), 1.5, 2]}
+		for backend in codec.BACKENDS if codec.simplejson else ["json"]:
+			text = codec.Codec(backend).dumps(data, sort_keys=True)
+			self.assertEqual(text, '{"pi": 3.14159265358979323846, "values": [1.00000000000000001, 1.5, 2]}')
+			self.assertEqual(codec.loads(text), data)
+	
+	@unittest.skipIf(codec.simplejson is None, "simplejson is not installed")
+	def test_backends_agree(self):
+		"""
+		Tests that the simplejson backend reads and writes the same as the stdlib backend
+		"""
+		stdlib = codec.Codec("json")
+		fast = codec.Codec("simplejson")
+		self.assertEqual(fast.loads(self.text), stdlib.loads(self.text))
+		for kwargs in [{}, {"indent": 2, "sort_keys": True}, {"sort_keys": True, "separators": (",", ":")}]:
+			self.assertEqual(fast.dumps(fast.loads(self.text), **kwargs), stdlib.dumps(stdlib.loads(self.text), **kwargs))
+	
+	def test_dumps_without_python_encoder(self):
+		"""
+		Tests that the stdlib backend still writes Decimals exactly, laid out the same, when json's private python
+		encoder is missing or cannot be called as expected
+		"""
+		data = codec.loads(self.text)
+		data.update({"pi": decimal.Decimal("3.14159265358979323846"), "tags": set(["b", "a"]), "text": u"caf\xe9"})
+		stdlib = codec.Codec("json")
+		kwargs_list = [{}, {"indent": 2, "sort_keys": True}, {"sort_keys": True, "separators": (",", ":")}, {"ensure_ascii": False}]
+		expected = [stdlib.dumps(data, **kwargs) for kwargs in kwargs_list]
+		make_iterencode = codec._make_iterencode
+		try:
+			for replacement in [None, lambda markers, default: None]:
+				codec._make_iterencode = replacement
+				self.assertEqual([stdlib.dumps(data, **kwargs) for kwargs in kwargs_list], expected)
+		finally:
+			codec._make_iterencode = make_iterencode
+	
+	def test_invalid_backend(self):
+		"""
+		Tests that an unknown backend is rejected
+		"""
+		self.assertRaises(ValueError, codec.Codec, "yaml")
+	
+	def test_sets_and_binary(self):
+		"""
+		Tests that sets and binary values read from dynamo DB are written as sorted lists and base64 strings
+		"""
+		data = {"tags": set(["b", "a"]), "blob": Binary("\x00\x01"), "blobs": set([Binary("\x02"), Binary("\x01")])}
+		for backend in codec.BACKENDS if codec.simplejson else ["json"]:
+			self.assertEqual(json.loads(codec.Codec(backend).dumps(data)), {"tags": ["a", "b"], "blob": "AAE=", "blobs": ["AQ==", "Ag=="]})
+
+class TestReportPages(unittest.TestCase):
+	def setUp(self):
+		self.schema = {"table": "test", "keys": ["id1"]}
+		changed = []
+		for n in range(5):
+			changed.append({"id1": n, "_meta": {"action": "create"}, "_compare_result": {"state": "does_not_exist", "action": "create"}})
+		changed.append({"id1": 5, "_meta": {"action": "create"}, "_compare_result": {"state": "exists", "action": "none"}})
+		unchanged = [{"id1": n, "_meta": {"action": "create"}, "_compare_result": {"state": "exists", "action": "none"}} for n in range(3)]
+		self.tables = {
+			"changed": TableState(self.schema, changed),
+			"unchanged": TableState({"table": "unchanged", "keys": ["id1"]}, unchanged)
+		}
+		self.unmanaged = {"changed": [{"id1": 9}], "unchanged": []}
+	
+	def test_summary_counts(self):
+		"""
+		Tests that the summary counts rows by the action which will be performed
+		"""
+		summary = get_report_summary(self.tables, self.unmanaged)
+		self.assertDictEqual(summary["changed"], {"create": 5, "update": 0, "delete": 0, "none": 1, "unmanaged": 1})
+		self.assertDictEqual(summary["unchanged"], {"create": 0, "update": 0, "delete": 0, "none": 3, "unmanaged": 0})
+	
+	def test_pages_split_rows(self):
+		"""
+		Tests that rows are split into pages of the requested size with unmanaged rows last
+		"""
+		pages = get_report_pages(self.tables, self.unmanaged, page_rows = 4)
+		self.assertEqual([(page["table"], page["number"], page["count"]) for page in pages], [("changed", 1, 2), ("changed", 2, 2)])
+		self.assertEqual([record["id1"] for record in pages[1]["records"]], [4, 5])
+		self.assertEqual(pages[1]["unmanaged"], [{"id1": 9}])
+		self.assertEqual(get_report_page_path("job", pages[1]), "job/changed/page-0002.html")
+	
+	def test_unchanged_table_collapsed(self):
+		"""
+		Tests that a table where every row has no action gets no pages and is summarised in the index
+		"""
+		pages = get_report_pages(self.tables, self.unmanaged, page_rows = 4)
+		self.assertNotIn("unchanged", [page["table"] for page in pages])
+		index = "".join(iter_report_index(self.tables, "dev", get_report_summary(self.tables, self.unmanaged), {"changed": ["https://a?x=1&y=2", "https://b"]}))
+		self.assertIn("<tr><td>unchanged</td><td>0</td><td>0</td><td>0</td><td>3</td><td>0</td><td><p>No changes</p></td></tr>", index)
+		self.assertIn("<a href=\"https://a?x=1&amp;y=2\">1</a> <a href=\"https://b\">2</a> ", index)
+	
+	def test_page_shows_table_total_unmanaged(self):
+		"""
+		Tests that a page shows its rows and the total number of unmanaged rows for the table
+		"""
+		page = get_report_pages(self.tables, self.unmanaged, page_rows = 4)[1]
+		html = "".join(iter_report_page(page, self.tables, "dev", self.unmanaged, "https://index"))
+		self.assertIn("<p>Page 2 of 2</p>", html)
+		self.assertIn("<h3>Unmanaged rows: 1</h3>", html)
+		self.assertIn("<a href=\"https://index\">Back to index</a>", html)
+		self.assertEqual(html.count("<td><p class=\"label\">"), 2)
+
+class TestCompression(unittest.TestCase):
+	def setUp(self):
+		self.html = "<tr><td><p class=\"label none\">none</p></td></tr>" * 1000
+	
+	def compress(self, encoding):
+		out = StringIO.StringIO()
+		writer = compression.open_writer(out, encoding)
+		write_fragments([self.html[:100], self.html[100:]], writer)
+		writer.close()
+		return out.getvalue()
+	
+	def test_gzip_round_trip(self):
+		"""
+		Tests that gzipped output decompresses to what was written and is much smaller
+		"""
+		data = self.compress("gzip")
+		self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(data)).read(), self.html)
+		self.assertLess(len(data) * 10, len(self.html))
+	
+	@unittest.skipIf(compression.brotli is None, "brotli is not installed")
+	def test_brotli_round_trip(self):
+		"""
+		Tests that brotli output decompresses to what was written
+		"""
+		self.assertEqual(compression.brotli.decompress(self.compress("br")), self.html)
+	
+	def test_identity(self):
+		"""
+		Tests that the identity encoding writes the data unchanged
+		"""
+		self.assertEqual(self.compress("identity"), self.html)
+	
+	def test_invalid_encoding(self):
+		"""
+		Tests that an unknown encoding is rejected
+		"""
+		self.assertRaises(ValueError, compression.open_writer, StringIO.StringIO(), "zip")
+
+class FakeS3(object):
+	"""
+	Records the calls an uploader makes, failing upload_part for the part number in fail_part
+	"""
+	def __init__(self, fail_part = None):
+		self.fail_part = fail_part
+		self.calls = []
+		self.parts = {}
+		self.lock = threading.Lock()
+	
+	def record(self, name, kwargs):
+		with self.lock:
+			self.calls.append((name, kwargs))
+	
+	def put_object(self, **kwargs):
+		self.record("put_object", kwargs)
+	
+	def create_multipart_upload(self, **kwargs):
+		self.record("create_multipart_upload", kwargs)
+		return {"UploadId": "upload"}
+	
+	def upload_part(self, **kwargs):
+		if kwargs["PartNumber"] == self.fail_part:
+			raise ProcessError("part failed")
+		self.parts[kwargs["PartNumber"]] = kwargs["Body"]
+		self.record("upload_part", {"PartNumber": kwargs["PartNumber"]})
+		return {"ETag": "etag{n}".format(n=kwargs["PartNumber"])}
+	
+	def complete_multipart_upload(self, **kwargs):
+		self.record("complete_multipart_upload", kwargs)
+	
+	def abort_multipart_upload(self, **kwargs):
+		self.record("abort_multipart_upload", kwargs)
+	
+	def names(self):
+		return [name for (name, kwargs) in self.calls]
+
+class TestUploader(unittest.TestCase):
+	def setUp(self):
+		self.block = "x" * (1024 * 1024)
+	
+	def test_small_object_single_put(self):
+		"""
+		Tests that an object smaller than a part is uploaded with one put_object
+		"""
+		client = FakeS3()
+		with uploader.MultipartUploader(client, "bucket", "key", ContentType = "text/html") as upload:
+			upload.write("abc")
+			upload.write("def")
+		self.assertEqual(client.names(), ["put_object"])
+		self.assertEqual(client.calls[0][1]["Body"], "abcdef")
+		self.assertEqual(client.calls[0][1]["ContentType"], "text/html")
+	
+	def test_large_object_in_parts(self):
+		"""
+		Tests that a large object is uploaded in ordered parts and the upload is completed
+		"""
+		client = FakeS3()
+		with uploader.MultipartUploader(client, "bucket", "key", part_size = uploader.MIN_PART_SIZE, concurrency = 2) as upload:
+			for n in range(12):
+				upload.write(self.block)
+		self.assertEqual(client.names()[0], "create_multipart_upload")
+		self.assertEqual(client.names()[-1], "complete_multipart_upload")
+		self.assertEqual([len(client.parts[n]) for n in sorted(client.parts)], [5 * len(self.block), 5 * len(self.block), 2 * len(self.block)])
+		self.assertEqual(client.calls[-1][1]["MultipartUpload"]["Parts"], [{"PartNumber": n, "ETag": "etag{n}".format(n=n)} for n in [1, 2, 3]])
+	
+	def test_failed_part_aborts(self):
+		"""
+		Tests that the upload is aborted and the error raised when a part fails
+		"""
+		client = FakeS3(fail_part = 2)
+		with self.assertRaisesRegexp(ProcessError, "part failed"):
+			with uploader.MultipartUploader(client, "bucket", "key", part_size = uploader.MIN_PART_SIZE) as upload:
+				for n in range(12):
+					upload.write(self.block)
+		self.assertEqual(client.names()[-1], "abort_multipart_upload")
+		self.assertNotIn("complete_multipart_upload", client.names())
+	
+	def test_error_while_writing_aborts(self):
+		"""
+		Tests that an error raised by the writer aborts the upload
+		"""
+		client = FakeS3()
+		with self.assertRaises(KeyError):
+			with uploader.MultipartUploader(client, "bucket", "key", part_size = uploader.MIN_PART_SIZE) as upload:
+				for n in range(6):
+					upload.write(self.block)
+				raise KeyError("writer failed")
+		self.assertEqual(client.names()[-1], "abort_multipart_upload")
+
+class TestUpdateExpression(unittest.TestCase):
+	def test_nested_paths(self):
+		"""
+		Tests that nested map and list paths use name placeholders, reusing them for repeated names
+		"""
+		update = UpdateExpressionBuilder()
+		update.set(("address", "lines", 0), "1 Main St").set(("address", "post code"), "2000").remove(("tags", 3))
+		self.assertDictEqual(update.build(), {
+			"UpdateExpression": "SET #n0.#n1[0] = :v0, #n0.#n2 = :v1 REMOVE #n3[3]",
+			"ExpressionAttributeNames": {"#n0": "address", "#n1": "lines", "#n2": "post code", "#n3": "tags"},
+			"ExpressionAttributeValues": {":v0": "1 Main St", ":v1": "2000"}
+		})
+	
+	def test_remove_only(self):
+		"""
+		Tests that an update which only removes has no attribute values
+		"""
+		self.assertDictEqual(UpdateExpressionBuilder().remove(("a",)).build(), {
+			"UpdateExpression": "REMOVE #n0",
+			"ExpressionAttributeNames": {"#n0": "a"}
+		})
+	
+	def test_path_must_start_with_name(self):
+		"""
+		Tests that a path starting with a list index is rejected
+		"""
+		self.assertRaises(ValueError, UpdateExpressionBuilder().set, (0, "a"), 1)
+	
+	def test_delta_update(self):
+		"""
+		Tests that a compare delta is compiled into SET and REMOVE clauses with the meta data set
+		"""
+		delta = {"new": {"b": 2}, "changed": {"a": {"current": 1, "new": 3}}, "removed": {"c": ""}}
+		self.assertDictEqual(get_delta_update(delta, {"action": "update"}), {
+			"UpdateExpression": "SET #n0 = :v0, #n1 = :v1, #n3 = :v2 REMOVE #n2",
+			"ExpressionAttributeNames": {"#n0": "b", "#n1": "a", "#n2": "c", "#n3": "_meta"},
+			"ExpressionAttributeValues": {":v0": 2, ":v1": 3, ":v2": {"action": "update"}}
+		})
 
 class TestSchema(unittest.TestCase):
 	def setUp(self):
@@ -1076,7 +1419,1021 @@ class TestMisc(unittest.TestCase):
 		Tests that deep compare works for a list of dict with with changes
 		"""
 		self.assertFalse(deep_field_compare(dict_list_compare_with_changes_new, dict_list_compare_with_changes_current))
+	
+	def test_diff_field_dict_list_with_changes(self):
+		"""
+		Tests that the diff of a list of dicts only has the leaf which changed, with DT changes beside it kept
+		"""
+		edits = sorted(diff_field(dict_list_compare_with_changes_new, dict_list_compare_with_changes_current), key = lambda edit: edit["path"])
+		self.assertEqual(edits, [
+			{"path": [0, "dt_Created"], "op": "changed", "current": "blah", "new": "blah1"},
+			{"path": [0, "dt_Modified"], "op": "changed", "current": "blah", "new": "blah1"},
+			{"path": [0, "field2"], "op": "changed", "current": "test1", "new": "test2"}
+		])
+	
+	def test_diff_field_added_and_removed(self):
+		"""
+		Tests that added and removed map keys and list elements are found
+		"""
+		current = {"a": {"x": 1, "y": 2}, "b": [1, 2, 3]}
+		new = {"a": {"x": 1, "z": 3}, "b": [1, 5]}
+		edits = sorted(diff_field(new, current), key = lambda edit: edit["path"])
+		self.assertEqual(edits, [
+			{"path": ["a", "y"], "op": "removed", "current": 2},
+			{"path": ["a", "z"], "op": "added", "new": 3},
+			{"path": ["b", 1], "op": "changed", "current": 2, "new": 5},
+			{"path": ["b", 2], "op": "removed", "current": 3}
+		])
+	
+	def test_compare_nested_change(self):
+		"""
+		Tests that a change inside a map is reported as edits, applied by path and shown by path in the report
+		"""
+		current = {"id1": 1, "doc": {"big": "x" * 100, "small": 1}, "val": "a"}
+		new = {"id1": 1, "doc": {"big": "x" * 100, "small": 2}, "val": "b", "_meta": {"action": "update"}}
+		delta = compare_single_record(new, current, ["id1"])
+		self.assertEqual(delta["changed"], {
+			"doc": {"edits": [{"path": ["small"], "op": "changed", "current": 1, "new": 2}]},
+			"val": {"current": "a", "new": "b"}
+		})
+		update = get_delta_update(delta, {"action": "update"})
+		self.assertEqual(update["UpdateExpression"], "SET #n0.#n1 = :v0, #n2 = :v1, #n3 = :v2")
+		self.assertNotIn("x" * 100, json.dumps(update))
+		new["_compare_result"] = {"state": "exists", "action": "update", "delta": delta}
+		self.assertIn("<tr><td>doc.small</td><td>1</td><td>2</td></tr>", create_change_report_entry(new, {"keys": ["id1"]}))
 		
-			
+
+class TestCompare(unittest.TestCase):
+	def setUp(self):
+		self.maxDiff = None
+		self.schema = dict_dual_key_schema["test"].schema
+	
+	def test_get_records(self):
+		"""
+		Tests that all the records in a table are returned in key order
+		"""
+		records = dict_valid_create_nested_key["test"].get_records()
+		self.assertEqual([get_key_tuple(r, self.schema["keys"]) for r in records], [(1, 2), (1, 3)])
+	
+	def test_underscore_key_value(self):
+		"""
+		Tests that records with key values starting with _ are compared and reported
+		"""
+		tables = validate_and_process({
+			"test": {
+				"000_schema.json": json.loads(valid_single_key_schema),
+				"001_create.json": {"action": "create", "data": {"id1": "_hidden", "val1": "test"}}
+			}
+		})
+		self.assertEqual(len(get_pending_records(tables["test"])), 1)
+		classify_record(tables["test"].get(("_hidden",)), None, tables["test"].schema)
+		self.assertIn("<td>_hidden</td>", create_change_report(tables, "dev"))
+	
+	def test_classify_create_not_existing(self):
+		"""
+		Tests that a create for an item which is not in dynamo is a create
+		"""
+		record = {"id1": 1, "id2": 2, "_meta": {"action": "create"}}
+		classify_record(record, None, self.schema)
+		self.assertDictEqual(record["_compare_result"], {"state": "does_not_exist", "action": "create", "observed": None})
+	
+	def test_classify_update_no_changes(self):
+		"""
+		Tests that an update matching the item in dynamo results in no action
+		"""
+		record = {"id1": 1, "id2": 2, "val1": "a", "_meta": {"action": "update"}}
+		classify_record(record, {"id1": 1, "id2": 2, "val1": "a"}, self.schema)
+		self.assertEqual(record["_compare_result"]["action"], "none")
+		self.assertEqual(record["_compare_result"]["state"], "exists_no_changes")
+	
+	def test_classify_update_with_changes(self):
+		"""
+		Tests that an update differing from the item in dynamo results in an update
+		"""
+		record = {"id1": 1, "id2": 2, "val1": "b", "_meta": {"action": "update"}}
+		classify_record(record, {"id1": 1, "id2": 2, "val1": "a"}, self.schema)
+		self.assertEqual(record["_compare_result"]["action"], "update")
+		self.assertDictEqual(record["_compare_result"]["delta"]["changed"], {"val1": {"current": "a", "new": "b"}})
+	
+	def test_classify_delete_not_existing(self):
+		"""
+		Tests that a delete for an item which is not in dynamo results in no action
+		"""
+		record = {"id1": 1, "id2": 2, "_meta": {"action": "delete"}}
+		classify_record(record, None, self.schema)
+		self.assertDictEqual(record["_compare_result"], {"state": "does_not_exist", "action": "none", "observed": None})
+	
+	def test_invalid_compare_mode(self):
+		"""
+		Tests for valid exception when the compare mode is not known
+		"""
+		with self.assertRaisesRegexp(ProcessError, "Compare mode blah is not valid"):
+			compare_tables_to_dynamo(dict_valid_create_dual_key, "dev", mode = "blah")
+	
+	def test_unmanaged_report_entries(self):
+		"""
+		Tests that unmanaged rows are shown with their keys and remaining fields
+		"""
+		entries = create_unmanaged_report_entries([{"id1": 5, "id2": 6, "val1": "x"}], self.schema)
+		self.assertEqual(entries, ["<tr><td>5</td><td>6</td><td><pre>{\n  \"val1\": \"x\"\n}</pre></td></tr>"])
+	
+	def test_streamed_report_matches_string(self):
+		"""
+		Tests that the streamed report is byte for byte the HTML the string report gave before it was streamed, for
+		create, update, delete and no action rows and unmanaged rows
+		"""
+		tables = validate_and_process({
+			"test": {
+				"000_schema.json": {"table": "test", "keys": ["id1", "id2"]},
+				"001_create.json": {"action": "create", "data": {"id1": 1, "id2": 1, "val1": "a", "val2": {"nested": [1, 2]}}},
+				"002_create.json": {"action": "create", "data": {"id1": 1, "id2": 2, "val1": "b"}},
+				"003_create.json": {"action": "create", "data": {"id1": 1, "id2": 3, "val1": "c"}},
+				"004_create.json": {"action": "create", "data": {"id1": 1, "id2": 4, "val1": "d"}},
+				"005_update.json": {"action": "update", "data": {"id1": 1, "id2": 3, "val1": "new", "val3": [1, 2]}},
+				"006_delete.json": {"action": "delete", "data": {"id1": 1, "id2": 4}}
+			}
+		})
+		items = {
+			(1, 2): {"id1": 1, "id2": 2, "val1": "b"},
+			(1, 3): {"id1": 1, "id2": 3, "val1": "c", "val2": {"gone": True}},
+			(1, 4): {"id1": 1, "id2": 4, "val1": "d"}
+		}
+		for record in tables["test"].get_records():
+			classify_record(record, items.get((record["id1"], record["id2"])), tables["test"].schema)
+		out = StringIO.StringIO()
+		write_fragments(iter_change_report(tables, "dev", {"test": [{"id1": 5, "id2": 6, "val1": "x"}]}), out)
+		expected = (
+			"<html><head><title>Delta Report</title><style>{style}</style></head><body>".format(style = lambda_function.stylesheet) +
+			"<h1>DynamoDB Ref Data delta report</h1><h2>Environment: dev</h2><h2>Table: test</h2>"
+			"<table class=\"TableTable\"><tr><th class=\"fixed_width\">id1</th><th class=\"fixed_width\">id2</th>"
+			"<th class=\"fixed_width\">Requested action</th><th class=\"fixed_width\">Action which will be performed</th>"
+			"<th class=\"fixed_width\">Reason</th><th class=\"take_up_space\">Row data</th></tr>"
+			"<tr><td>1</td><td>1</td><td><p class=\"label create\">create</p></td><td><p class=\"label create\">create</p></td>"
+			"<td><p class=\"label\">does_not_exist</p></td><td><table class=\"ResultsTable\"><tr><th>Field</th><th>Value</th></tr>"
+			"<tr><td>val2</td><td><pre>{\n  \"nested\": [\n    1, \n    2\n  ]\n}</pre></td></tr><tr><td>val1</td><td>a</td></tr>"
+			"<tr><td>id2</td><td>1</td></tr><tr><td>id1</td><td>1</td></tr></table></td></tr>"
+			"<tr><td>1</td><td>2</td><td><p class=\"label create\">create</p></td><td><p class=\"label none\">none</p></td>"
+			"<td><p class=\"label\">exists</p></td><td>n/a</td></tr>"
+			"<tr><td>1</td><td>3</td><td><p class=\"label update\">update</p></td><td><p class=\"label update\">update</p></td>"
+			"<td><p class=\"label\">exists</p></td><td class=\"row_data\"><p>New Fields</p><table class=\"ResultsTable\">"
+			"<tr><th>Field</th><th>Value</th></tr><tr><td>val3</td><td><pre>[\n  1, \n  2\n]</pre></td></tr></table>"
+			"<p>Changed Fields</p><table class=\"ResultsTable\"><tr><th>Field</th><th>Current Value</th><th>New Value</th></tr>"
+			"<tr><td>val1</td><td>c</td><td>new</td></tr></table><p>No removed fields</p></td></tr>"
+			"<tr><td>1</td><td>4</td><td><p class=\"label delete\">delete</p></td><td><p class=\"label delete\">delete</p></td>"
+			"<td><p class=\"label\">exists</p></td><td>n/a</td></tr></table>"
+			"<h3>Unmanaged rows: 1</h3><table class=\"TableTable\"><tr><th class=\"fixed_width\">id1</th>"
+			"<th class=\"fixed_width\">id2</th><th class=\"take_up_space\">Row data</th></tr>"
+			"<tr><td>5</td><td>6</td><td><pre>{\n  \"val1\": \"x\"\n}</pre></td></tr></table></body></html>"
+		)
+		self.assertEqual(out.getvalue(), expected)
+	
+	def test_change_plan_lines(self):
+		"""
+		Tests that the change plan has one line of JSON for each compared record
+		"""
+		tables = validate_and_process({
+			"test": {
+				"000_schema.json": json.loads(valid_dual_key_schema),
+				"001_create.json": json.loads(valid_create_dual_key),
+				"002_create.json": json.loads(valid_create_dual_nested_key)
+			}
+		})
+		records = tables["test"].get_records()
+		classify_record(records[0], None, tables["test"].schema)
+		lines = list(iter_change_plan(tables))
+		self.assertEqual(len(lines), 1)
+		self.assertTrue(lines[0].endswith("\n"))
+		self.assertDictEqual(json.loads(lines[0]), {
+			"table": "test",
+			"keys": get_record_keys(records[0], ["id1", "id2"]),
+			"requested": "create",
+			"action": "create",
+			"state": "does_not_exist",
+			"ref_file": records[0]["_meta"]["ref_file"]
+		})
+	
+	def test_invalid_write_mode(self):
+		"""
+		Tests for valid exception when the write mode is not known
+		"""
+		with self.assertRaisesRegexp(ProcessError, "Write mode blah is not valid"):
+			apply_tables_to_dynamo(dict_valid_create_dual_key, "dev", mode = "blah")
+	
+	def test_item_to_write(self):
+		"""
+		Tests that the compare and apply results are not written to dynamo
+		"""
+		record = {"id1": 1, "_meta": {"action": "create"}, "_compare_result": {"action": "create"}, "_result": "completed"}
+		self.assertDictEqual(get_item_to_write(record), {"id1": 1, "_meta": {"action": "create"}, "_hash": get_content_hash(record)})
+	
+	def test_content_hash_managed_fields(self):
+		"""
+		Tests that the content hash ignores meta data, DT fields at any level and blank fields but not other changes
+		"""
+		record = {"id1": 1, "val1": "a", "doc": {"x": 1, "dt_modified": "then"}, "_meta": {"action": "update"}}
+		same = {"id1": 1, "val1": "a", "doc": {"x": 1, "DT_MODIFIED": "now"}, "dt_created": "now", "blank": "", "_meta": {"action": "create"}}
+		self.assertEqual(get_content_hash(record), get_content_hash(same))
+		self.assertNotEqual(get_content_hash(record), get_content_hash(dict(record, val1 = "b")))
+	
+	def test_content_hash_exact_decimals(self):
+		"""
+		Tests that the content hash tells apart Decimals which are the same float, and is the same with either backend
+		"""
+		record = {"id1": 1, "val1": decimal.Decimal("1.00000000000000001")}
+		self.assertNotEqual(get_content_hash(record), get_content_hash(dict(record, val1 = decimal.Decimal("1.00000000000000002"))))
+		self.assertEqual(get_content_hash(record), get_content_hash({"val1": decimal.Decimal("1.00000000000000001"), "id1": decimal.Decimal(1)}))
+		backend = codec.get_backend()
+		try:
+			hashes = set()
+			for name in codec.BACKENDS if codec.simplejson else ["json"]:
+				codec.set_backend(name)
+				hashes.add(get_content_hash(record))
+			self.assertEqual(len(hashes), 1)
+		finally:
+			codec.set_backend(backend)
+	
+	def test_classify_update_matching_hash(self):
+		"""
+		Tests that an update whose item has the same content hash is not compared, and one without a hash is marked to store it
+		"""
+		record = {"id1": 1, "id2": 2, "val1": "b", "_meta": {"action": "update"}}
+		classify_record(record, {"id1": 1, "id2": 2, "val1": "a", "_hash": get_content_hash(record)}, self.schema)
+		self.assertEqual(record["_compare_result"]["action"], "none")
+		classify_record(record, {"id1": 1, "id2": 2, "val1": "b"}, self.schema)
+		self.assertEqual(record["_compare_result"]["action"], "none")
+		self.assertTrue(record["_compare_result"]["rehash"])
+	
+	def test_batch_compare_hash_projection(self):
+		"""
+		Tests that only updates whose items have a different content hash are read in full
+		"""
+		records = [{"id1": n, "id2": n, "val1": "b", "_meta": {"action": "update"}} for n in range(3)]
+		items = {
+			0: {"id1": 0, "id2": 0, "val1": "b", "_hash": get_content_hash(records[0])},
+			1: {"id1": 1, "id2": 1, "val1": "a", "_hash": "old"}
+		}
+		reads = []
+		def batch_get(keys, table_name, attributes = None):
+			reads.append(([key["id1"] for key in keys], attributes))
+			return [dict((k, v) for (k, v) in items[key["id1"]].iteritems() if attributes is None or k in attributes) for key in keys if key["id1"] in items]
+		original = lambda_function.ddb_batch_get_items_consistent
+		lambda_function.ddb_batch_get_items_consistent = batch_get
+		try:
+			lambda_function.batch_compare_records(records, self.schema, "dev")
+		finally:
+			lambda_function.ddb_batch_get_items_consistent = original
+		self.assertEqual(reads, [([0, 1, 2], ["id1", "id2", "_meta", "_hash"]), ([1], None)])
+		self.assertEqual([record["_compare_result"]["action"] for record in records], ["none", "update", "create"])
+
+class TestPlan(unittest.TestCase):
+	def setUp(self):
+		self.maxDiff = None
+	
+	def test_plan_round_trip(self):
+		"""
+		Tests that a plan saved as lines of JSON loads back into the same tables and checksums
+		"""
+		tables = validate_and_process({
+			"test": {
+				"000_schema.json": json.loads(valid_dual_key_schema),
+				"001_create.json": json.loads(valid_create_dual_key),
+				"002_create.json": json.loads(valid_create_dual_nested_key)
+			}
+		})
+		for record in tables["test"].get_records():
+			classify_record(record, None, tables["test"].schema)
+		tables["empty"] = TableState({"table": "empty", "keys": ["id"]})
+		text = "".join(iter_plan(tables, {"test": {"001_create.json": "x"}}))
+		self.assertEqual(len(text.splitlines()), 2)
+		checksums = {}
+		self.assertDictEqual(dict(load_plan(text.splitlines(), checksums)), tables)
+		self.assertEqual(checksums, {"test": {"001_create.json": "x"}, "empty": {}})
+	
+	def test_body_lines(self):
+		"""
+		Tests that lines are read from a streamed body whatever the size of the reads
+		"""
+		text = "first\n" + "x" * 25 + "\n\nlast"
+		for size in [1, 4, 100]:
+			self.assertEqual(list(iter_body_lines(StringIO.StringIO(text), size)), ["first", "x" * 25, "", "last"])
+		self.assertEqual(list(iter_body_lines(StringIO.StringIO("one\n"), 2)), ["one"])
+	
+	def test_group_tables(self):
+		"""
+		Tests that tables are grouped until a group holds enough records, without splitting a table
+		"""
+		tables = [(name, TableState({"table": name, "keys": ["id"]}, [{"id": n} for n in range(size)])) for (name, size) in [("a", 3), ("b", 1), ("c", 5), ("d", 1)]]
+		self.assertEqual([sorted(group.keys()) for group in group_tables(tables, 4)], [["a", "b"], ["c"], ["d"]])
+		self.assertEqual([sorted(group.keys()) for group in group_tables(tables, 100)], [["a", "b", "c", "d"]])
+	
+	def test_record_unchanged_since_plan(self):
+		"""
+		Tests that an item which is the version the record was compared to has not changed
+		"""
+		item = {"id1": 1, "_meta": {"ref_file": "001.json", "timestamp": "2018-01-01T00:00:00"}, "_hash": "abc"}
+		record = {"_meta": {"action": "update"}}
+		classify_record(record, item, {"keys": ["id1"]})
+		self.assertFalse(record_changed_since_plan(json.loads(json.dumps(record)), dict(item)))
+	
+	def test_record_written_since_plan(self):
+		"""
+		Tests that an item written since the plan was made has changed, even when it has the same timestamp
+		"""
+		item = {"id1": 1, "_meta": {"ref_file": "001.json", "timestamp": "2018-01-01T00:00:00"}, "_hash": "abc"}
+		record = {"_meta": {"action": "update"}}
+		classify_record(record, item, {"keys": ["id1"]})
+		self.assertTrue(record_changed_since_plan(record, dict(item, _hash = "def")))
+		self.assertTrue(record_changed_since_plan(record, dict(item, _meta = {"ref_file": "002.json", "timestamp": "2018-01-01T00:00:00"})))
+		self.assertTrue(record_changed_since_plan(record, None))
+	
+	def test_record_created_since_plan(self):
+		"""
+		Tests that an item created after the plan was made has changed
+		"""
+		record = {"_meta": {"action": "create"}}
+		classify_record(record, None, {"keys": ["id1"]})
+		self.assertTrue(record_changed_since_plan(record, {"id1": 1}))
+		self.assertFalse(record_changed_since_plan(record, None))
+	
+	def test_record_from_old_plan(self):
+		"""
+		Tests that a record from a plan which did not keep the version of the item has changed
+		"""
+		record = {"_compare_result": {"state": "exists", "action": "none"}}
+		self.assertTrue(record_changed_since_plan(record, {"id1": 1}))
+
+class TestLedger(unittest.TestCase):
+	def setUp(self):
+		self.raw = {
+			"folder": {
+				"000_schema.json": json.loads(valid_dual_key_schema),
+				"001_create.json": json.loads(valid_create_dual_key),
+				"002_create.json": json.loads(valid_create_dual_nested_key),
+				"003_update.json": json.loads(valid_update_dual_nested_key)
+			}
+		}
+	
+	def test_checksums_keyed_by_table(self):
+		"""
+		Tests that checksums are keyed by the table name from the schema and cover only record files
+		"""
+		checksums = get_file_checksums(self.raw)
+		self.assertEqual(checksums.keys(), ["test"])
+		self.assertEqual(sorted(checksums["test"].keys()), ["001_create.json", "002_create.json", "003_update.json"])
+	
+	def test_checksum_ignores_formatting(self):
+		"""
+		Tests that the checksum of a file depends on its content and not how it is laid out
+		"""
+		compact = {"folder": dict(self.raw["folder"])}
+		compact["folder"]["001_create.json"] = json.loads(json.dumps(json.loads(valid_create_dual_key)))
+		self.assertEqual(get_file_checksums(compact)["test"]["001_create.json"], get_file_checksums(self.raw)["test"]["001_create.json"])
+	
+	def test_mark_applied_records(self):
+		"""
+		Tests that only records all of whose files have been applied are marked and left out of the compare
+		"""
+		tables = validate_and_process(self.raw)
+		self.assertEqual(mark_applied_records(tables, {"test": set(["001_create.json", "002_create.json"])}), 1)
+		pending = get_pending_records(tables["test"])
+		self.assertEqual([record["_meta"]["ref_file"] for record in pending], ["003_update.json"])
+	
+	def test_mark_records_with_older_file_changed(self):
+		"""
+		Tests that a record whose newest file has been applied is still compared when an older file it came from has not
+		"""
+		tables = validate_and_process(self.raw)
+		self.assertEqual(tables["test"].files_of((1, 3)), ["002_create.json", "003_update.json"])
+		self.assertEqual(mark_applied_records(tables, {"test": set(["001_create.json", "003_update.json"])}), 1)
+		pending = get_pending_records(tables["test"])
+		self.assertEqual([record["_meta"]["ref_file"] for record in pending], ["003_update.json"])
+
+class TestWorkers(unittest.TestCase):
+	def test_run_tasks_keeps_order(self):
+		"""
+		Tests that task results are returned in the order of the tasks
+		"""
+		tasks = [(lambda n=n: n * 2) for n in range(20)]
+		self.assertEqual(run_tasks(tasks, 4), [n * 2 for n in range(20)])
+	
+	def test_run_tasks_raises(self):
+		"""
+		Tests that an exception from a task is raised by run_tasks
+		"""
+		def fail():
+			raise ProcessError("task failed")
+		with self.assertRaisesRegexp(ProcessError, "task failed"):
+			run_tasks([lambda: 1, fail, lambda: 2], 2)
+	
+	def test_request_slots_cap(self):
+		"""
+		Tests that no more requests than the cap are in flight at once
+		"""
+		slots = RequestSlots(2)
+		lock = threading.Lock()
+		state = {"current": 0, "peak": 0}
+		def request():
+			with slots:
+				with lock:
+					state["current"] += 1
+					state["peak"] = max(state["peak"], state["current"])
+				sleep(0.01)
+				with lock:
+					state["current"] -= 1
+		run_tasks([request for n in range(10)], 5)
+		self.assertEqual(state["peak"], 2)
+
+class FakeClock(object):
+	"""
+	A clock which only moves when slept on
+	"""
+	def __init__(self):
+		self.now = 1000.0
+	
+	def time(self):
+		return self.now
+	
+	def sleep(self, seconds):
+		self.now += seconds
+
+class TestRateLimiter(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+	
+	def test_bucket_unlimited(self):
+		"""
+		Tests that a bucket without a rate never makes callers wait
+		"""
+		bucket = TokenBucket(None, self.clock.time)
+		self.assertEqual(bucket.take(1000), 0)
+	
+	def test_bucket_waits_for_debt(self):
+		"""
+		Tests that taking more than the burst makes the caller wait for the refill
+		"""
+		bucket = TokenBucket(10, self.clock.time)
+		self.assertEqual(bucket.take(10), 0)
+		self.assertAlmostEqual(bucket.take(5), 0.5)
+	
+	def test_provisioned_ceiling(self):
+		"""
+		Tests that the rate starts at the provisioned capacity and is cut on a throttle
+		"""
+		limiter = AdaptiveRateLimiter(capacity_lookup = lambda table, kind: 100, clock = self.clock.time, sleep = self.clock.sleep)
+		self.assertEqual(limiter.rate("t", "read"), 100)
+		limiter.throttled("t", "read")
+		self.assertEqual(limiter.rate("t", "read"), 50)
+	
+	def test_additive_increase_up_to_ceiling(self):
+		"""
+		Tests that the rate ramps back up to the ceiling once throttling stops
+		"""
+		limiter = AdaptiveRateLimiter(capacity_lookup = lambda table, kind: 100, clock = self.clock.time, sleep = self.clock.sleep)
+		limiter.throttled("t", "write")
+		rates = []
+		for n in range(10):
+			self.clock.sleep(1)
+			limiter.acquire("t", "write", 1)
+			limiter.consumed("t", "write", 1, 1)
+			rates.append(limiter.rate("t", "write"))
+		self.assertEqual(rates[:3], [60, 70, 80])
+		self.assertEqual(rates[-1], 100)
+	
+	def test_capacity_lookup_outside_lock(self):
+		"""
+		Tests that other tables are not held up while the capacity of a table is being looked up, and that threads
+		looking up the same table share one pacer
+		"""
+		looking = threading.Event()
+		release = threading.Event()
+		def lookup(table, kind):
+			if table == "slow":
+				looking.set()
+				release.wait(10)
+			return 100
+		limiter = AdaptiveRateLimiter(capacity_lookup = lookup, clock = self.clock.time, sleep = self.clock.sleep)
+		threads = [threading.Thread(target = limiter.throttled, args = ("slow", "read")) for n in range(2)]
+		for thread in threads:
+			thread.start()
+		self.assertTrue(looking.wait(5))
+		fast = threading.Thread(target = limiter.acquire, args = ("fast", "read", 1))
+		fast.start()
+		fast.join(2)
+		self.assertFalse(fast.is_alive())
+		self.assertEqual(limiter.rate("fast", "read"), 100)
+		release.set()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(limiter.rate("slow", "read"), 25)
+	
+	def test_adaptive_throttle_from_unlimited(self):
+		"""
+		Tests that an unlimited table gets a rate based on what it was consuming when it is throttled
+		"""
+		limiter = AdaptiveRateLimiter(clock = self.clock.time, sleep = self.clock.sleep)
+		self.assertEqual(limiter.rate("t", "read"), None)
+		limiter.acquire("t", "read", 40)
+		limiter.consumed("t", "read", 40, 40)
+		limiter.throttled("t", "read")
+		self.assertEqual(limiter.rate("t", "read"), 20)
+	
+	def test_disabled(self):
+		"""
+		Tests that a disabled limiter does not pace or learn
+		"""
+		limiter = AdaptiveRateLimiter(enabled = False, clock = self.clock.time, sleep = self.clock.sleep)
+		limiter.throttled("t", "read")
+		self.assertEqual(limiter.rate("t", "read"), None)
+	
+	def test_consumed_units(self):
+		"""
+		Tests that consumed capacity is read from single and batch responses
+		"""
+		self.assertEqual(get_consumed_units({"ConsumedCapacity": {"TableName": "t", "CapacityUnits": 2.5}}, "t"), 2.5)
+		self.assertEqual(get_consumed_units({"ConsumedCapacity": [{"TableName": "t", "CapacityUnits": 3}, {"TableName": "u", "CapacityUnits": 4}]}, "t"), 3)
+		self.assertEqual(get_consumed_units({}, "t"), 0)
+
+class TestMetrics(unittest.TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.metrics = Metrics(clock=self.clock.time)
+	
+	def test_span_adds_up(self):
+		"""
+		Tests that each use of a span adds to the time and count of its stage
+		"""
+		for seconds in [1, 2]:
+			with self.metrics.span("compare", items=10):
+				self.clock.sleep(seconds)
+		with self.assertRaises(ValueError):
+			with self.metrics.span("report"):
+				self.clock.sleep(4)
+				raise ValueError()
+		summary = self.metrics.summary(job="j")
+		self.assertEqual(summary["job"], "j")
+		self.assertEqual(summary["seconds"], 7)
+		self.assertDictEqual(summary["stages"], {
+			"compare": {"seconds": 3, "count": 2, "items": 20},
+			"report": {"seconds": 4, "count": 1}
+		})
+	
+	def test_table_counters(self):
+		"""
+		Tests that counters are kept for each table and forgotten on reset
+		"""
+		self.metrics.add("t", "requests")
+		self.metrics.add("t", "requests")
+		self.metrics.add("t", "consumed_read", 2.5)
+		self.metrics.add("u", "throttles")
+		self.assertDictEqual(self.metrics.summary()["tables"], {"t": {"requests": 2, "consumed_read": 2.5}, "u": {"throttles": 1}})
+		self.metrics.reset()
+		self.assertDictEqual(self.metrics.summary()["tables"], {})
+	
+	def test_emit(self):
+		"""
+		Tests that emit writes a summary line, followed in emf output by a document for each stage and table
+		"""
+		with self.metrics.span("parse"):
+			self.clock.sleep(1)
+		self.metrics.add("t", "requests", 3)
+		out = StringIO.StringIO()
+		self.metrics.emit(out, "json", dimensions={"Environment": "dev"}, job="j")
+		lines = [json.loads(line) for line in out.getvalue().splitlines()]
+		self.assertEqual(len(lines), 1)
+		self.assertEqual((lines[0]["metrics"], lines[0]["job"], lines[0]["Environment"]), ("summary", "j", "dev"))
+		out = StringIO.StringIO()
+		self.metrics.emit(out, "emf", dimensions={"Environment": "dev"}, job="j")
+		lines = [json.loads(line) for line in out.getvalue().splitlines()]
+		self.assertEqual(len(lines), 3)
+		self.assertEqual((lines[1]["Stage"], lines[1]["Duration"], lines[1]["Environment"]), ("parse", 1, "dev"))
+		self.assertEqual(lines[1]["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Environment", "Stage"]])
+		self.assertEqual((lines[2]["Table"], lines[2]["requests"]), ("t", 3))
+		self.assertNotIn("job", lines[2])
+		out = StringIO.StringIO()
+		self.metrics.emit(out, "off")
+		self.assertEqual(out.getvalue(), "")
+
+class TestProfiler(unittest.TestCase):
+	def test_cpu(self):
+		"""
+		Tests that a cpu profile reports the functions which were called
+		"""
+		with Profiler("cpu", top=5) as profiler:
+			validate_and_process({"test": {"000_schema.json": json.loads(valid_dual_key_schema), "001_create.json": json.loads(valid_create_dual_key)}})
+		report = profiler.report()
+		self.assertIn("Top 5 functions by cumulative time", report)
+		self.assertIn("validate_table", report)
+	
+	def test_mem(self):
+		"""
+		Tests that a mem profile reports what grew while it ran
+		"""
+		with Profiler("mem", top=5) as profiler:
+			kept = [TableState({"table": "t", "keys": ["id"]}) for i in range(1000)]
+		self.assertIn("Top 5", profiler.report())
+	
+	def test_unknown_profile(self):
+		"""
+		Tests that only cpu and mem profiles can be made
+		"""
+		self.assertRaises(ValueError, Profiler, "disk")
+
+class FakeSession(object):
+	"""
+	Records the sessions and clients made by a ClientRegistry
+	"""
+	sessions = []
+	
+	def __init__(self, **kwargs):
+		self.kwargs = kwargs
+		self.made = []
+		FakeSession.sessions.append(self)
+	
+	def client(self, service, config=None):
+		self.made.append(("client", service, config))
+		return {"service": service, "config": config, "session": self}
+	
+	def resource(self, service, config=None):
+		self.made.append(("resource", service, config))
+		return {"service": service, "config": config, "session": self}
+
+class TestClientRegistry(unittest.TestCase):
+	def setUp(self):
+		FakeSession.sessions = []
+		self.registry = ClientRegistry(session_factory=FakeSession)
+	
+	def creds(self, n):
+		return {"accessKeyId": "key{n}".format(n=n), "secretAccessKey": "secret", "sessionToken": "token"}
+	
+	def test_lazy(self):
+		"""
+		Tests that a lazy client is only made when used and is then reused
+		"""
+		sns = self.registry.lazy("sns")
+		self.assertEqual(FakeSession.sessions, [])
+		self.assertEqual(sns.get("service"), "sns")
+		self.assertEqual(sns.get("service"), "sns")
+		self.assertEqual(len(FakeSession.sessions), 1)
+		self.assertEqual(FakeSession.sessions[0].kwargs, {"region_name": "ap-southeast-2"})
+		self.assertEqual(FakeSession.sessions[0].made, [("client", "sns", None)])
+	
+	def test_kept_by_kind_and_config(self):
+		"""
+		Tests that clients are kept for each service, kind and config and share the default session
+		"""
+		client = self.registry.get("dynamodb")
+		self.assertIs(self.registry.get("dynamodb"), client)
+		self.assertIsNot(self.registry.get("dynamodb", "resource"), client)
+		pooled = self.registry.get("dynamodb", max_pool_connections=50)
+		self.assertEqual(pooled["config"].max_pool_connections, 50)
+		self.assertIs(self.registry.get("dynamodb", max_pool_connections=50), pooled)
+		self.assertEqual(len(FakeSession.sessions), 1)
+	
+	def test_credentials(self):
+		"""
+		Tests that clients for credentials get their own session and only the most recent are kept
+		"""
+		client = self.registry.get("s3", creds=self.creds(0))
+		self.assertEqual(client["session"].kwargs["aws_access_key_id"], "key0")
+		self.assertIs(self.registry.get("s3", creds=self.creds(0)), client)
+		self.assertIsNot(self.registry.get("s3"), client)
+		for n in range(1, MAX_CREDENTIAL_SESSIONS + 1):
+			self.registry.get("s3", creds=self.creds(n))
+		self.assertIsNot(self.registry.get("s3", creds=self.creds(0)), client)
+	
+	def test_lazy_config(self):
+		"""
+		Tests that a lazy client switches to a client with the new config when its config changes
+		"""
+		config = {}
+		ddb = self.registry.lazy("dynamodb", config=config)
+		self.assertIsNone(ddb.get("config"))
+		config["retries"] = {"max_attempts": 3}
+		self.assertEqual(ddb.get("config").retries, {"max_attempts": 3})
+		self.assertEqual(len(FakeSession.sessions[0].made), 2)
+
+class TestClientConfig(unittest.TestCase):
+	def setUp(self):
+		self.environ = dict(os.environ)
+	
+	def tearDown(self):
+		os.environ.clear()
+		os.environ.update(self.environ)
+		lambda_function.configure_ddb_clients({})
+	
+	def test_client_config(self):
+		"""
+		Tests that settings are turned into botocore config and only those botocore supports are kept
+		"""
+		(config, unsupported) = client_config(max_pool_connections=50, connect_timeout=2.0, max_attempts=5, retry_mode="legacy")
+		self.assertEqual(config, {"max_pool_connections": 50, "connect_timeout": 2.0, "retries": {"max_attempts": 5}})
+		self.assertEqual(unsupported, [])
+		botocore.client.Config(**config)
+		(config, unsupported) = client_config(retry_mode="adaptive", tcp_keepalive=True)
+		botocore.client.Config(**config)
+		for setting in ["retry_mode", "tcp_keepalive"]:
+			self.assertTrue(setting in unsupported or setting.replace("retry_mode", "retries") in config)
+		self.assertRaises(ValueError, client_config, retry_mode="fast")
+	
+	def test_settings(self):
+		"""
+		Tests that the pool scales with the workers and that UserParameters override environment variables
+		"""
+		os.environ.pop("DDB_MAX_POOL_CONNECTIONS", None)
+		self.assertEqual(lambda_function.get_ddb_client_settings({}, 4), {"max_pool_connections": 10})
+		self.assertEqual(lambda_function.get_ddb_client_settings({}, 64), {"max_pool_connections": 64})
+		os.environ["DDB_MAX_POOL_CONNECTIONS"] = "20"
+		os.environ["DDB_READ_TIMEOUT"] = "5"
+		os.environ["DDB_TCP_KEEPALIVE"] = "true"
+		self.assertEqual(lambda_function.get_ddb_client_settings({"ddbpool": "30", "ddbretrymode": "standard"}, 64), {
+			"max_pool_connections": 30,
+			"read_timeout": 5.0,
+			"tcp_keepalive": True,
+			"retry_mode": "standard"
+		})
+		self.assertRaises(ProcessError, lambda_function.get_ddb_client_settings, {"ddbretrymode": "fast"}, 1)
+		self.assertRaises(ProcessError, lambda_function.get_ddb_client_settings, {"ddbpool": "many"}, 1)
+	
+	def test_configure(self):
+		"""
+		Tests that configuring the clients changes the config the shared dynamo DB clients are made with
+		"""
+		lambda_function.configure_ddb_clients({"max_pool_connections": 40, "max_attempts": 2})
+		self.assertEqual(lambda_function.ddb_client_config, {"max_pool_connections": 40, "retries": {"max_attempts": 2}})
+
+class TestBatchOperations(unittest.TestCase):
+	def setUp(self):
+		self.aws = FakeAWS().install(lambda_function)
+		self.aws.dynamodb.create_table("dev_test", ["id"])
+		# unprocessed batches slow the rate limiter down, these tests are only about the retries
+		lambda_function.configure_rate_limit("off")
+		self.backoff_sleep = lambda_function.backoff_sleep
+		lambda_function.backoff_sleep = lambda attempt: None
+	
+	def tearDown(self):
+		lambda_function.backoff_sleep = self.backoff_sleep
+		lambda_function.configure_rate_limit("adaptive")
+		self.aws.uninstall()
+	
+	def requests(self, operation):
+		return self.aws.dynamodb.requests[(operation, "dev_test")]
+	
+	def test_batch_get_chunks(self):
+		"""
+		Tests that batch gets are sent in chunks of 100 keys
+		"""
+		for n in range(250):
+			self.aws.dynamodb.put("dev_test", {"id": n, "val": n})
+		items = lambda_function.ddb_batch_get_items_consistent([{"id": n} for n in range(260)], "dev_test")
+		self.assertEqual(sorted(item["id"] for item in items), range(250))
+		self.assertEqual(self.requests("BatchGetItem"), 3)
+	
+	def test_batch_get_unprocessed(self):
+		"""
+		Tests that unprocessed keys are retried until every item has been read
+		"""
+		for n in range(100):
+			self.aws.dynamodb.put("dev_test", {"id": n})
+		self.aws.dynamodb.batch_limit = 40
+		items = lambda_function.ddb_batch_get_items_consistent([{"id": n} for n in range(100)], "dev_test")
+		self.assertEqual(sorted(item["id"] for item in items), range(100))
+		self.assertEqual(self.requests("BatchGetItem"), 3)
+	
+	def table(self, actions):
+		return {"test": TableState({"table": "test", "keys": ["id"]}, [{
+			"id": n,
+			"val": "new",
+			"_meta": {"action": action, "ref_file": "001.json", "timestamp": DATE_NOW},
+			"_compare_result": {"action": action, "state": "exists" if action == "delete" else "does_not_exist"}
+		} for (n, action) in enumerate(actions)])}
+	
+	def test_batch_deletes(self):
+		"""
+		Tests that in batch mode deletes are sent in batch writes of 25 items
+		"""
+		for n in range(60):
+			self.aws.dynamodb.put("dev_test", {"id": n})
+		tables = self.table(["delete"] * 60)
+		apply_tables_to_dynamo(tables, "dev", mode = "batch")
+		self.assertEqual(self.aws.dynamodb.items("dev_test"), [])
+		self.assertEqual(self.requests("BatchWriteItem"), 3)
+		self.assertEqual(set(record["_result"] for record in tables["test"].get_records()), set(["completed"]))
+	
+	def test_batch_write_unprocessed(self):
+		"""
+		Tests that unprocessed items are retried until every delete has been written
+		"""
+		for n in range(25):
+			self.aws.dynamodb.put("dev_test", {"id": n})
+		self.aws.dynamodb.batch_limit = 10
+		apply_tables_to_dynamo(self.table(["delete"] * 25), "dev", mode = "batch")
+		self.assertEqual(self.aws.dynamodb.items("dev_test"), [])
+		self.assertEqual(self.requests("BatchWriteItem"), 3)
+	
+	def test_batch_creates_stay_conditional(self):
+		"""
+		Tests that in batch mode creates are still conditional, so an item created since the compare is not overwritten
+		"""
+		self.aws.dynamodb.put("dev_test", {"id": 1, "val": "theirs"})
+		tables = self.table(["create", "create", "delete"])
+		apply_tables_to_dynamo(tables, "dev", mode = "batch")
+		records = sorted(tables["test"].get_records(), key = lambda record: record["id"])
+		self.assertEqual([record["_result"] for record in records], ["completed", "not_completed", "completed"])
+		self.assertEqual([(item["id"], item["val"]) for item in self.aws.dynamodb.items("dev_test")], [(0, "new"), (1, "theirs")])
+		self.assertEqual(self.requests("PutItem"), 2)
+		self.assertEqual(self.requests("BatchWriteItem"), 1)
+	
+	def test_batch_get_gives_up(self):
+		"""
+		Tests that reading gives up when keys are still unprocessed after the last retry
+		"""
+		self.aws.dynamodb.batch_limit = 0
+		self.assertRaises(ProcessError, lambda_function.ddb_batch_get_items_consistent, [{"id": 1}], "dev_test")
+		self.assertEqual(self.requests("BatchGetItem"), lambda_function.BATCH_MAX_RETRIES + 1)
+
+class TestEndToEnd(unittest.TestCase):
+	def setUp(self):
+		self.maxDiff = None
+		archive = StringIO.StringIO()
+		zf = zipfile.ZipFile(archive, "w")
+		zf.writestr("test/000_schema.json", valid_dual_key_schema)
+		zf.writestr("test/001_create.json", valid_create_dual_key)
+		zf.writestr("test/002_create.json", json.dumps({"action": "create", "data": {"id1": 2, "id2": 3, "val1": {"a": [1, 2]}}}))
+		zf.close()
+		self.aws = FakeAWS().install(lambda_function)
+		self.aws.dynamodb.create_table("dev_test", ["id1", "id2"])
+		self.aws.s3.put("artifacts", "artifact.zip", archive.getvalue())
+	
+	def tearDown(self):
+		self.aws.uninstall()
+	
+	def run_job(self, mode, artifact = "artifact.zip", **parameters):
+		parameters.update({
+			"mode": mode,
+			"env": "dev",
+			"reportbucket": "reports",
+			"topic": "arn:aws:sns:fake:topic"
+		})
+		lambda_function.cp_event_handler(make_job_event("job-" + mode, "artifacts", artifact, parameters), None)
+		return self.aws.code_pipeline.results[-1]
+	
+	def test_report_then_commit(self):
+		"""
+		Tests that a report job and then a commit job run against fake AWS services write the items, the report and
+		the plans
+		"""
+		self.assertEqual(self.run_job("report"), ("job-report", "success", None))
+		self.assertEqual(self.aws.dynamodb.items("dev_test"), [])
+		summary = lambda_function.metrics.summary()
+		for stage in ["download", "parse", "compare", "report", "plan", "notify"]:
+			self.assertIn(stage, summary["stages"])
+		self.assertEqual(summary["stages"]["compare"]["items"], 2)
+		self.assertEqual(summary["tables"]["dev_test"]["records_create"], 2)
+		self.assertEqual(summary["tables"]["dev_test"]["requests"], 1)
+		for key in ["job-report/index.html", "job-report/plan.ndjson"]:
+			self.assertIn(("reports", key), self.aws.s3.objects)
+		self.assertTrue(any(key.startswith("plans/dev/") for (bucket, key) in self.aws.s3.objects))
+		self.assertEqual(len(self.aws.sns.messages), 1)
+		self.assertEqual(self.run_job("commit"), ("job-commit", "success", None))
+		self.assertEqual(lambda_function.metrics.summary()["tables"]["dev_test"]["items_written"], 2)
+		items = sorted(self.aws.dynamodb.items("dev_test"), key=lambda item: item["id1"])
+		self.assertEqual([(item["id1"], item["id2"]) for item in items], [(1, 2), (2, 3)])
+		self.assertEqual(items[1]["val1"], {"a": [1, 2]})
+		self.assertEqual(items[0]["_hash"], get_content_hash({"id1": 1, "id2": 2, "val1": "test"}))
+	
+	def put_artifact(self, key, files):
+		archive = StringIO.StringIO()
+		zf = zipfile.ZipFile(archive, "w")
+		zf.writestr("test/000_schema.json", valid_dual_key_schema)
+		for (name, data) in sorted(files.items()):
+			zf.writestr("test/" + name, json.dumps(data))
+		zf.close()
+		self.aws.s3.put("artifacts", key, archive.getvalue())
+	
+	def test_commit_after_other_commit(self):
+		"""
+		Tests that committing a plan compares the items written by another commit since the report again, rather than
+		relying on timestamps which are the same for every job run by a warm container
+		"""
+		for (key, value) in [("a.zip", "a"), ("b.zip", "b")]:
+			self.put_artifact(key, {
+				"001_create.json": json.loads(valid_create_dual_key),
+				"002_update.json": {"action": "update", "data": {"id1": 1, "id2": 2, "val1": value}}
+			})
+		self.assertEqual(self.run_job("commit", "a.zip")[1], "success")
+		self.assertEqual(self.run_job("report", "a.zip")[1], "success")
+		self.assertEqual(self.run_job("commit", "b.zip")[1], "success")
+		self.assertEqual(self.aws.dynamodb.items("dev_test")[0]["val1"], "b")
+		self.assertEqual(self.run_job("commit", "a.zip")[1], "success")
+		self.assertEqual(self.aws.dynamodb.items("dev_test")[0]["val1"], "a")
+	
+	def test_ledger_older_file_changed(self):
+		"""
+		Tests that a commit using the ledger applies an edit to a file when a newer file for the same record has not
+		changed
+		"""
+		self.aws.dynamodb.create_table("dev_ledger", ["table", "ref_file"])
+		for (key, value) in [("a.zip", "a"), ("b.zip", "b")]:
+			self.put_artifact(key, {
+				"001_create.json": {"action": "create", "data": {"id1": 1, "id2": 2, "val1": value}},
+				"002_update.json": {"action": "update", "data": {"id1": 1, "id2": 2, "val2": "x"}}
+			})
+			self.assertEqual(self.run_job("commit", key, ledger = "ledger")[1], "success")
+			self.assertEqual(self.aws.dynamodb.items("dev_test")[0]["val1"], value)
+		checksums = dict((item["ref_file"], item["checksum"]) for item in self.aws.dynamodb.items("dev_ledger"))
+		self.assertEqual(checksums["001_create.json"], get_file_checksum({"action": "create", "data": {"id1": 1, "id2": 2, "val1": "b"}}))
+	
+	def test_groups_of_tables(self):
+		"""
+		Tests that a report and commit which compare one table at a time give the same report and items, and that the
+		commit uses the plan the report saved
+		"""
+		archive = StringIO.StringIO()
+		zf = zipfile.ZipFile(archive, "w")
+		for table in ["one", "two"]:
+			zf.writestr(table + "/000_schema.json", json.dumps({"table": table, "keys": ["id"]}))
+			zf.writestr(table + "/001_create.json", json.dumps({"action": "create", "data": {"id": 1, "val": table}}))
+			self.aws.dynamodb.create_table("dev_" + table, ["id"])
+		zf.close()
+		self.aws.s3.put("artifacts", "tables.zip", archive.getvalue())
+		self.assertEqual(self.run_job("report", "tables.zip", grouprecords = 1)[1], "success")
+		index = gzip.GzipFile(fileobj=StringIO.StringIO(self.aws.s3.objects[("reports", "job-report/index.html")]["Body"])).read()
+		self.assertIn("<tr><td>one</td>", index)
+		self.assertIn("<tr><td>two</td>", index)
+		plans = [key for (bucket, key) in self.aws.s3.objects if key.startswith("plans/dev/")]
+		self.assertEqual(len(self.aws.s3.objects[("reports", plans[0])]["Body"].splitlines()), 3)
+		self.assertEqual(self.run_job("commit", "tables.zip", grouprecords = 1)[1], "success")
+		self.assertEqual(lambda_function.metrics.summary()["stages"]["recheck"]["count"], 2)
+		self.assertEqual([item["val"] for item in self.aws.dynamodb.items("dev_one") + self.aws.dynamodb.items("dev_two")], ["one", "two"])
+		self.assertEqual(self.run_job("report", "tables.zip", grouprecords = 0)[1], "failure")
+	
+	def test_artifact_closed_on_failure(self):
+		"""
+		Tests that the downloaded artifact is closed when a job fails after downloading it
+		"""
+		artifacts = []
+		download = lambda_function.get_artifact_from_s3
+		def get_artifact_from_s3(*args, **kwargs):
+			artifacts.append(download(*args, **kwargs)[0])
+			return (artifacts[-1], "hash")
+		lambda_function.get_artifact_from_s3 = get_artifact_from_s3
+		try:
+			self.assertEqual(self.run_job("report", compare = "blah")[1], "failure")
+		finally:
+			lambda_function.get_artifact_from_s3 = download
+		self.assertTrue(artifacts[0].closed)
+	
+	def report_pages(self):
+		return "".join(gzip.GzipFile(fileobj=StringIO.StringIO(self.aws.s3.objects[("reports", key)]["Body"])).read()
+			for (bucket, key) in self.aws.s3.objects if bucket == "reports" and key.endswith(".html"))
+	
+	def test_scan_compare(self):
+		"""
+		Tests that report jobs which scan the table show unmanaged items, including ones holding sets and binary values
+		"""
+		self.aws.dynamodb.put("dev_test", {"id1": 9, "id2": 9, "tags": set(["a", "b"]), "blob": Binary("\x00\x01")})
+		for compare in ["scan", "auto"]:
+			self.assertEqual(self.run_job("report", compare=compare), ("job-report", "success", None))
+			self.assertGreater(self.aws.dynamodb.requests[("Scan", "dev_test")], 0)
+			pages = self.report_pages()
+			self.assertIn("AAE=", pages)
+			self.assertIn('"tags": [', pages)
+			self.aws.dynamodb.requests.clear()
+	
+	def test_concurrent_io(self):
+		"""
+		Tests that a concurrent job uses the shared client with a connection pool sized for the requests it has in
+		flight, and that the removed io parameter is rejected
+		"""
+		try:
+			self.assertEqual(self.run_job("report", concurrency=50), ("job-report", "success", None))
+			self.assertEqual(lambda_function.ddb_client_config["max_pool_connections"], 50)
+			self.assertIs(lambda_function.get_ddb_item_client(), self.aws.dynamodb.client)
+		finally:
+			lambda_function.configure_ddb_clients({})
+		self.assertEqual(self.run_job("report", io="pipelined")[1], "failure")
+	
+	def test_profile(self):
+		"""
+		Tests that a profiled job puts the profile next to its report
+		"""
+		self.assertEqual(self.run_job("report", profile="cpu", profiletop=5), ("job-report", "success", None))
+		profile = self.aws.s3.objects[("reports", "job-report/profile-cpu.txt")]["Body"]
+		self.assertIn("Top 5 functions by cumulative time", profile)
+		self.assertIn("lambda_function.py", profile)
+		self.assertEqual(self.run_job("report", profile="disk")[1], "failure")
+		for top in [0, -1]:
+			self.assertEqual(self.run_job("report", profile="cpu", profiletop=top)[1:],
+				("failure", "Unexpected err: Profile top {n} is not valid, expecting at least 1".format(n = top)))
+	
+	def test_page_size(self):
+		"""
+		Tests that a report can be paged a row at a time and that a page size below 1 is rejected
+		"""
+		self.assertEqual(self.run_job("report", pagesize = 1), ("job-report", "success", None))
+		for size in [0, -1]:
+			self.assertEqual(self.run_job("report", pagesize = size)[1:],
+				("failure", "Unexpected err: Page size {n} is not valid, expecting at least 1".format(n = size)))
+
 if __name__ == "__main__":
 	unittest.main()
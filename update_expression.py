@@ -0,0 +1,61 @@
+class UpdateExpressionBuilder(object):
+    """
+    Builds a dynamo DB UpdateExpression from SET and REMOVE actions on document paths
+
+    A path is a tuple of attribute names and list indexes, for example ("address", "lines", 0) is address.lines[0].
+    Attribute names are always given placeholders so reserved words and special characters need no handling.
+    """
+    def __init__(self):
+        self.sets = []
+        self.removes = []
+        self.names = {}
+        self.values = {}
+
+    def _name(self, name):
+        if name not in self.names:
+            self.names[name] = "#n{i}".format(i=len(self.names))
+        return self.names[name]
+
+    def _path(self, path):
+        if not path or not isinstance(path[0], basestring):
+            raise ValueError("Path {p} must start with an attribute name".format(p=path))
+        expression = ""
+        for element in path:
+            if isinstance(element, basestring):
+                expression += ("." if expression else "") + self._name(element)
+            else:
+                expression += "[{i:d}]".format(i=element)
+        return expression
+
+    def set(self, path, value):
+        """
+        Sets the value at path
+        """
+        placeholder = ":v{i}".format(i=len(self.values))
+        self.values[placeholder] = value
+        self.sets.append("{p} = {v}".format(p=self._path(path), v=placeholder))
+        return self
+
+    def remove(self, path):
+        """
+        Removes the value at path
+        """
+        self.removes.append(self._path(path))
+        return self
+
+    def build(self):
+        """
+        Gets the UpdateExpression, ExpressionAttributeNames and ExpressionAttributeValues parameters for update_item
+        """
+        clauses = []
+        if self.sets:
+            clauses.append("SET " + ", ".join(self.sets))
+        if self.removes:
+            clauses.append("REMOVE " + ", ".join(self.removes))
+        parameters = {
+            "UpdateExpression": " ".join(clauses),
+            "ExpressionAttributeNames": dict((placeholder, name) for (name, placeholder) in self.names.items())
+        }
+        if self.values:
+            parameters["ExpressionAttributeValues"] = self.values
+        return parameters
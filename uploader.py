@@ -0,0 +1,145 @@
+import sys
+import threading
+
+# S3 needs every part but the last to be at least 5 MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+CONCURRENCY = 4
+
+class MultipartUploader(object):
+    """
+    A file-like object which uploads what is written to it to S3 as a multipart upload
+
+    Parts of part_size bytes are uploaded by up to concurrency threads while more is written, and writers wait when
+    that many parts are in flight, so at most concurrency + 1 parts are held in memory.  Objects smaller than one part
+    are uploaded with a single put_object.  extra_args (for example ContentType) are passed when the object is
+    created.
+
+    Used as a context manager the upload is completed on exit, or aborted if there was an exception, so failed uploads
+    do not leave parts behind in the bucket.
+    """
+    def __init__(self, client, bucket, key, part_size=PART_SIZE, concurrency=CONCURRENCY, **extra_args):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("Part size must be at least {m} bytes".format(m=MIN_PART_SIZE))
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args
+        self.upload_id = None
+        self._buffer = []
+        self._buffered = 0
+        self._parts = {}
+        self._errors = []
+        self._threads = []
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self.closed = False
+
+    def write(self, data):
+        """
+        Adds data to the object, uploading parts as they fill
+        """
+        if self.closed:
+            raise ValueError("Upload is closed")
+        self._check_errors()
+        self._buffer.append(data)
+        self._buffered += len(data)
+        while self._buffered >= self.part_size:
+            self._start_part(self._take(self.part_size))
+
+    def _take(self, size):
+        data = "".join(self._buffer)
+        self._buffer = [data[size:]] if len(data) > size else []
+        self._buffered = len(data) - min(size, len(data))
+        return data[:size]
+
+    def _start_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                **self.extra_args
+            )["UploadId"]
+        number = len(self._threads) + 1
+        self._slots.acquire()
+        thread = threading.Thread(target=self._upload_part, args=(number, data))
+        self._threads.append(thread)
+        thread.start()
+
+    def _upload_part(self, number, data):
+        try:
+            response = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=data
+            )
+            self._parts[number] = response["ETag"]
+        except:
+            self._errors.append(sys.exc_info())
+        finally:
+            self._slots.release()
+
+    def _wait(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _check_errors(self):
+        if self._errors:
+            raise self._errors[0][0], self._errors[0][1], self._errors[0][2]
+
+    def close(self):
+        """
+        Uploads what is left and completes the upload
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=self._take(self._buffered),
+                **self.extra_args
+            )
+            return
+        if self._buffered:
+            self._start_part(self._take(self._buffered))
+        self._wait()
+        self._check_errors()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={
+                "Parts": [{"PartNumber": number, "ETag": self._parts[number]} for number in sorted(self._parts.keys())]
+            }
+        )
+
+    def abort(self):
+        """
+        Stops the upload and removes any parts which have been uploaded
+        """
+        self.closed = True
+        self._wait()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            try:
+                self.close()
+            except:
+                self.abort()
+                raise
+        else:
+            self.abort()
+        return False
@@ -0,0 +1,68 @@
+import threading
+import Queue
+import sys
+
+def run_tasks(tasks, concurrency):
+    """
+    Runs a list of callables using up to concurrency threads
+
+    Returns the results in the same order as tasks.  If any task raises, the first exception is re-raised once all
+    the threads have finished.  With a concurrency of 1 the tasks are run in order on the calling thread.
+    """
+    if concurrency <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+    results = [None] * len(tasks)
+    errors = []
+    queue = Queue.Queue()
+    for i in range(len(tasks)):
+        queue.put(i)
+    def worker():
+        while not errors:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = tasks[i]()
+            except:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=worker) for n in range(min(concurrency, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+class RequestSlots(object):
+    """
+    Caps the number of requests in flight across all threads
+
+    Used as a context manager around each request, a size of None means there is no cap
+    """
+    def __init__(self, size=None):
+        self._local = threading.local()
+        self.resize(size)
+
+    def resize(self, size):
+        """
+        Changes the cap, this should only be done when no requests are in flight
+        """
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size) if size else None
+
+    def __enter__(self):
+        semaphore = self._semaphore
+        if semaphore:
+            semaphore.acquire()
+        if not hasattr(self._local, "held"):
+            self._local.held = []
+        self._local.held.append(semaphore)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        semaphore = self._local.held.pop()
+        if semaphore:
+            semaphore.release()
+        return False